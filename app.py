@@ -1,10 +1,54 @@
+import os
+import re
+import sys
+import csv
+import copy
+import codecs
+import glob
 import json
-import boto3
 import time
+import bisect
+import zlib
+import array
+import struct
+import shutil
+import sqlite3
+import hashlib
+import contextlib
+import random
+import itertools
+import unicodedata
+import threading
 import requests
+import atexit
+import argparse
+import subprocess
 import mimetypes
+import statistics
+import multiprocessing
 from lxml import etree
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from opentelemetry import trace as opentelemetry_trace
+except ImportError:
+    opentelemetry_trace = None
+try:
+    import spacy
+except ImportError:
+    spacy = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 '''
     script configuration variables start
@@ -29,6 +73,130 @@ aws_secret_access_key = ""
 # S3 Bucket Name to store recording
 s3_bucket_name = ""
 
+# Number of parallel Translate and Comprehend requests while analyzing the utterances
+enrichment_max_workers = 8
+# Maximum requests per second sent to each service, 0 disables the limit
+translate_requests_per_second = 10
+comprehend_requests_per_second = 20
+transcribe_requests_per_second = 10
+rekognition_requests_per_second = 5
+# Retries of a request throttled by AWS, with exponential backoff between them
+aws_max_retries = 6
+# Utterances per Comprehend batch request and maximum UTF-8 size of each of them, longer utterances are split
+comprehend_batch_size = 25
+comprehend_max_document_bytes = 5000
+# Translation of the utterances, "realtime" requests a translation for each distinct utterance text, "batch" writes all distinct texts
+# to HTML documents in S3 and translates them with a single Translate batch job, which needs an IAM role allowing Translate to
+# read and write the S3 bucket, documents of the batch job are at most translation_document_max_bytes UTF-8 bytes
+translation_mode = "realtime"
+translation_role_arn = ""
+translation_document_max_bytes = 1000000
+# Backend analyzing entities, sentiment and syntax of the utterances, "comprehend" or "spacy" for a local spaCy pipeline,
+# the translations are always requested from Translate
+analyzer_backend = "comprehend"
+# spaCy pipeline name or path, processes running it and utterances per batch, 0 processes uses one process per processor,
+# the German pipelines tag the words with STTS tags and have no sentiment, all utterances are marked up as neutral then
+spacy_model = "de_core_news_lg"
+spacy_processes = 0
+spacy_batch_size = 64
+
+# Optional job completion notifications, keep the variable strings empty to only poll the job status
+# SNS topic and IAM role used by Rekognition to publish job completion messages
+notification_sns_topic_arn = ""
+notification_role_arn = ""
+# SQS queue subscribed to the SNS topic and to an EventBridge rule for "Transcribe Job State Change" events
+notification_sqs_queue_url = ""
+# Seconds between job status requests, a job is requested every job_poll_min_interval seconds like by a fixed polling loop and
+# once it runs longer than job_poll_backoff_after seconds the interval grows by the factor up to the maximum,
+# so a job is never requested more often than by the fixed loop
+job_poll_min_interval = 15
+job_poll_max_interval = 60
+job_poll_backoff = 1.5
+job_poll_backoff_after = 60
+# Seconds between job status requests while notifications are received, only needed if a notification got lost
+job_poll_notification_interval = 120
+
+# Results per Rekognition get request, the results of a job are read page by page
+rekognition_page_size = 1000
+# Save the raw Rekognition result pages as json lines, one page per line
+spool_raw_responses = True
+
+# Multipart upload of the recording to S3, sizes in bytes
+s3_multipart_threshold = 64 * 1024 * 1024
+s3_multipart_chunksize = 64 * 1024 * 1024
+s3_max_concurrency = 10
+
+# Cache of AWS results, recordings and texts analyzed before are not sent to AWS again, keep variable string empty to disable
+cache_file_path = "aws_result_cache.sqlite"
+# Size of the cache in bytes, the least recently used results are removed when it grows beyond
+cache_max_bytes = 2 * 1024 * 1024 * 1024
+
+# Batch processing of the recordings listed in a manifest, see --batch
+# Recordings analyzed by AWS at the same time and processes creating the TEI files, 0 uses one process per processor
+batch_max_recordings = 8
+batch_tei_workers = 0
+# Uploads and jobs running at the same time for all recordings together, keep them within the service quotas of the account
+max_concurrent_uploads = 4
+max_concurrent_transcription_jobs = 100
+max_concurrent_rekognition_jobs = 20
+max_concurrent_translation_jobs = 10
+
+# Split recordings into chunks of about chunk_duration seconds at keyframes, the chunks overlap by chunk_overlap seconds,
+# the jobs of all chunks run at the same time and their results are merged, 0 disables the chunked mode, needs ffmpeg and ffprobe
+chunk_duration = 0
+chunk_overlap = 30
+ffmpeg_path = "ffmpeg"
+ffprobe_path = "ffprobe"
+
+# Extract the audio track with ffmpeg as mono file and transcribe it instead of the recording, the small audio file is uploaded
+# while the recording is still uploading so the transcription job starts earlier, needs ffmpeg
+extract_audio = False
+# "flac" or "opus", Opus files are smaller but lossy
+audio_format = "flac"
+audio_sample_rate = 16000
+
+# Detect shots and technical cues with Rekognition or "local" with ffmpeg without waiting for the upload,
+# a shot starts at each frame with a scene change score above the threshold, black frames longer than the minimum seconds are
+# BlackFrames cues and the video between them Content cues, needs ffmpeg and ffprobe
+segment_detection_backend = "rekognition"
+scene_change_threshold = 0.4
+black_frames_min_duration = 0.5
+# Seconds of video decoded by each ffmpeg process of the local segment detection and processes running at the same time
+local_segment_range_duration = 300
+local_segment_workers = 4
+
+# Save the uploads, job ids and finished stages of a run in run_state.json of the output directory, a restarted run of the same
+# recording attaches to the jobs still running and skips the finished stages, delete the file to run all stages again
+resume_runs = True
+
+# Write the TEI file element by element instead of building the whole document in memory first, both write the same file
+incremental_tei_writer = True
+# Processes building the cue divs of a TEI file at the same time for the incremental writer, they are written in order,
+# 1 builds them in this process and 0 uses one process per processor, cues longer than tei_fragment_window seconds are split
+tei_fragment_workers = 1
+tei_fragment_window = 300
+# The cues are built in this process if only one processor is available, if they are not split into several tasks or if the
+# shots, detections, utterances, entities and syntax tokens the cue divs are built from have less rows, starting the worker
+# processes and loading the annotation in each of them takes longer than building that many rows (about 50000 per second)
+tei_fragment_min_rows = 150000
+# Merge the samples of a label following each other within a shot to one time range with the sample count and the highest confidence,
+# False keeps one detected label per sample, samples further apart than the gap in seconds start a new range,
+# samples outside of the shots are only merged within the same gap between two shots, numpy is used if it is installed
+aggregate_labels = False
+label_run_max_gap = 1.0
+
+# Save the annotation also as annotation.bin in the columnar binary format, the TEI file is created from it as it loads faster
+save_binary_annotation = True
+
+# Report of the stage times, AWS requests, job waits and TEI creation times of a run saved in the output directory, keep empty to disable
+metrics_report_file_name = "metrics.json"
+# Save the report also in the Prometheus text format as metrics.prom
+metrics_prometheus = False
+# Create an OpenTelemetry span for each timed section, needs the opentelemetry packages and a configured tracer provider
+metrics_opentelemetry = False
+# Upper bounds of the latency histogram buckets in seconds
+metrics_latency_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
 '''
     script configuration variables end
 '''
@@ -36,89 +204,97 @@ s3_bucket_name = ""
 '''
     global variable declaration start
 '''
-transcribe_client = boto3.client('transcribe',
-    region_name=aws_region_name,
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key,
-)
-s3_client = boto3.client('s3',
-    region_name=aws_region_name,
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key,
-)
-translate_client = boto3.client('translate',
-    region_name=aws_region_name,
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key,
-)
-comprehend_client = boto3.client('comprehend',
-    region_name=aws_region_name,
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key,
-)
-rekognition_client = boto3.client('rekognition',
-    region_name=aws_region_name,
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key,
-)
+# AWS clients are created on first use, the offline rebuild does not need boto3
+aws_clients = {}
+aws_clients_lock = threading.Lock()
+# Set by the offline rebuild, every attempt to create an AWS client fails
+offline_mode = False
 
 unix_timestamp = str(int(time.time()))
-s3_key = unix_timestamp+"_"+file_name
+transcription_job_name = unix_timestamp+"_"+file_name
 
-annotation_dict = {}
+result_cache = None
+result_cache_lock = threading.Lock()
 
-'''
-    global variable declaration end
-'''
+# spaCy analyzer loaded on first use
+spacy_analyzer = None
+spacy_analyzer_lock = threading.Lock()
 
+# Prefix of the metric names in the Prometheus text format
+metrics_prefix = "video_to_tei_"
 
+# Slots limiting the uploads and jobs running at the same time for all recordings
+job_slots = {
+    "s3": threading.BoundedSemaphore(max_concurrent_uploads),
+    "transcribe": threading.BoundedSemaphore(max_concurrent_transcription_jobs),
+    "rekognition": threading.BoundedSemaphore(max_concurrent_rekognition_jobs),
+    "translate": threading.BoundedSemaphore(max_concurrent_translation_jobs),
+}
 
-def startAnnotationJobs():
-    
-    print("Start uploading file")
-    with open(file_path+file_name, 'rb') as data:
-        s3_client.upload_fileobj(data, s3_bucket_name, s3_key)
-    s3_uri = "s3://"+s3_bucket_name+"/"+s3_key
-    print("File uploaded to S3")
+# ffmpeg encoder arguments and file extension of each audio format, both are media formats Transcribe accepts
+audio_formats = {
+    "flac": (["-c:a", "flac"], ".flac"),
+    "opus": (["-c:a", "libopus", "-b:a", "32k"], ".ogg"),
+}
 
-    
-    settings = {}
-    if custom_vocabulary:
-        settings["VocabularyName"] = custom_vocabulary
-    print("Start transcription job")
-    response = transcribe_client.start_transcription_job(
-        TranscriptionJobName=s3_key,
-        LanguageCode=language_code,
-        Media={
-            'MediaFileUri': s3_uri,
-        },
-        Settings=settings,
-        #ModelSettings={
-        #    'LanguageModelName': 'string'
-        #},
-    )
+# State of the run of a recording saved in its output directory
+run_state_file_name = "run_state.json"
+# Authority records shared by the recordings of a batch, saved in the output directory of the batch
+entity_registry_file_name = "entity_registry.json"
 
+# Columns of each table of the columnar annotation model, "q" columns are integers like the times in milliseconds,
+# "d" columns are floats and "i" columns are positions in the unique strings of the column
+annotation_columns = {
+    "detected_cues": {"start_ms": "q", "end_ms": "q", "dur_ms": "q", "type": "i"},
+    "detected_shots": {"start_ms": "q", "end_ms": "q", "dur_ms": "q", "index": "q"},
+    "detected_text": {"timestamp_ms": "q", "detected_text": "i"},
+    "detected_labels": {"timestamp_ms": "q", "label_name": "i", "end_ms": "q", "confidence": "d", "count": "q"},
+    "detected_celebrities": {"timestamp_ms": "q", "name": "i", "urls": "i"},
+    "utterances": {"start_ms": "q", "end_ms": "q", "dur_ms": "q", "text": "i", "translation": "i", "sentiment": "i", "entities_end": "q", "syntax_end": "q"},
+    "entities": {"begin": "q", "end": "q", "type": "i", "text": "i", "score": "d"},
+    "syntax": {"begin": "q", "end": "q", "text": "i", "tag": "i", "tag_score": "d"},
+}
+# First bytes of an annotation saved in the binary format and the version of the header and column layout following them
+annotation_model_magic = b"VTTANNO1"
+annotation_model_version = 1
 
-    print("Start video analyzing jobs")
-    label_detection_response = rekognition_client.start_label_detection(
-        Video={
-            'S3Object': {
-                'Bucket': s3_bucket_name,
-                'Name': s3_key,
-            }
-        },
-        MinConfidence=90,
-    )
-    label_detection_response_jobId = label_detection_response["JobId"]
-    #print(label_detection_response["JobId"])
-    segment_detection_response = rekognition_client.start_segment_detection(
-        Video={
-            'S3Object': {
-                'Bucket': s3_bucket_name,
-                'Name': s3_key,
-            }
-        },
-        Filters={
+# AWS error codes of requests rejected because of request rate limits
+throttling_error_codes = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "LimitExceededException",
+    "ServiceUnavailableException",
+}
+
+# Comprehend batch ErrorList codes of documents that are sent again
+retryable_batch_error_codes = throttling_error_codes | {"InternalServerException"}
+
+# Job status of the different services mapped to SUCCEEDED, FAILED or IN_PROGRESS
+job_statuses = {
+    "COMPLETED": "SUCCEEDED",
+    "COMPLETED_WITH_ERROR": "SUCCEEDED",
+    "SUCCEEDED": "SUCCEEDED",
+    "FAILED": "FAILED",
+    "ERROR": "FAILED",
+    "STOPPED": "FAILED",
+}
+
+# Rekognition get operation and raw response file of each video analyzing job
+rekognition_get_operations = {
+    "label_detection": "get_label_detection",
+    "segment_detection": "get_segment_detection",
+    "text_detection": "get_text_detection",
+    "celebrity_recognition": "get_celebrity_recognition",
+}
+# Rekognition start parameters of each video analyzing job
+rekognition_job_parameters = {
+    "label_detection": {
+        "MinConfidence": 90,
+    },
+    "segment_detection": {
+        "Filters": {
             'TechnicalCueFilter': {
                 'MinSegmentConfidence': 90
             },
@@ -126,355 +302,3256 @@ def startAnnotationJobs():
                 'MinSegmentConfidence': 90
             }
         },
-        SegmentTypes=[
+        "SegmentTypes": [
             'TECHNICAL_CUE', 'SHOT'
-        ]
-    )
-    segment_detection_response_jobId = segment_detection_response["JobId"]
-    #print(segment_detection_response["JobId"])
-    text_detection_response = rekognition_client.start_text_detection(
-        Video={
-            'S3Object': {
-                'Bucket': s3_bucket_name,
-                'Name': s3_key,
-            }
-        },
-        Filters={
+        ],
+    },
+    "text_detection": {
+        "Filters": {
             'WordFilter': {
                 'MinConfidence': 90,
                 'MinBoundingBoxHeight': 0.05,
                 'MinBoundingBoxWidth': 0.05
             },
-        }
-    )
-    text_detection_response_jobId = text_detection_response["JobId"]
-    #print(text_detection_response["JobId"])
-    celebrity_detection_response = rekognition_client.start_celebrity_recognition(
-        Video={
-            'S3Object': {
-                'Bucket': s3_bucket_name,
-                'Name': s3_key,
-            }
         },
-    )
-    celebrity_detection_response_jobId = celebrity_detection_response["JobId"]
-    #print(celebrity_detection_response["JobId"])
+    },
+    "celebrity_recognition": {},
+}
+# List of the results and their time keys in the result pages of each Rekognition job
+rekognition_result_times = {
+    "label_detection": ("Labels", ("Timestamp",)),
+    "segment_detection": ("Segments", ("StartTimestampMillis", "EndTimestampMillis")),
+    "text_detection": ("TextDetections", ("Timestamp",)),
+    "celebrity_recognition": ("Celebrities", ("Timestamp",)),
+}
+raw_response_names = {
+    "label_detection": "raw_label_detection_response",
+    "segment_detection": "raw_segment_detection_response",
+    "text_detection": "raw_text_detection_response",
+    "celebrity_recognition": "raw_celebrity_detection_response",
+}
 
+# TEI element and authority list for each entity type marked up in the utterances
+entity_markup = {
+    "LOCATION": ("placeName", "place"),
+    "PERSON": ("persName", "pers"),
+    "DATE": ("date", None),
+    "ORGANIZATION": ("orgName", "org"),
+    "QUANTITY": ("num", None),
+}
 
+# STTS tag for each Universal POS tag of Comprehend, all other tags not in the STTS tag set are marked up as XY
+stts_tags = {
+    "NOUN": "NN",
+    "DET": "ART",
+    "NUM": "CARD",
+    "ADJ": "ADJA",
+    "ADP": "APPR",
+    "ADV": "ADV",
+    "AUX": "VAINF",
+    "CCONJ": "KON",
+    "INTJ": "ITJ",
+    "PRON": "PPER",
+    "PROPN": "NE",
+    "PUNCT": "XY",
+    "SCONJ": "KOUS",
+    "VERB": "VVINF",
+    "PART": "PTKZU",
+    "SYM": "XY",
+    "O": "XY",
+}
+# STTS tags used as they are, tags of the German spaCy pipelines
+stts_tag_set = {
+    "ADJA", "ADJD", "ADV", "APPR", "APPRART", "APPO", "APZR", "ART", "CARD", "FM", "ITJ", "KOUI", "KOUS", "KON", "KOKOM",
+    "NN", "NNE", "NE", "PDS", "PDAT", "PIS", "PIAT", "PIDAT", "PPER", "PPOSS", "PPOSAT", "PRELS", "PRELAT", "PRF",
+    "PWS", "PWAT", "PWAV", "PAV", "PROAV", "PTKZU", "PTKNEG", "PTKVZ", "PTKANT", "PTKA", "TRUNC",
+    "VVFIN", "VVIMP", "VVINF", "VVIZU", "VVPP", "VAFIN", "VAIMP", "VAINF", "VAPP", "VMFIN", "VMINF", "VMPP",
+    "XY", "$,", "$.", "$(",
+}
+# Comprehend entity type of each spaCy entity label, all other labels are typed OTHER
+spacy_entity_types = {
+    "PER": "PERSON",
+    "PERSON": "PERSON",
+    "LOC": "LOCATION",
+    "GPE": "LOCATION",
+    "FAC": "LOCATION",
+    "ORG": "ORGANIZATION",
+    "DATE": "DATE",
+    "TIME": "DATE",
+    "CARDINAL": "QUANTITY",
+    "QUANTITY": "QUANTITY",
+    "MONEY": "QUANTITY",
+    "PERCENT": "QUANTITY",
+    "EVENT": "EVENT",
+    "PRODUCT": "COMMERCIAL_ITEM",
+    "WORK_OF_ART": "TITLE",
+}
 
-    print("Waiting for transcription job to be complete - retry every 15 seconds")
-    while (response["TranscriptionJob"]["TranscriptionJobStatus"] != "COMPLETED") and (response["TranscriptionJob"]["TranscriptionJobStatus"] != "FAILED"):
-        time.sleep(15)
+'''
+    global variable declaration end
+'''
 
-        response = transcribe_client.get_transcription_job(
-            TranscriptionJobName=s3_key
-        )
 
-        if response["TranscriptionJob"]["TranscriptionJobStatus"] == "FAILED":
-            raise Exception("Transcription job failed")
 
-        print("Transcription job not finished")
+def getClient(service_name):
+    '''
+        Function to get the boto3 client of an AWS service, boto3 is only imported once the first client is needed
+    '''
+    if offline_mode:
+        raise Exception("No "+service_name+" requests in offline mode, the results are not available in the raw responses, annotation or cache")
+    with aws_clients_lock:
+        if service_name not in aws_clients:
+            import boto3
+            from botocore.config import Config
 
-    
-    print("Transcription job finished")
+            config = None
+            if service_name in ("translate", "comprehend"):
+                config = Config(max_pool_connections=enrichment_max_workers)
+            aws_clients[service_name] = boto3.client(service_name,
+                region_name=aws_region_name,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                config=config,
+            )
+        return aws_clients[service_name]
 
-    url = response["TranscriptionJob"]["Transcript"]["TranscriptFileUri"]
-    r = requests.get(url, allow_redirects=True)
-    open('raw_transcript.json', 'wb').write(r.content)
-    
-    with open('raw_transcript.json') as f_in:
-        transcript_json = json.load(f_in)
 
-    utterances = []
-    previous_end_time = float(transcript_json["results"]["items"][0]["start_time"])
-    previous_start_time = 0
-    utterance = ""
-    utterance_start = 0
-    utterance_end = 0
-    # Finding last element with an end_time
-    index = 0
+class Metrics:
+    '''
+        Thread safe counters, gauges and latency histograms of a run, each identified by a name and labels,
+        timed sections are also OpenTelemetry spans if metrics_opentelemetry is set and opentelemetry is installed
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(metrics_latency_buckets) + 1)}
+            histogram["count"] = histogram["count"] + 1
+            histogram["sum"] = histogram["sum"] + seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bisect.bisect_left(metrics_latency_buckets, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+            Observes the seconds taken by the block in the histogram name
+        '''
+        span = None
+        if metrics_opentelemetry and opentelemetry_trace is not None:
+            span = opentelemetry_trace.get_tracer("video-to-tei").start_as_current_span(name, attributes={key: str(value) for key, value in labels.items()})
+            span.__enter__()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+            if span is not None:
+                span.__exit__(None, None, None)
+
+    def report(self) -> dict:
+        '''
+            Returns all metrics and the peak resident memory of the process as dict
+        '''
+        peak_rss_bytes = None
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        with self.lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "seconds": time.time() - self.started,
+                "peak_rss_bytes": peak_rss_bytes,
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                    "max": histogram["max"],
+                    "buckets": dict(zip([str(bound) for bound in metrics_latency_buckets] + ["+Inf"], histogram["buckets"])),
+                } for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def toPrometheus(self, report=None) -> str:
+        '''
+            Returns the metrics in the Prometheus text format, histogram buckets are cumulative there
+        '''
+        report = report or self.report()
+
+        def formatLabels(labels):
+            if not labels:
+                return ""
+            return "{"+",".join(key+'="'+str(value).replace("\\", "\\\\").replace('"', '\\"')+'"' for key, value in labels.items())+"}"
+
+        lines = []
+        typed = set()
+        for metric_type, entries in (("counter", report["counters"]), ("gauge", report["gauges"])):
+            for entry in entries:
+                name = metrics_prefix+entry["name"]
+                if name not in typed:
+                    typed.add(name)
+                    lines.append("# TYPE "+name+" "+metric_type)
+                lines.append(name+formatLabels(entry["labels"])+" "+repr(entry["value"]))
+        for entry in report["histograms"]:
+            name = metrics_prefix+entry["name"]
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE "+name+" histogram")
+            cumulative = 0
+            for bound, bucket_count in entry["buckets"].items():
+                cumulative = cumulative + bucket_count
+                lines.append(name+"_bucket"+formatLabels({**entry["labels"], "le": bound})+" "+str(cumulative))
+            lines.append(name+"_sum"+formatLabels(entry["labels"])+" "+repr(entry["sum"]))
+            lines.append(name+"_count"+formatLabels(entry["labels"])+" "+str(entry["count"]))
+        if report["peak_rss_bytes"] is not None:
+            lines.append("# TYPE "+metrics_prefix+"peak_rss_bytes gauge")
+            lines.append(metrics_prefix+"peak_rss_bytes "+str(report["peak_rss_bytes"]))
+        return "\n".join(lines)+"\n"
+
+    def save(self, output_directory):
+        '''
+            Saves the report as json file in the output directory and as Prometheus text file if metrics_prometheus is set
+        '''
+        if not metrics_report_file_name:
+            return
+        report = self.report()
+        with open(os.path.join(output_directory, metrics_report_file_name), 'w') as fp:
+            json.dump(report, fp, indent=2)
+        if metrics_prometheus:
+            with open(os.path.join(output_directory, os.path.splitext(metrics_report_file_name)[0]+".prom"), 'w') as fp:
+                fp.write(self.toPrometheus(report))
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def jobSlot(service):
+    '''
+        Holds one of the job slots of a service, the seconds waited for the slot are observed
+    '''
+    with metrics.timer("job_slot_wait_seconds", service=service):
+        job_slots[service].acquire()
+    try:
+        yield
+    finally:
+        job_slots[service].release()
+
+
+class RateLimiter:
+    '''
+        Thread safe limiter spacing the requests to a service evenly at a maximum rate
+    '''
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_request = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            scheduled = max(now, self.next_request)
+            self.next_request = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+rate_limiters = {
+    "translate": RateLimiter(translate_requests_per_second),
+    "comprehend": RateLimiter(comprehend_requests_per_second),
+    "transcribe": RateLimiter(transcribe_requests_per_second),
+    "rekognition": RateLimiter(rekognition_requests_per_second),
+}
+
+
+def callAws(service, function, **kwargs) -> dict:
+    '''
+        Function to call an AWS client method within the rate limit of the service,
+        throttled requests are retried with exponential backoff and jitter
+    '''
+    attempt = 0
+    operation = getattr(function, "__name__", "unknown")
     while True:
+        if service in rate_limiters:
+            rate_limiters[service].wait()
+        metrics.count("aws_requests_total", service=service, operation=operation)
         try:
-            index = index - 1
-            utterance_end = float(transcript_json["results"]["items"][index]["end_time"])
-            break
-        except KeyError:
-            continue
-    duration = 0
-    for item in transcript_json["results"]["items"]:
-        if item["type"] == "pronunciation":
-            difference = float(item["start_time"]) - previous_end_time
-            if utterance_start == 0:
-                utterance_start = item["start_time"]
-            if difference > 3:
-                utterance_end = previous_end_time
-                duration = float(utterance_end) - float(utterance_start)
-                # Handle case if utterance only has a single word
-                if duration < 0:
-                    utterance_start = str(previous_start_time)
-                duration = float(utterance_end) - float(utterance_start)
-                #print("\n\n"+utterance)
-                utterances.append({
-                    'text': utterance.lstrip(),
-                    'start': utterance_start,
-                    'end': str(previous_end_time),
-                    'dur': '%.2f' % duration
-                })
-                utterance = ""
-                utterance_start = 0
-                utterance_end = 0
-                utterance = utterance + " " + item["alternatives"][0]["content"]
+            with metrics.timer("aws_request_seconds", service=service, operation=operation):
+                return function(**kwargs)
+        except Exception as error:
+            error_code = getattr(error, "response", {}).get("Error", {}).get("Code")
+            if error_code not in throttling_error_codes or attempt >= aws_max_retries:
+                metrics.count("aws_request_errors_total", service=service, operation=operation)
+                raise
+        metrics.count("aws_throttled_retries_total", service=service, operation=operation)
+        time.sleep(random.uniform(0, min(20.0, 0.5 * 2 ** attempt)))
+        attempt = attempt + 1
+
+
+def translationCacheKey(text) -> tuple:
+    return ("translate_text", text, analyze_source_language, translation_target_language)
+
+
+def translateText(text, translate_client=None) -> str:
+    cache = getResultCache()
+    cache_key = translationCacheKey(text)
+    translation = cache.get(*cache_key) if cache is not None else None
+    if translation is None:
+        translate_client = translate_client or getClient("translate")
+        response = callAws("translate", translate_client.translate_text,
+            Text=text,
+            SourceLanguageCode=analyze_source_language,
+            TargetLanguageCode=translation_target_language,
+        )
+        translation = response["TranslatedText"]
+        if cache is not None:
+            cache.put(translation, *cache_key)
+    return translation
+
+
+def splitDocument(text, max_bytes) -> list:
+    '''
+        Function to split a text into (character offset, text) parts of at most max_bytes UTF-8 bytes,
+        parts end at the last whitespace before the limit if there is one
+    '''
+    if len(text.encode("utf-8")) <= max_bytes:
+        return [(0, text)] if text else []
+    documents = []
+    offset = 0
+    while offset < len(text):
+        end = offset
+        size = 0
+        while end < len(text):
+            character_size = len(text[end].encode("utf-8"))
+            if size + character_size > max_bytes:
+                break
+            size = size + character_size
+            end = end + 1
+        if end < len(text):
+            whitespace = text.rfind(" ", offset, end)
+            if whitespace > offset:
+                end = whitespace + 1
+        documents.append((offset, text[offset:end]))
+        offset = end
+    return documents
+
+
+def detectBatch(operation, texts, comprehend_client=None) -> list:
+    '''
+        Function to run a Comprehend batch operation on up to comprehend_batch_size texts,
+        documents in the ErrorList are retried on their own, returns one result per text
+    '''
+    comprehend_client = comprehend_client or getClient("comprehend")
+    results = [None] * len(texts)
+    pending = list(range(len(texts)))
+    attempt = 0
+    while True:
+        response = callAws("comprehend", getattr(comprehend_client, operation),
+            TextList=[texts[index] for index in pending],
+            LanguageCode=analyze_source_language,
+        )
+        for result in response["ResultList"]:
+            results[pending[result["Index"]]] = result
+        failed = []
+        for error in response["ErrorList"]:
+            if error["ErrorCode"] not in retryable_batch_error_codes or attempt >= aws_max_retries:
+                raise Exception("Comprehend "+operation+" failed: "+error["ErrorCode"]+" "+error.get("ErrorMessage", ""))
+            failed.append(pending[error["Index"]])
+        if not failed:
+            return results
+        pending = failed
+        time.sleep(random.uniform(0, min(20.0, 0.5 * 2 ** attempt)))
+        attempt = attempt + 1
+
+
+def addComprehendResults(utterances, documents, entity_results, sentiment_results, syntax_results):
+    '''
+        Function to add the batch results of the utterance documents to the utterances,
+        offsets of split utterances are moved back to the position of the part in the utterance
+    '''
+    sentiments = [[] for utterance in utterances]
+    for utterance in utterances:
+        utterance["entities"] = []
+        utterance["syntax"] = []
+    for (position, offset, text), entity_result, sentiment_result, syntax_result in zip(documents, entity_results, sentiment_results, syntax_results):
+        utterance = utterances[position]
+        for entity in entity_result["Entities"]:
+            if entity["Score"] > 0.7:
+                entity["BeginOffset"] = entity["BeginOffset"] + offset
+                entity["EndOffset"] = entity["EndOffset"] + offset
+                utterance["entities"].append(entity)
+        for token in syntax_result["SyntaxTokens"]:
+            token["TokenId"] = len(utterance["syntax"]) + 1
+            token["BeginOffset"] = token["BeginOffset"] + offset
+            token["EndOffset"] = token["EndOffset"] + offset
+            utterance["syntax"].append(token)
+        sentiments[position].append((sentiment_result, len(text)))
+    for utterance, parts in zip(utterances, sentiments):
+        if len(parts) == 1:
+            utterance["sentiment"] = parts[0][0]["Sentiment"]
+        elif parts:
+            # Sentiment of a split utterance with the highest score weighted by the length of the parts
+            scores = {}
+            for sentiment_result, length in parts:
+                for sentiment, score in sentiment_result["SentimentScore"].items():
+                    scores[sentiment] = scores.get(sentiment, 0.0) + score * length
+            utterance["sentiment"] = max(scores, key=scores.get).upper()
+        else:
+            utterance["sentiment"] = "NEUTRAL"
+
+
+class ComprehendAnalyzer:
+    '''
+        Analyzer sending the utterance documents to Comprehend in batches of comprehend_batch_size documents,
+        documents analyzed before are taken from the result cache
+    '''
+    operations = ("batch_detect_entities", "batch_detect_sentiment", "batch_detect_syntax")
+
+    def __init__(self, comprehend_client=None):
+        self.comprehend_client = comprehend_client
+        self.max_document_bytes = comprehend_max_document_bytes
+
+    def analyze(self, texts, executor) -> tuple:
+        '''
+            Analyzes the texts of an iterable, batches are submitted to the executor while the next texts are still read,
+            returns the entity, sentiment and syntax results of all texts
+        '''
+        cache = getResultCache()
+        documents = []
+        results = {operation: [] for operation in self.operations}
+        missing = {operation: [] for operation in self.operations}
+        batches = []
+
+        def submitBatch(operation):
+            indexes = missing[operation]
+            missing[operation] = []
+            batches.append((operation, indexes, executor.submit(detectBatch, operation, [documents[index] for index in indexes], self.comprehend_client)))
+
+        for text in texts:
+            index = len(documents)
+            documents.append(text)
+            for operation in self.operations:
+                result = cache.get(operation, text, analyze_source_language) if cache is not None else None
+                results[operation].append(result)
+                if result is None:
+                    missing[operation].append(index)
+                    if len(missing[operation]) == comprehend_batch_size:
+                        submitBatch(operation)
+        for operation in self.operations:
+            if missing[operation]:
+                submitBatch(operation)
+        for operation, indexes, future in batches:
+            for index, result in zip(indexes, future.result()):
+                results[operation][index] = result
+                if cache is not None:
+                    cache.put(result, operation, documents[index], analyze_source_language)
+        return tuple(results[operation] for operation in self.operations)
+
+
+class SpacyAnalyzer:
+    '''
+        Analyzer running a local spaCy pipeline over all utterance documents in batches on several processes,
+        the results have the structure of the Comprehend results, the syntax tokens carry the native tags of the pipeline,
+        STTS tags for the German pipelines, and the sentiment is read from a text classifier with sentiment labels if there is one
+    '''
+    def __init__(self, model=None, processes=None, batch_size=None):
+        if spacy is None:
+            raise Exception("The spacy analyzer backend needs the spacy package and the "+(model or spacy_model)+" pipeline")
+        self.nlp = spacy.load(model or spacy_model)
+        self.processes = (processes if processes is not None else spacy_processes) or os.cpu_count() or 1
+        self.batch_size = batch_size or spacy_batch_size
+        # Utterances are not split, only texts longer than the pipeline accepts
+        self.max_document_bytes = self.nlp.max_length
+
+    def analyze(self, texts, executor) -> tuple:
+        '''
+            Analyzes the texts of an iterable, returns the entity, sentiment and syntax results of all texts
+        '''
+        texts = list(texts)
+        entity_results = []
+        sentiment_results = []
+        syntax_results = []
+        with metrics.timer("spacy_analysis_seconds"):
+            for doc in self.nlp.pipe(texts, batch_size=self.batch_size, n_process=min(self.processes, max(1, len(texts) // self.batch_size))):
+                entity_results.append({"Entities": [{
+                    "Score": 1.0,
+                    "Type": spacy_entity_types.get(entity.label_, "OTHER"),
+                    "Text": entity.text,
+                    "BeginOffset": entity.start_char,
+                    "EndOffset": entity.end_char,
+                } for entity in doc.ents]})
+                sentiment_results.append(self.sentiment(doc))
+                syntax_results.append({"SyntaxTokens": [{
+                    "TokenId": position + 1,
+                    "Text": token.text,
+                    "BeginOffset": token.idx,
+                    "EndOffset": token.idx + len(token.text),
+                    "PartOfSpeech": {
+                        "Tag": token.tag_ or token.pos_ or "X",
+                        "Score": 1.0,
+                    },
+                } for position, token in enumerate(token for token in doc if not token.is_space)]})
+        metrics.count("spacy_documents_total", len(texts))
+        return entity_results, sentiment_results, syntax_results
+
+    def sentiment(self, doc) -> dict:
+        scores = {sentiment: 0.0 for sentiment in ("Positive", "Negative", "Neutral", "Mixed")}
+        for label, score in doc.cats.items():
+            if label.capitalize() in scores:
+                scores[label.capitalize()] = score
+        if not any(scores.values()):
+            scores["Neutral"] = 1.0
+        return {"Sentiment": max(scores, key=scores.get).upper(), "SentimentScore": scores}
+
+
+def getAnalyzer(comprehend_client=None):
+    '''
+        Function to return the analyzer of the analyzer backend, the spaCy pipeline is loaded once
+    '''
+    global spacy_analyzer
+    if analyzer_backend == "comprehend":
+        return ComprehendAnalyzer(comprehend_client)
+    if analyzer_backend == "spacy":
+        with spacy_analyzer_lock:
+            if spacy_analyzer is None:
+                spacy_analyzer = SpacyAnalyzer()
+        return spacy_analyzer
+    raise Exception("Unknown analyzer backend "+analyzer_backend)
+
+
+def enrichUtterances(utterances, translate_client=None, comprehend_client=None, max_workers=None, analyzer=None) -> list:
+    '''
+        Function to add translation, entities, sentiment and syntax to the utterances,
+        translations are requested once per distinct text and the other analyses are made by the analyzer of the analyzer backend,
+        all requests run on a thread pool and the utterances are returned in their original order,
+        texts analyzed before are taken from the result cache, utterances already translated are not translated again,
+        utterances may be a generator, requests are sent while the next utterances are still read
+    '''
+    analyzer = analyzer or getAnalyzer(comprehend_client)
+    enriched_utterances = []
+    documents = []
+    translations = {}
+    pending_translations = []
+    with ThreadPoolExecutor(max_workers=max_workers or enrichment_max_workers) as executor:
+
+        def iterDocuments():
+            for utterance in utterances:
+                position = len(enriched_utterances)
+                enriched_utterances.append(utterance)
+                if "translation" not in utterance:
+                    # Repeated utterances like jingles or recurring phrases wait for the translation of their first occurrence
+                    if utterance["text"] in translations:
+                        metrics.count("translation_duplicates_total")
+                    else:
+                        translations[utterance["text"]] = executor.submit(translateText, utterance["text"], translate_client)
+                    pending_translations.append(utterance)
+                for offset, text in splitDocument(utterance["text"], analyzer.max_document_bytes):
+                    documents.append((position, offset, text))
+                    yield text
+
+        entity_results, sentiment_results, syntax_results = analyzer.analyze(iterDocuments(), executor)
+        for utterance in pending_translations:
+            utterance["translation"] = translations[utterance["text"]].result()
+
+    addComprehendResults(enriched_utterances, documents, entity_results, sentiment_results, syntax_results)
+    return enriched_utterances
+
+
+def parseJobNotification(body) -> tuple:
+    '''
+        Function to read the job id and status from a queue message, returns None for other messages,
+        understands Rekognition messages with or without SNS envelope and Transcribe EventBridge events
+    '''
+    try:
+        message = json.loads(body)
+        if message.get("Type") == "Notification":
+            message = json.loads(message["Message"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+    if not isinstance(message, dict):
+        return None
+    if message.get("source") == "aws.transcribe":
+        detail = message.get("detail", {})
+        return detail.get("TranscriptionJobName"), job_statuses.get(detail.get("TranscriptionJobStatus"), "IN_PROGRESS")
+    if "JobId" in message and "Status" in message:
+        return message["JobId"], job_statuses.get(message["Status"], "IN_PROGRESS")
+    return None
+
+
+class SqsNotificationQueue:
+    '''
+        Job completion notifications received from an SQS queue, only the messages of the tracked jobs are deleted,
+        messages of jobs tracked by someone else and messages which are no job notification are made visible again
+        for the other consumers of the queue
+    '''
+    def __init__(self, queue_url, sqs_client=None):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client or getClient("sqs")
+
+    def receive(self, job_ids, wait_seconds) -> list:
+        response = callAws("sqs", self.sqs_client.receive_message,
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=max(0, min(20, int(wait_seconds))),
+        )
+        notifications = []
+        for message in response.get("Messages", []):
+            notification = parseJobNotification(message["Body"])
+            if notification is not None and notification[0] in job_ids:
+                callAws("sqs", self.sqs_client.delete_message, QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+                notifications.append(notification)
             else:
-                utterance = utterance + " " + item["alternatives"][0]["content"]
-            previous_end_time = float(item["end_time"])
-            previous_start_time = float(item["start_time"])
-        elif item["type"] == "punctuation":
-            utterance = utterance + item["alternatives"][0]["content"]
-    #print("\n\n"+utterance)
-    duration = float(previous_end_time) - float(utterance_start)
-    utterances.append({
-        'text': utterance.lstrip(),
-        'start': utterance_start,
-        'end': str(previous_end_time),
-        'dur': '%.2f' % duration
-    })
-    
+                callAws("sqs", self.sqs_client.change_message_visibility, QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"], VisibilityTimeout=0)
+        return notifications
+
+
+class JobTracker:
+    '''
+        Tracks running AWS jobs until they are finished, a notification queue announces finished jobs
+        and jobs without notification are polled with growing intervals as fallback,
+        finished jobs are not requested again
+    '''
+    def __init__(self, notification_queue=None, min_interval=None, max_interval=None, clock=time.monotonic, sleep=time.sleep):
+        self.notification_queue = notification_queue
+        self.min_interval = min_interval or job_poll_min_interval
+        self.max_interval = max_interval or job_poll_max_interval
+        if notification_queue is not None:
+            # Polling is only a fallback for lost notifications
+            self.min_interval = self.max_interval = job_poll_notification_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.checking = False
+
+    def add(self, key, job_id, poll, status="IN_PROGRESS", response=None):
+        '''
+            Adds a job, poll is a function returning the (status, response) of the job
+        '''
+        with self.condition:
+            self.jobs[key] = {
+                "job_id": job_id,
+                "poll": poll,
+                "status": status,
+                "response": response,
+                "interval": self.min_interval,
+                "next_poll": self.clock() + self.min_interval,
+                "added": self.clock(),
+            }
+
+    def waitFor(self, keys) -> dict:
+        '''
+            Blocks until all given jobs are finished, returns the last response of each job,
+            safe to be called from several threads at once
+        '''
+        while True:
+            with self.condition:
+                for key in keys:
+                    if self.jobs[key]["status"] == "FAILED":
+                        raise Exception(key+" job failed")
+                if all(self.jobs[key]["status"] == "SUCCEEDED" for key in keys):
+                    return {key: self.jobs[key]["response"] for key in keys}
+                if self.checking:
+                    self.condition.wait(self.max_interval)
+                    continue
+                self.checking = True
+            try:
+                self.checkJobs()
+            finally:
+                with self.condition:
+                    self.checking = False
+                    self.condition.notify_all()
+
+    def checkJobs(self):
+        '''
+            Waits for notifications until the next job is due for polling, then polls the due jobs
+        '''
+        with self.condition:
+            running = {job["job_id"]: key for key, job in self.jobs.items() if job["status"] == "IN_PROGRESS"}
+            if not running:
+                return
+            next_poll = min(self.jobs[key]["next_poll"] for key in running.values())
+        wait_seconds = max(0.0, next_poll - self.clock())
+        if self.notification_queue is not None:
+            for job_id, status in self.notification_queue.receive(set(running), wait_seconds):
+                if job_id in running:
+                    # Request the job once more to get its result
+                    with self.condition:
+                        self.jobs[running[job_id]]["next_poll"] = 0.0
+        elif wait_seconds > 0:
+            self.sleep(wait_seconds)
+
+        now = self.clock()
+        for key in running.values():
+            job = self.jobs[key]
+            if job["next_poll"] > now:
+                continue
+            status, response = job["poll"]()
+            # Keys of jobs of batch recordings start with the recording name
+            job_label = key.rsplit(" ", 1)[-1]
+            metrics.count("job_status_requests_total", job=job_label)
+            if status != "IN_PROGRESS":
+                metrics.observe("job_wait_seconds", self.clock() - job["added"], job=job_label, status=status)
+            with self.condition:
+                job["status"] = status
+                job["response"] = response
+                if now - job["added"] >= job_poll_backoff_after:
+                    job["interval"] = min(job["interval"] * job_poll_backoff, self.max_interval)
+                job["next_poll"] = now + job["interval"]
+            if status == "IN_PROGRESS":
+                print(key+" job not finished - next status request in "+'%.0f' % job["interval"]+" seconds")
+            else:
+                print(key+" job finished")
+
+
+def pollTranscriptionJob(job_name) -> tuple:
+    response = callAws("transcribe", getClient("transcribe").get_transcription_job,
+        TranscriptionJobName=job_name
+    )
+    return job_statuses.get(response["TranscriptionJob"]["TranscriptionJobStatus"], "IN_PROGRESS"), response
+
+
+def pollRekognitionJob(get_function, job_id) -> tuple:
+    # A single result is enough to read the job status, the results are paginated once the job is finished
+    response = callAws("rekognition", get_function,
+        JobId=job_id,
+        MaxResults=1,
+    )
+    return job_statuses.get(response["JobStatus"], "IN_PROGRESS"), response
+
+
+def getNotificationQueue():
+    if notification_sqs_queue_url:
+        return SqsNotificationQueue(notification_sqs_queue_url)
+    return None
+
+
+class ResultCache:
+    '''
+        Persistent cache of json results in a SQLite database, keyed by the SHA-256 of the json encoded key parts,
+        the least recently used results are removed once the cache grows beyond max_bytes,
+        reads only note the access time in memory, the access times are written with the next result or on close,
+        files like transcripts are kept in a directory next to the database and only their size is stored in it
+    '''
+    # Access times noted before they are written without a result
+    max_pending_accesses = 1000
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.accessed = {}
+        self.files_directory = path+".files"
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def key(self, key_parts) -> str:
+        return hashlib.sha256(json.dumps(key_parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, *key_parts):
+        '''
+            Returns the cached result or None
+        '''
+        key = self.key(key_parts)
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.noteAccess(key)
+        return json.loads(zlib.decompress(row[0]))
+
+    def contains(self, *key_parts) -> bool:
+        key = self.key(key_parts)
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            self.noteAccess(key)
+        return True
+
+    def noteAccess(self, key):
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= self.max_pending_accesses:
+            self.writeAccesses()
+            self.connection.commit()
+
+    def writeAccesses(self):
+        # Called with the lock held, the caller commits
+        if self.accessed:
+            self.connection.executemany("UPDATE results SET last_access = ? WHERE key = ?", [(accessed, key) for key, accessed in self.accessed.items()])
+            self.accessed = {}
+
+    def getFile(self, *key_parts):
+        '''
+            Returns the path of the cached file or None, the file is read from the cache directory and must not be changed
+        '''
+        key = self.key(key_parts)
+        path = os.path.join(self.files_directory, key)
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None or not os.path.exists(path):
+                return None
+            self.noteAccess(key)
+        return path
+
+    def put(self, value, *key_parts):
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        self.putRow(self.key(key_parts), data, len(data))
+
+    def putFile(self, source_path, *key_parts):
+        '''
+            Copies a file into the cache directory, get() of its key returns None
+        '''
+        key = self.key(key_parts)
+        path = os.path.join(self.files_directory, key)
+        os.makedirs(self.files_directory, exist_ok=True)
+        shutil.copyfile(source_path, path+".part")
+        os.replace(path+".part", path)
+        self.putRow(key, zlib.compress(b"null"), os.path.getsize(path))
+
+    def putRow(self, key, data, size):
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes = self.total_bytes - row[0]
+            self.connection.execute("INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, data, size, time.time()))
+            self.accessed.pop(key, None)
+            self.total_bytes = self.total_bytes + size
+            # The least recently used results are only known with all access times written
+            self.writeAccesses()
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.writeAccesses()
+            self.connection.commit()
+            self.connection.close()
+
+    def evict(self):
+        removed = []
+        for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if self.total_bytes <= self.max_bytes:
+                break
+            removed.append((key,))
+            self.total_bytes = self.total_bytes - size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", removed)
+        for key, in removed:
+            if os.path.exists(os.path.join(self.files_directory, key)):
+                os.remove(os.path.join(self.files_directory, key))
+
+
+def getResultCache():
+    global result_cache
+    with result_cache_lock:
+        if result_cache is None and cache_file_path:
+            result_cache = ResultCache(cache_file_path, cache_max_bytes)
+            # Access times of results read since the last write are saved when the script ends
+            atexit.register(result_cache.close)
+    return result_cache
+
+
+def transcriptionCacheKey(media_hash) -> tuple:
+    return (media_hash, "transcribe", language_code, custom_vocabulary)
+
+
+def rekognitionCacheKey(media_hash, job_name) -> tuple:
+    return (media_hash, "rekognition", job_name, rekognition_job_parameters[job_name])
+
+
+def getCachedPages(cache_key):
+    '''
+        Function to get the cached result pages of a job, returns a generator over the pages
+        or None if the job is not cached completely
+    '''
+    cache = getResultCache()
+    if cache is None:
+        return None
+    page_count = cache.get(*cache_key, "pages")
+    if page_count is None:
+        return None
+    if not all(cache.contains(*cache_key, index) for index in range(page_count)):
+        return None
+    return (cache.get(*cache_key, index) for index in range(page_count))
+
+
+def cachePages(pages, cache_key):
+    '''
+        Generator passing the result pages of a job through and adding them to the cache,
+        the job counts as cached once the last page passed
+    '''
+    cache = getResultCache()
+    page_count = 0
+    for page in pages:
+        if cache is not None:
+            cache.put(page, *cache_key, page_count)
+        page_count = page_count + 1
+        yield page
+    if cache is not None:
+        cache.put(page_count, *cache_key, "pages")
+
+
+def getRekognitionJobNames() -> list:
+    '''
+        Function to return the Rekognition jobs run for a recording, the segment detection may run locally
+    '''
+    return [job_name for job_name in rekognition_get_operations if job_name != "segment_detection" or segment_detection_backend == "rekognition"]
+
+
+def allJobsCached(media_hash, transcription=True) -> bool:
+    cache = getResultCache()
+    if cache is None:
+        return False
+    if transcription and cache.getFile(*transcriptionCacheKey(media_hash)) is None:
+        return False
+    return all(cache.contains(*rekognitionCacheKey(media_hash, job_name), "pages") for job_name in getRekognitionJobNames())
+
+
+class UploadProgress:
+    '''
+        Callback of an S3 upload printing the uploaded share and the throughput every few seconds
+    '''
+    def __init__(self, total_bytes, report_interval=5.0):
+        self.total_bytes = total_bytes
+        self.report_interval = report_interval
+        self.uploaded_bytes = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            self.uploaded_bytes = self.uploaded_bytes + bytes_amount
+            now = time.monotonic()
+            if now - self.last_report < self.report_interval:
+                return
+            self.last_report = now
+        print("Uploaded "+'%.1f' % (100.0 * self.uploaded_bytes / max(1, self.total_bytes))+" % with "+'%.1f' % self.throughput()+" MB/s")
+
+    def throughput(self) -> float:
+        return self.uploaded_bytes / 1000000.0 / max(0.001, time.monotonic() - self.started)
+
+
+def hashFile(path) -> str:
+    '''
+        Function to calculate the SHA-256 of a file reading it in chunks
+    '''
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(8 * 1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def s3ObjectExists(s3_client, key, size) -> bool:
+    try:
+        response = s3_client.head_object(Bucket=s3_bucket_name, Key=key)
+    except Exception as error:
+        if getattr(error, "response", {}).get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return response["ContentLength"] == size
+
+
+def uploadRecording(media_hash, path=None, s3_client=None) -> str:
+    '''
+        Function to upload the recording to S3 under the SHA-256 of its content,
+        the upload is skipped if the bucket already contains the recording, returns the S3 key
+    '''
+    path = path or file_path+file_name
+    s3_client = s3_client or getClient("s3")
+    key = "media/"+media_hash+os.path.splitext(path)[1].lower()
+    # The extracted audio file is transcribed instead of the recording
+    if allJobsCached(media_hash, transcription=not extract_audio):
+        print("All analyzing results found in cache, skipping upload")
+        return key
+    return uploadFile(path, key, s3_client, "video")
+
+
+def uploadFile(path, key, s3_client, media):
+    '''
+        Function to upload a file to S3 in parts, the upload is skipped if the bucket already contains the file, returns the S3 key
+    '''
+    from boto3.s3.transfer import TransferConfig
+
+    size = os.path.getsize(path)
+    if s3ObjectExists(s3_client, key, size):
+        print("File already in S3, skipping upload")
+        return key
+
+    print("Start uploading file")
+    transfer_config = TransferConfig(
+        multipart_threshold=s3_multipart_threshold,
+        multipart_chunksize=s3_multipart_chunksize,
+        max_concurrency=s3_max_concurrency,
+    )
+    with jobSlot("s3"):
+        progress = UploadProgress(size)
+        with open(path, 'rb') as data:
+            s3_client.upload_fileobj(data, s3_bucket_name, key, Config=transfer_config, Callback=progress)
+    upload_seconds = time.monotonic() - progress.started
+    metrics.count("upload_bytes_total", size, media=media)
+    metrics.observe("upload_seconds", upload_seconds, media=media)
+    metrics.gauge("upload_bytes_per_second", size / max(0.001, upload_seconds), media=media)
+    print("File uploaded to S3 in "+'%.1f' % upload_seconds+" seconds with "+'%.1f' % progress.throughput()+" MB/s")
+    return key
+
+
+def extractAudio(recording_path, audio_directory) -> str:
+    '''
+        Function to extract the audio track of a recording with ffmpeg as mono file in the audio format, returns its path
+    '''
+    arguments, extension = audio_formats[audio_format]
+    audio_path = os.path.join(audio_directory, "audio"+extension)
+    with metrics.timer("audio_extraction_seconds"):
+        subprocess.run([ffmpeg_path, "-v", "error", "-y", "-i", recording_path,
+            "-vn", "-ac", "1", "-ar", str(audio_sample_rate), *arguments,
+            audio_path], check=True, capture_output=True)
+    return audio_path
+
+
+def uploadAudio(media_hash, recording_path, audio_directory, s3_client=None):
+    '''
+        Function to extract the audio track of the recording and upload it to S3 under the SHA-256 of the recording,
+        nothing is extracted if the transcript is cached, returns the S3 key of the audio file or None
+    '''
+    cache = getResultCache()
+    if cache is not None and cache.getFile(*transcriptionCacheKey(media_hash)) is not None:
+        print("Transcript found in cache, skipping audio extraction")
+        return None
+    s3_client = s3_client or getClient("s3")
+    audio_path = extractAudio(recording_path, audio_directory)
+    recording_size = os.path.getsize(recording_path)
+    audio_size = os.path.getsize(audio_path)
+    metrics.count("audio_bytes_saved_total", recording_size - audio_size)
+    print("Audio extracted to "+'%.1f' % (audio_size / 1000000.0)+" MB instead of "+'%.1f' % (recording_size / 1000000.0)+" MB, "
+        +'%.1f' % ((recording_size - audio_size) / 1000000.0)+" MB less to upload for the transcription")
+    return uploadFile(audio_path, "audio/"+media_hash+"_"+str(audio_sample_rate)+os.path.splitext(audio_path)[1], s3_client, "audio")
+
+
+def runTranscriptionJob(job_tracker, s3_object_key, job_name=None, job_key="transcription", run_state=None) -> dict:
+    job_name = job_name or transcription_job_name
+    settings = {}
+    if custom_vocabulary:
+        settings["VocabularyName"] = custom_vocabulary
+    with jobSlot("transcribe"):
+        previous_job_name = run_state.getJob(job_key) if run_state is not None else None
+        status, response = (None, None)
+        if previous_job_name is not None:
+            status, response = attachJob(job_key, lambda: pollTranscriptionJob(previous_job_name))
+        if status is None:
+            print("Start transcription job")
+            response = callAws("transcribe", getClient("transcribe").start_transcription_job,
+                TranscriptionJobName=job_name,
+                LanguageCode=language_code,
+                Media={
+                    'MediaFileUri': "s3://"+s3_bucket_name+"/"+s3_object_key,
+                },
+                Settings=settings,
+                #ModelSettings={
+                #    'LanguageModelName': 'string'
+                #},
+            )
+            if run_state is not None:
+                run_state.setJob(job_key, job_name)
+            job_tracker.add(job_key, job_name, lambda: pollTranscriptionJob(job_name))
+        else:
+            job_tracker.add(job_key, previous_job_name, lambda: pollTranscriptionJob(previous_job_name), status, response)
+        print("Waiting for transcription job to be complete")
+        response = job_tracker.waitFor([job_key])[job_key]
+    print("Transcription job finished")
+    return response
+
+
+class TeeReader:
+    '''
+        File-like reader copying all data read from a stream to a file
+    '''
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copy.write(data)
+        return data
+
+
+class JsonStreamReader:
+    '''
+        Reader of a JSON document from a binary stream decoding one value after another with the json module,
+        only the part of the document not decoded yet is kept in memory
+    '''
+    # Characters a number decoded up to the end of the buffer may go on with in the next chunk
+    number_tail = re.compile(r"[0-9.eE+-]*\Z")
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def fill(self, size=None) -> bool:
+        if self.finished:
+            return False
+        data = self.stream.read(size or self.chunk_size)
+        self.finished = not data
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(data, final=self.finished)
+        self.position = 0
+        return not self.finished
+
+    def peek(self) -> str:
+        '''
+            Returns the next character after whitespace without consuming it, an empty string at the end of the document
+        '''
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\n\r":
+                self.position = self.position + 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, characters) -> str:
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of "+repr(characters)+" in the JSON document, found "+repr(character))
+        self.position = self.position + 1
+        return character
+
+    def value(self):
+        '''
+            Decodes the next value, more of the stream is read while the value may continue after the buffer,
+            at least as much as is buffered already, so a long value is decoded again only a few times
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill(max(self.chunk_size, len(self.buffer) - self.position)):
+                    raise
+                continue
+            # A number cut at the end of the buffer, also after its "." or exponent, goes on in the next chunk
+            if isinstance(value, (int, float)) and self.number_tail.match(self.buffer, end) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def iterArray(self, path):
+        '''
+            Generator over the values of the array at the path of object keys, the document after the array is not read
+        '''
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key == path[0]:
+                if len(path) > 1:
+                    yield from self.iterArray(path[1:])
+                    return
+                self.expect("[")
+                if self.peek() == "]":
+                    return
+                while True:
+                    yield self.value()
+                    if self.expect(",]") == "]":
+                        return
+            self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+def iterTranscriptItems(transcript_file):
+    '''
+        Generator over the items of a transcript file object, parsed one item after another
+        with ijson if it is installed or else with the json module
+    '''
+    if ijson is None:
+        yield from JsonStreamReader(transcript_file).iterArray(("results", "items"))
+    else:
+        yield from ijson.items(transcript_file, "results.items.item", use_float=True)
+
+
+def readTranscriptItems(transcript_path):
+    with open(transcript_path, 'rb') as transcript_file:
+        yield from iterTranscriptItems(transcript_file)
+
+
+def downloadTranscriptItems(response, transcript_path='raw_transcript.json', cache_key=None):
+    '''
+        Generator over the transcript items parsed directly from the download, the transcript is saved to the file while it is read
+        and added to the cache once it is read completely
+    '''
+    url = response["TranscriptionJob"]["Transcript"]["TranscriptFileUri"]
+    with requests.get(url, allow_redirects=True, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(transcript_path, 'wb') as copy:
+            transcript_stream = TeeReader(r.raw, copy)
+            yield from iterTranscriptItems(transcript_stream)
+            # Copy what follows the items
+            while transcript_stream.read(1024 * 1024):
+                pass
+    cache = getResultCache()
+    if cache is not None and cache_key is not None:
+        cache.putFile(transcript_path, *cache_key)
+
+
+def runTranscriptionStage(job_tracker, media_hash, s3_object_key, output_directory=".", job_name=None, job_key="transcription", run_state=None):
+    '''
+        Function to get the transcript from the cache or by running the transcription job,
+        returns a generator over the transcript items which downloads the transcript while it is read
+    '''
+    transcript_path = os.path.join(output_directory, 'raw_transcript.json')
+    cache = getResultCache()
+    cache_key = transcriptionCacheKey(media_hash)
+    cached_transcript_path = cache.getFile(*cache_key) if cache is not None else None
+    if cached_transcript_path is not None:
+        print("Transcript found in cache")
+        shutil.copyfile(cached_transcript_path, transcript_path)
+        return readTranscriptItems(transcript_path)
+    return downloadTranscriptItems(runTranscriptionJob(job_tracker, s3_object_key, job_name, job_key, run_state), transcript_path, cache_key)
+
+
+def buildTranslationDocuments(texts, max_bytes) -> list:
+    '''
+        Function to write texts to HTML documents of about max_bytes UTF-8 bytes at most, each text is a paragraph
+        with its position as id, so the translated paragraphs are found again whatever the translation does to the texts
+    '''
+    documents = []
+    body = None
+    size = 0
+    for position, text in enumerate(texts):
+        paragraph = etree.Element("p", id="t"+str(position))
+        paragraph.text = text
+        paragraph_size = len(etree.tostring(paragraph, encoding="UTF-8", method="html"))
+        if body is None or size + paragraph_size > max_bytes:
+            html = etree.Element("html")
+            head = etree.SubElement(html, "head")
+            etree.SubElement(head, "meta", charset="utf-8")
+            body = etree.SubElement(html, "body")
+            documents.append(html)
+            size = 0
+        body.append(paragraph)
+        size = size + paragraph_size
+    return [etree.tostring(html, encoding="UTF-8", method="html") for html in documents]
+
+
+def readTranslationDocument(document) -> dict:
+    '''
+        Function to read the paragraphs of a translated HTML document, returns the translated texts by their position
+    '''
+    html = etree.fromstring(document, etree.HTMLParser(encoding="utf-8"))
+    translations = {}
+    for paragraph in html.iter("p"):
+        paragraph_id = paragraph.get("id", "")
+        if paragraph_id.startswith("t") and paragraph_id[1:].isdigit():
+            translations[int(paragraph_id[1:])] = " ".join("".join(paragraph.itertext()).split())
+    return translations
+
+
+def pollTranslationJob(job_id, translate_client=None) -> tuple:
+    response = callAws("translate", (translate_client or getClient("translate")).describe_text_translation_job,
+        JobId=job_id
+    )
+    return job_statuses.get(response["TextTranslationJobProperties"]["JobStatus"], "IN_PROGRESS"), response
+
+
+def runTranslationJob(job_tracker, document_prefix, job_name=None, job_key="translation", run_state=None, translate_client=None) -> dict:
+    '''
+        Function to translate the HTML documents under the input folder of the S3 prefix with a Translate batch job,
+        the translated documents are written to the output folder, returns the job description
+    '''
+    translate_client = translate_client or getClient("translate")
+    # Translate job names only allow letters, numbers and a few punctuation characters
+    job_name = re.sub(r"[^\w.:/=+\-%@]", "_", job_name or unix_timestamp)[:256]
+    with jobSlot("translate"):
+        previous_job_id = run_state.getJob(job_key) if run_state is not None else None
+        status, response = (None, None)
+        if previous_job_id is not None:
+            status, response = attachJob(job_key, lambda: pollTranslationJob(previous_job_id, translate_client))
+        if status is None:
+            print("Start translation job")
+            job_id = callAws("translate", translate_client.start_text_translation_job,
+                JobName=job_name,
+                InputDataConfig={
+                    'S3Uri': "s3://"+s3_bucket_name+"/"+document_prefix+"input/",
+                    'ContentType': "text/html",
+                },
+                OutputDataConfig={
+                    'S3Uri': "s3://"+s3_bucket_name+"/"+document_prefix+"output/",
+                },
+                DataAccessRoleArn=translation_role_arn,
+                SourceLanguageCode=analyze_source_language,
+                TargetLanguageCodes=[translation_target_language],
+            )["JobId"]
+            if run_state is not None:
+                run_state.setJob(job_key, job_id)
+            job_tracker.add(job_key, job_id, lambda: pollTranslationJob(job_id, translate_client))
+        else:
+            job_tracker.add(job_key, previous_job_id, lambda: pollTranslationJob(previous_job_id, translate_client), status, response)
+        print("Waiting for translation job to be complete")
+        response = job_tracker.waitFor([job_key])[job_key]
+    print("Translation job finished")
+    return response
+
+
+def downloadTranslations(response, document_names, s3_client) -> dict:
+    '''
+        Function to read the translated documents of a finished translation job from S3,
+        returns the translated texts by their position
+    '''
+    properties = response["TextTranslationJobProperties"]
+    # Translate writes the documents to a folder named after the account and job id as <language>.<input document name>
+    output_prefix = properties["OutputDataConfig"]["S3Uri"].split("/", 3)[3]
+    job_folder = "-TranslateText-"+properties["JobId"]+"/"
+    translated_names = {translation_target_language+"."+document_name for document_name in document_names}
+    translations = {}
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=s3_bucket_name, Prefix=output_prefix):
+        for s3_object in page.get("Contents", []):
+            if job_folder in s3_object["Key"] and os.path.basename(s3_object["Key"]) in translated_names:
+                document = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_object["Key"])["Body"].read()
+                translations.update(readTranslationDocument(document))
+    return translations
+
+
+def translateUtterancesBatch(utterances, job_tracker, job_name=None, job_key="translation", run_state=None, translate_client=None, s3_client=None) -> list:
+    '''
+        Function to translate the utterances with one Translate batch job instead of a request per utterance,
+        each distinct text is translated once, texts from the result cache and utterances already translated are not sent,
+        texts missing in the translated documents are translated one by one, returns the utterances as list
+    '''
+    utterances = list(utterances)
+    pending = [utterance for utterance in utterances if "translation" not in utterance]
+    cache = getResultCache()
+    translations = {}
+    texts = []
+    for text in dict.fromkeys(utterance["text"] for utterance in pending):
+        translation = cache.get(*translationCacheKey(text)) if cache is not None else None
+        if translation is None:
+            texts.append(text)
+        else:
+            translations[text] = translation
+    metrics.count("translation_duplicates_total", len(pending) - len(translations) - len(texts))
+
+    if texts:
+        s3_client = s3_client or getClient("s3")
+        documents = buildTranslationDocuments(texts, translation_document_max_bytes)
+        # Documents with the same texts are uploaded to the same prefix, the job folder keeps the outputs of the jobs apart
+        document_prefix = "translation/"+hashlib.sha256(b"".join(documents)).hexdigest()+"/"
+        document_names = ["transcript"+f'{index:03d}'+".html" for index in range(len(documents))]
+        for document_name, document in zip(document_names, documents):
+            s3_client.put_object(Bucket=s3_bucket_name, Key=document_prefix+"input/"+document_name, Body=document, ContentType="text/html")
+        response = runTranslationJob(job_tracker, document_prefix, job_name, job_key, run_state, translate_client)
+        translated = downloadTranslations(response, document_names, s3_client)
+        missing = [text for position, text in enumerate(texts) if position not in translated]
+        if missing:
+            print(str(len(missing))+" texts missing in the translated documents, translating them one by one")
+            metrics.count("translation_fallbacks_total", len(missing))
+        for position, text in enumerate(texts):
+            if position in translated:
+                translations[text] = translated[position]
+                if cache is not None:
+                    cache.put(translated[position], *translationCacheKey(text))
+            else:
+                translations[text] = translateText(text, translate_client)
+        print(str(len(pending))+" utterances translated with one translation job of "+str(len(texts))+" distinct texts in "+str(len(documents))+" documents")
+
+    for utterance in pending:
+        utterance["translation"] = translations[utterance["text"]]
+    return utterances
+
+
+def addEnrichmentStages(stage_graph, output_directory, job_tracker, job_name, job_key_prefix, run_state):
+    '''
+        Function to add the stages translating and analyzing the utterances to a stage graph,
+        in the batch translation mode the utterances are translated by one job before they are analyzed
+    '''
+    enrichment_input = "utterances"
+    if translation_mode == "batch":
+        enrichment_input = "translation"
+        stage_graph.add("translation", lambda utterances: translateUtterancesBatch(utterances, job_tracker, job_name, job_key_prefix+"translation", run_state), ["utterances"],
+            checkpoint=(lambda utterances: saveStageOutput(utterances, os.path.join(output_directory, 'translation.json')), loadStageOutput))
+    elif translation_mode != "realtime":
+        raise Exception("Unknown translation mode "+translation_mode)
+    stage_graph.add("enrichment", lambda **results: enrichUtterances(results[enrichment_input]), [enrichment_input],
+        checkpoint=(lambda utterances: saveStageOutput(utterances, os.path.join(output_directory, 'enrichment.json')), loadStageOutput))
+
+
+def iterUtterances(items):
+    '''
+        Generator joining the transcribed words to utterances, an utterance ends at a pause longer than 3 seconds
+        and is yielded as soon as the next word shows the pause
+    '''
+    items = iter(items)
+    first_item = next(items, None)
+    if first_item is None:
+        return
+    previous_end_time = float(first_item["start_time"])
+    previous_start_time = 0
+    utterance = ""
+    utterance_start = 0
+    for item in itertools.chain([first_item], items):
+        if item["type"] == "pronunciation":
+            difference = float(item["start_time"]) - previous_end_time
+            if utterance_start == 0:
+                utterance_start = item["start_time"]
+            if difference > 3:
+                utterance_end = previous_end_time
+                duration = float(utterance_end) - float(utterance_start)
+                # Handle case if utterance only has a single word
+                if duration < 0:
+                    utterance_start = str(previous_start_time)
+                duration = float(utterance_end) - float(utterance_start)
+                yield {
+                    'text': utterance.lstrip(),
+                    'start': utterance_start,
+                    'end': str(previous_end_time),
+                    'dur': '%.2f' % duration
+                }
+                utterance = ""
+                utterance_start = 0
+                utterance = utterance + " " + item["alternatives"][0]["content"]
+            else:
+                utterance = utterance + " " + item["alternatives"][0]["content"]
+            previous_end_time = float(item["end_time"])
+            previous_start_time = float(item["start_time"])
+        elif item["type"] == "punctuation":
+            utterance = utterance + item["alternatives"][0]["content"]
+    duration = float(previous_end_time) - float(utterance_start)
+    yield {
+        'text': utterance.lstrip(),
+        'start': utterance_start,
+        'end': str(previous_end_time),
+        'dur': '%.2f' % duration
+    }
+
+
+def startRekognitionJob(job_name, s3_object_key) -> str:
+    '''
+        Function to start a Rekognition video analyzing job, returns the job id
+    '''
+    video = {
+        'S3Object': {
+            'Bucket': s3_bucket_name,
+            'Name': s3_object_key,
+        }
+    }
+    notification_channel = {}
+    if notification_sns_topic_arn:
+        notification_channel["NotificationChannel"] = {
+            'SNSTopicArn': notification_sns_topic_arn,
+            'RoleArn': notification_role_arn,
+        }
+    start_function = getattr(getClient("rekognition"), "start_"+job_name)
+    response = callAws("rekognition", start_function,
+        Video=video,
+        **rekognition_job_parameters[job_name],
+        **notification_channel,
+    )
+    return response["JobId"]
+
+
+def runRekognitionJob(job_tracker, job_name, s3_object_key, job_key=None, run_state=None):
+    '''
+        Function to run a Rekognition video analyzing job until it is finished, a job submitted by a previous run is attached to,
+        returns a generator over all result pages of the job
+    '''
+    job_key = job_key or job_name
+    get_function = getattr(getClient("rekognition"), rekognition_get_operations[job_name])
+    with jobSlot("rekognition"):
+        job_id = run_state.getJob(job_key) if run_state is not None else None
+        status, response = (None, None)
+        if job_id is not None:
+            status, response = attachJob(job_key, lambda: pollRekognitionJob(get_function, job_id))
+        if status is None:
+            print("Start "+job_name+" job")
+            job_id = startRekognitionJob(job_name, s3_object_key)
+            if run_state is not None:
+                run_state.setJob(job_key, job_id)
+            job_tracker.add(job_key, job_id, lambda: pollRekognitionJob(get_function, job_id))
+        else:
+            job_tracker.add(job_key, job_id, lambda: pollRekognitionJob(get_function, job_id), status, response)
+        job_tracker.waitFor([job_key])
+    return iterRekognitionPages(get_function, job_id)
+
+
+def iterRekognitionPages(get_function, job_id):
+    '''
+        Generator over all result pages of a finished Rekognition job following the NextToken
+    '''
+    pagination = {}
+    while True:
+        page = callAws("rekognition", get_function,
+            JobId=job_id,
+            MaxResults=rekognition_page_size,
+            **pagination,
+        )
+        yield page
+        if not page.get("NextToken"):
+            break
+        pagination["NextToken"] = page["NextToken"]
+
+
+def spoolPages(pages, spool_file_path):
+    '''
+        Generator passing the pages through, each page is appended as json line to the spool file
+    '''
+    with open(spool_file_path, 'w') as spool:
+        for page in pages:
+            spool.write(json.dumps(page)+"\n")
+            yield page
+
+
+def getRekognitionPages(job_tracker, job_name, media_hash, s3_object_key, job_key=None, run_state=None):
+    '''
+        Function to get the result pages of a Rekognition job from the cache or by running the job
+    '''
+    cache_key = rekognitionCacheKey(media_hash, job_name)
+    pages = getCachedPages(cache_key)
+    if pages is None:
+        return cachePages(runRekognitionJob(job_tracker, job_name, s3_object_key, job_key, run_state), cache_key)
+    print(job_name+" results found in cache")
+    return pages
+
+
+def runRekognitionStage(job_tracker, job_name, media_hash, s3_object_key, output_directory=".", job_key=None, run_state=None) -> dict:
+    '''
+        Function to get the results of a Rekognition job from the cache or by running the job
+    '''
+    pages = getRekognitionPages(job_tracker, job_name, media_hash, s3_object_key, job_key, run_state)
+    if spool_raw_responses:
+        pages = spoolPages(pages, os.path.join(output_directory, raw_response_names[job_name]+".jsonl"))
+    return collectRekognitionResults(job_name, pages)
+
+
+def collectRekognitionResults(job_name, pages) -> dict:
+    '''
+        Function to parse the result pages of a Rekognition job one after another to the annotation lists,
+        returns the lists by their annotation key and the video metadata of the job
+    '''
+    results = {"VideoMetadata": None}
+    if job_name == "label_detection":
+        results["detected_labels"] = []
+    elif job_name == "segment_detection":
+        results["detected_cues"] = []
+        results["detected_shots"] = []
+    elif job_name == "text_detection":
+        results["detected_text"] = []
+    elif job_name == "celebrity_recognition":
+        results["detected_celebrities"] = []
+    for page in pages:
+        if results["VideoMetadata"] is None:
+            results["VideoMetadata"] = page.get("VideoMetadata")
+        if job_name == "label_detection":
+            results["detected_labels"].extend(parseLabels(page))
+        elif job_name == "segment_detection":
+            cues, shots = parseSegments(page)
+            results["detected_cues"].extend(cues)
+            results["detected_shots"].extend(shots)
+        elif job_name == "text_detection":
+            results["detected_text"].extend(parseTextDetections(page))
+        elif job_name == "celebrity_recognition":
+            results["detected_celebrities"].extend(parseCelebrities(page))
+    return results
+
+
+def parseTextDetections(text_detection_response) -> list:
+    detected_text_array = []
+    for detection in text_detection_response["TextDetections"]:
+        detected_text = {}
+        if detection["TextDetection"]["Type"] == "LINE":
+            detected_text["detected_text"] = detection["TextDetection"]["DetectedText"]
+            timestamp = float(detection["Timestamp"])/1000.0
+            detected_text["timestamp"] = "%.2f" % timestamp
+            detected_text_array.append(detected_text)
+    return detected_text_array
+
+
+def parseSegments(segment_detection_response) -> tuple:
+    cue_detection_array = []
+    shot_detection_array = []
+    for segment in segment_detection_response["Segments"]:
+        if segment["Type"] == "TECHNICAL_CUE":
+            detected_cue = {}
+            timestamp = float(segment["StartTimestampMillis"])/1000.0
+            detected_cue["start"] = "%.2f" % timestamp
+            timestamp = float(segment["EndTimestampMillis"])/1000.0
+            detected_cue["end"] = "%.2f" % timestamp
+            timestamp = float(segment["DurationMillis"])/1000.0
+            detected_cue["dur"] = "%.2f" % timestamp
+            detected_cue["type"] = segment["TechnicalCueSegment"]["Type"]
+            cue_detection_array.append(detected_cue)
+        if segment["Type"] == "SHOT":
+            detected_shot = {}
+            timestamp = float(segment["StartTimestampMillis"])/1000.0
+            detected_shot["start"] = "%.2f" % timestamp
+            timestamp = float(segment["EndTimestampMillis"])/1000.0
+            detected_shot["end"] = "%.2f" % timestamp
+            timestamp = float(segment["DurationMillis"])/1000.0
+            detected_shot["dur"] = "%.2f" % timestamp
+            detected_shot["index"] = segment["ShotSegment"]["Index"]
+            shot_detection_array.append(detected_shot)
+    return cue_detection_array, shot_detection_array
+
+
+def parseLabels(label_detection_response) -> list:
+    label_detection_array = []
+    for label in label_detection_response["Labels"]:
+        detected_label = {}
+        detected_label["label_name"] = label["Label"]["Name"]
+        timestamp = float(label["Timestamp"])/1000.0
+        detected_label["timestamp"] = "%.2f" % timestamp
+        if aggregate_labels:
+            detected_label["confidence"] = label["Label"]["Confidence"]
+        label_detection_array.append(detected_label)
+    return label_detection_array
+
+
+def getLabelSegment(shot_starts, shot_ends, timestamp) -> int:
+    '''
+        Function to return the segment of a label sample, 2 * shot + 1 within a shot and 2 * shot + 2 in the gap after the shot,
+        so samples outside of the shots are not merged across the shots between them
+    '''
+    shot = bisect.bisect_right(shot_starts, timestamp) - 1
+    if shot >= 0 and timestamp <= shot_ends[shot]:
+        return 2 * shot + 1
+    return 2 * shot + 2
+
+
+def aggregateLabels(labels, shots) -> list:
+    '''
+        Function to merge the samples of each label within a shot to time ranges in one pass over the samples sorted by label, segment and time,
+        returns the ranges with start, end, highest confidence and sample count sorted by their start
+    '''
+    shot_starts = [toMilliseconds(shot["start"]) for shot in shots]
+    shot_ends = [toMilliseconds(shot["end"]) for shot in shots]
+    max_gap = round(label_run_max_gap * 1000)
+    if numpy is not None:
+        label_runs = aggregateLabelArrays(labels, shot_starts, shot_ends, max_gap)
+    else:
+        samples = []
+        for label in labels:
+            timestamp = toMilliseconds(label["timestamp"])
+            samples.append((label["label_name"], getLabelSegment(shot_starts, shot_ends, timestamp), timestamp, label.get("confidence", 0.0)))
+        samples.sort()
+
+        label_runs = []
+        for (label_name, segment), segment_samples in itertools.groupby(samples, key=lambda sample: sample[:2]):
+            run = None
+            for _, _, timestamp, confidence in segment_samples:
+                if run is not None and timestamp - run["end"] <= max_gap:
+                    run["end"] = timestamp
+                    run["confidence"] = max(run["confidence"], confidence)
+                    run["count"] = run["count"] + 1
+                    continue
+                run = {"label_name": label_name, "start": timestamp, "end": timestamp, "confidence": confidence, "count": 1}
+                label_runs.append(run)
+        label_runs.sort(key=lambda run: run["start"])
+    for run in label_runs:
+        run["start"] = "%.2f" % (run["start"] / 1000)
+        run["end"] = "%.2f" % (run["end"] / 1000)
+        run["confidence"] = round(float(run["confidence"]), 2)
+    return label_runs
+
+
+def aggregateLabelArrays(labels, shot_starts, shot_ends, max_gap) -> list:
+    '''
+        Function to merge the label samples to ranges like aggregateLabels() with numpy, the samples are sorted once by label, segment and time
+        and a range starts wherever one of them changes or the time jumps further than max_gap, returns the ranges sorted by their start
+    '''
+    if not labels:
+        return []
+    names = sorted({label["label_name"] for label in labels})
+    name_codes = {name: code for code, name in enumerate(names)}
+    codes = numpy.fromiter((name_codes[label["label_name"]] for label in labels), dtype=numpy.int64, count=len(labels))
+    timestamps = numpy.fromiter((toMilliseconds(label["timestamp"]) for label in labels), dtype=numpy.int64, count=len(labels))
+    confidences = numpy.fromiter((label.get("confidence", 0.0) for label in labels), dtype=numpy.float64, count=len(labels))
+
+    shots = numpy.searchsorted(numpy.array(shot_starts, dtype=numpy.int64), timestamps, side="right") - 1
+    within_shot = (shots >= 0) & (timestamps <= numpy.array(shot_ends + [0], dtype=numpy.int64)[shots])
+    segments = numpy.where(within_shot, 2 * shots + 1, 2 * shots + 2)
+
+    order = numpy.lexsort((timestamps, segments, codes))
+    codes, segments, timestamps, confidences = codes[order], segments[order], timestamps[order], confidences[order]
+    run_starts = numpy.flatnonzero(numpy.concatenate(([True],
+        (codes[1:] != codes[:-1]) | (segments[1:] != segments[:-1]) | (timestamps[1:] - timestamps[:-1] > max_gap))))
+    run_ends = numpy.append(run_starts[1:], len(codes)) - 1
+    run_confidences = numpy.maximum.reduceat(confidences, run_starts)
+
+    label_runs = []
+    for run in numpy.argsort(timestamps[run_starts], kind="stable"):
+        label_runs.append({
+            "label_name": names[codes[run_starts[run]]],
+            "start": int(timestamps[run_starts[run]]),
+            "end": int(timestamps[run_ends[run]]),
+            "confidence": float(run_confidences[run]),
+            "count": int(run_ends[run] - run_starts[run] + 1),
+        })
+    return label_runs
+
+
+def parseCelebrities(celebrity_detection_response) -> list:
+    celebrity_detection_array = []
+    for celebrity in celebrity_detection_response["Celebrities"]:
+        if celebrity["Celebrity"]["Confidence"] > 90:
+            detected_celebrity = {}
+            detected_celebrity["name"] = celebrity["Celebrity"]["Name"]
+            timestamp = float(celebrity["Timestamp"])/1000.0
+            detected_celebrity["timestamp"] = "%.2f" % timestamp
+            urls = celebrity["Celebrity"]["Urls"]
+            detected_celebrity["urls"] = urls
+            celebrity_detection_array.append(detected_celebrity)
+    return celebrity_detection_array
+
+
+def getMetadata(video_metadata, recording_file_name=None) -> dict:
+    metadata = {}
+    metadata["FileName"] = recording_file_name or file_name
+    metadata["Duration"] = video_metadata["DurationMillis"] / 1000
+    metadata["Format"] = video_metadata["Format"]
+    metadata["FrameRate"] = video_metadata["FrameRate"]
+    metadata["FrameHeight"] = str(video_metadata["FrameHeight"])
+    metadata["FrameWidth"] = str(video_metadata["FrameWidth"])
+    metadata["VideoLanguage"] = analyze_source_language
+    metadata["TranslationLanguage"] = translation_target_language
+    return metadata
+
+
+class StageGraph:
+    '''
+        Runs the stages of a pipeline as soon as the stages they depend on are finished,
+        independent stages run concurrently and the start and end of each stage is recorded
+    '''
+    def __init__(self, run_state=None):
+        self.stages = {}
+        self.timings = {}
+        self.run_state = run_state
+
+    def add(self, name, function, dependencies=(), checkpoint=None):
+        '''
+            Adds a stage, function is called with the results of the dependencies as keyword arguments,
+            the result of a stage with checkpoint is saved in the run state, checkpoint is True for json results
+            or the (save, load) functions converting the result to json and back
+        '''
+        if checkpoint is True:
+            checkpoint = (lambda result: result, lambda value: value)
+        self.stages[name] = (function, list(dependencies), checkpoint)
+
+    def runStage(self, name, results) -> object:
+        function, dependencies, checkpoint = self.stages[name]
+        started = time.monotonic()
+        try:
+            if checkpoint is not None and self.run_state is not None:
+                return self.run_state.runStage(name, lambda: function(**{dependency: results[dependency] for dependency in dependencies}), *checkpoint)
+            return function(**{dependency: results[dependency] for dependency in dependencies})
+        finally:
+            self.timings[name] = {
+                "start": started - self.started,
+                "end": time.monotonic() - self.started,
+            }
+            metrics.observe("stage_seconds", self.timings[name]["end"] - self.timings[name]["start"], stage=name)
+
+    def run(self) -> dict:
+        '''
+            Runs all stages, returns the results of all stages
+        '''
+        self.started = time.monotonic()
+        results = {}
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.stages)))
+        try:
+            while len(results) < len(self.stages):
+                for name, (function, dependencies, checkpoint) in self.stages.items():
+                    if name not in results and name not in running.values() and all(dependency in results for dependency in dependencies):
+                        running[executor.submit(self.runStage, name, dict(results))] = name
+                if not running:
+                    raise Exception("Stage dependencies can not be resolved: "+", ".join(name for name in self.stages if name not in results))
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    results[running.pop(future)] = future.result()
+        finally:
+            # Stages still waiting for their dependencies are dropped if a stage failed
+            executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def printTimings(self):
+        for name, timing in sorted(self.timings.items(), key=lambda item: item[1]["start"]):
+            print(f"{name:24} {timing['start']:9.2f} s  -> {timing['end']:9.2f} s  ({timing['end'] - timing['start']:.2f} s)")
+
+
+def reportJobStarts(stage_graph, job_tracker, job_key_prefix=""):
+    '''
+        Observes the seconds from the start of the stages of a recording to the start of each of its AWS jobs and prints the first one
+    '''
+    job_starts = {}
+    for key, job in list(job_tracker.jobs.items()):
+        # Jobs of other recordings sharing the tracker have another prefix, job names contain no spaces
+        if key.startswith(job_key_prefix) and " " not in key[len(job_key_prefix):]:
+            job_starts[key[len(job_key_prefix):]] = job["added"] - stage_graph.started
+    for job_label, seconds in job_starts.items():
+        metrics.observe("job_start_seconds", seconds, job=job_label)
+    if job_starts:
+        job_label = min(job_starts, key=job_starts.get)
+        print(job_key_prefix+"First job started after "+'%.1f' % job_starts[job_label]+" seconds ("+job_label+")")
+
+
+def mergeAnnotation(enrichment, label_detection, segment_detection, text_detection, celebrity_recognition, annotation_path='annotation.json', recording_file_name=None) -> dict:
+    '''
+        Function to merge the results of all analyzing stages to the annotation and save it as json file
+    '''
+    print("Merging text, segments, labels, celebrities and utterances")
+    annotation_dict = {}
+    annotation_dict['utterances'] = enrichment
+    for results in (text_detection, segment_detection, label_detection, celebrity_recognition):
+        for key, value in results.items():
+            if key != "VideoMetadata":
+                annotation_dict[key] = value
+    annotation_dict["Metadata"] = getMetadata(celebrity_recognition["VideoMetadata"], recording_file_name)
+    if aggregate_labels:
+        annotation_dict["detected_labels"] = aggregateLabels(annotation_dict["detected_labels"], annotation_dict["detected_shots"])
+
+    # Save final annotation json file
+    with open(annotation_path, 'w') as fp:
+        json.dump(annotation_dict, fp)
+    if save_binary_annotation:
+        AnnotationModel.fromDict(annotation_dict).save(os.path.join(os.path.dirname(annotation_path), 'annotation.bin'))
+    return annotation_dict
+
+
+def startAnnotationJobs(recording_path=None, output_directory=".", job_tracker=None, recording_name=None, run_state=None) -> dict:
+    '''
+        Function to run all AWS analyzing jobs as a graph of stages,
+        the transcript is analyzed while the video analyzing jobs are still running,
+        several recordings can share a job tracker if they have different names,
+        uploads, job ids and finished stages are saved in the run state, returns the stage timings
+    '''
+    recording_path = recording_path or file_path+file_name
+    job_tracker = job_tracker or JobTracker(getNotificationQueue())
+    if run_state is None and resume_runs:
+        run_state = RunState(output_directory)
+    if run_state is not None:
+        run_state.begin(recording_path)
+    if chunk_duration:
+        duration_ms, keyframes_ms = probeRecording(recording_path)
+        chunks = planChunks(duration_ms, keyframes_ms, round(chunk_duration * 1000), round(chunk_overlap * 1000))
+        if len(chunks) > 1:
+            return startChunkedAnnotationJobs(recording_path, chunks, output_directory, job_tracker, recording_name, run_state)
+    job_key_prefix = recording_name+" " if recording_name else ""
+    job_name = unix_timestamp+"_"+os.path.basename(recording_path)
+    transcript_path = os.path.join(output_directory, 'raw_transcript.json')
+
+    stage_graph = StageGraph(run_state)
+    stage_graph.add("media_hash", lambda: hashFile(recording_path), checkpoint=True)
+    stage_graph.add("upload", lambda media_hash: uploadRecording(media_hash, recording_path), ["media_hash"], checkpoint=True)
+    transcription_upload = "upload"
+    if extract_audio:
+        transcription_upload = "audio_upload"
+        stage_graph.add("audio_upload", lambda media_hash: uploadAudio(media_hash, recording_path, output_directory), ["media_hash"], checkpoint=True)
+    stage_graph.add("transcription", lambda **results: runTranscriptionStage(job_tracker, results["media_hash"], results[transcription_upload], output_directory, job_name, job_key_prefix+"transcription", run_state), ["media_hash", transcription_upload],
+        checkpoint=fileCheckpoint(transcript_path, readTranscriptItems))
+    stage_graph.add("utterances", lambda transcription: iterUtterances(transcription), ["transcription"])
+    addEnrichmentStages(stage_graph, output_directory, job_tracker, job_name, job_key_prefix, run_state)
+    if segment_detection_backend == "local":
+        stage_graph.add("segment_detection", lambda: runLocalSegmentStage(recording_path, output_directory), checkpoint=rawResponseCheckpoint("segment_detection", output_directory))
+    for rekognition_job_name in getRekognitionJobNames():
+        stage_graph.add(rekognition_job_name, lambda media_hash, upload, rekognition_job_name=rekognition_job_name: runRekognitionStage(job_tracker, rekognition_job_name, media_hash, upload, output_directory, job_key_prefix+rekognition_job_name, run_state), ["media_hash", "upload"],
+            checkpoint=rawResponseCheckpoint(rekognition_job_name, output_directory))
+    stage_graph.add("merge", lambda **results: mergeAnnotation(annotation_path=os.path.join(output_directory, 'annotation.json'), recording_file_name=os.path.basename(recording_path), **results), ["enrichment"] + list(rekognition_get_operations))
+    stage_graph.run()
+
+    reportJobStarts(stage_graph, job_tracker, job_key_prefix)
+    print(job_key_prefix+"Stage timings")
+    stage_graph.printTimings()
+
+    return stage_graph.timings
+
+
+def probeRecording(recording_path) -> tuple:
+    '''
+        Function to read the duration and the keyframe times of the video stream of a recording with ffprobe,
+        the packets are listed without decoding the video, returns the duration and the keyframes in milliseconds
+    '''
+    duration = subprocess.run([ffprobe_path, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", recording_path],
+        check=True, capture_output=True, text=True).stdout.strip()
+    packets = subprocess.run([ffprobe_path, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", recording_path],
+        check=True, capture_output=True, text=True).stdout
+    keyframes = []
+    for line in packets.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframes.append(toMilliseconds(pts_time))
+    return toMilliseconds(duration), sorted(keyframes)
+
+
+def planChunks(duration_ms, keyframes_ms, chunk_duration_ms, overlap_ms) -> list:
+    '''
+        Function to plan the chunks of a recording, each chunk starts at the last keyframe before its nominal start
+        and reaches the overlap into the next chunk, a rest shorter than the overlap is added to the last chunk,
+        returns the chunks with their start and end in milliseconds
+    '''
+    starts = [0]
+    nominal_start = chunk_duration_ms
+    while nominal_start < duration_ms - overlap_ms:
+        keyframe = bisect.bisect_right(keyframes_ms, nominal_start) - 1
+        if keyframe >= 0 and keyframes_ms[keyframe] > starts[-1]:
+            starts.append(keyframes_ms[keyframe])
+        elif not keyframes_ms or keyframes_ms[-1] <= nominal_start:
+            print("No keyframe after "+formatClock(starts[-1])+" to start a chunk at, the last of "+str(len(starts))+" chunks is "
+                +'%.0f' % ((duration_ms - starts[-1]) / 1000)+" seconds long instead of "+'%.0f' % (chunk_duration_ms / 1000))
+            break
+        # Without a keyframe after the previous start this nominal start is skipped, the chunk grows up to the next one
+        nominal_start = nominal_start + chunk_duration_ms
+    chunks = []
+    for index, start in enumerate(starts):
+        end = min(duration_ms, starts[index + 1] + overlap_ms) if index + 1 < len(starts) else duration_ms
+        chunks.append({"index": index, "start_ms": start, "end_ms": end})
+    return chunks
+
+
+def getChunkBoundaries(chunks) -> list:
+    '''
+        Function to return the times in milliseconds from which on the results of the next chunk are used,
+        the middle of the overlap of two chunks
+    '''
+    return [(chunks[index + 1]["start_ms"] + chunk["end_ms"]) // 2 for index, chunk in enumerate(chunks[:-1])]
+
+
+def cutChunk(recording_path, chunk, chunk_directory) -> str:
+    '''
+        Function to copy the streams of a chunk of the recording to a file without encoding, returns its path
+    '''
+    chunk_path = os.path.join(chunk_directory, "chunk"+f'{chunk["index"]:03d}'+os.path.splitext(recording_path)[1])
+    subprocess.run([ffmpeg_path, "-v", "error", "-y",
+        "-ss", '%.3f' % (chunk["start_ms"] / 1000), "-i", recording_path,
+        "-t", '%.3f' % ((chunk["end_ms"] - chunk["start_ms"]) / 1000),
+        "-c", "copy", "-avoid_negative_ts", "make_zero",
+        chunk_path], check=True, capture_output=True)
+    return chunk_path
+
+
+def shiftTime(value, offset_ms) -> str:
+    return str((toMilliseconds(value) + offset_ms) / 1000)
+
+
+def mergeTranscriptItems(chunk_items, chunks) -> list:
+    '''
+        Function to merge the transcript items of the chunks to the items of the recording, the times are shifted by the chunk start,
+        words of the overlap are taken from the chunk owning their start time and punctuation follows the word before it,
+        so utterances crossing a chunk boundary are joined again by the segmentation
+    '''
+    boundaries = getChunkBoundaries(chunks)
+    merged_items = []
+    for index, items in enumerate(chunk_items):
+        owned_from = boundaries[index - 1] if index > 0 else None
+        owned_to = boundaries[index] if index < len(boundaries) else None
+        offset = chunks[index]["start_ms"]
+        owned = False
+        for item in items:
+            if "start_time" in item:
+                start = toMilliseconds(item["start_time"]) + offset
+                owned = (owned_from is None or start >= owned_from) and (owned_to is None or start < owned_to)
+            if not owned:
+                continue
+            item = dict(item)
+            for time_key in ("start_time", "end_time"):
+                if time_key in item:
+                    item[time_key] = shiftTime(item[time_key], offset)
+            merged_items.append(item)
+    return merged_items
+
+
+def saveMergedTranscript(items, transcript_path, job_name):
+    transcript = ""
+    for item in items:
+        content = item["alternatives"][0]["content"]
+        transcript = transcript + (" "+content if item["type"] == "pronunciation" else content)
+    with open(transcript_path, 'w', encoding="utf-8") as fp:
+        json.dump({
+            "jobName": job_name,
+            "results": {
+                "transcripts": [{"transcript": transcript.lstrip()}],
+                "items": items,
+            },
+            "status": "COMPLETED",
+        }, fp)
+
+
+def mergeRekognitionPages(job_name, chunk_pages, chunks, tolerance_ms=500) -> dict:
+    '''
+        Function to merge the result pages of a Rekognition job of all chunks to a single page of the recording,
+        the times are shifted by the chunk start and results of the overlap are taken from the chunk owning their start time,
+        a shot or cue cut off by the end of a chunk is continued to the end of the same segment in the next chunk
+    '''
+    results_key, time_keys = rekognition_result_times[job_name]
+    boundaries = getChunkBoundaries(chunks)
+    merged = {"VideoMetadata": None, results_key: []}
+    open_segments = []
+    for index, pages in enumerate(chunk_pages):
+        owned_from = boundaries[index - 1] if index > 0 else None
+        owned_to = boundaries[index] if index < len(boundaries) else None
+        offset = chunks[index]["start_ms"]
+        results = []
+        for page in pages:
+            if merged["VideoMetadata"] is None:
+                merged["VideoMetadata"] = copy.deepcopy(page.get("VideoMetadata"))
+            for result in page[results_key]:
+                result = copy.deepcopy(result)
+                for time_key in time_keys:
+                    result[time_key] = result[time_key] + offset
+                results.append(result)
+
+        continuations = set()
+        still_open = []
+        for segment in open_segments:
+            for position, result in enumerate(results):
+                same_type = result["Type"] == segment["Type"] and result.get("TechnicalCueSegment", {}).get("Type") == segment.get("TechnicalCueSegment", {}).get("Type")
+                if same_type and result["StartTimestampMillis"] <= segment["EndTimestampMillis"] + tolerance_ms and result["EndTimestampMillis"] > segment["EndTimestampMillis"]:
+                    segment["EndTimestampMillis"] = result["EndTimestampMillis"]
+                    continuations.add(position)
+                    if index + 1 < len(chunks) and result["EndTimestampMillis"] >= chunks[index]["end_ms"] - tolerance_ms:
+                        still_open.append(segment)
+                    break
+
+        for position, result in enumerate(results):
+            start = result[time_keys[0]]
+            if position in continuations or (owned_from is not None and start < owned_from) or (owned_to is not None and start >= owned_to):
+                continue
+            merged[results_key].append(result)
+            if "EndTimestampMillis" in result and index + 1 < len(chunks) and result["EndTimestampMillis"] >= chunks[index]["end_ms"] - tolerance_ms:
+                still_open.append(result)
+        open_segments = still_open
+
+    if job_name == "segment_detection":
+        merged[results_key].sort(key=lambda segment: (segment["StartTimestampMillis"], segment["Type"]))
+        shot_index = 0
+        for segment in merged[results_key]:
+            segment["DurationMillis"] = segment["EndTimestampMillis"] - segment["StartTimestampMillis"]
+            # Timecodes and frame numbers of the chunks are not valid for the recording
+            for key in ("StartTimecodeSMPTE", "EndTimecodeSMPTE", "DurationSMPTE", "StartFrameNumber", "EndFrameNumber", "DurationFrames"):
+                segment.pop(key, None)
+            if segment["Type"] == "SHOT":
+                segment["ShotSegment"]["Index"] = shot_index
+                shot_index = shot_index + 1
+    for metadata in merged["VideoMetadata"] if isinstance(merged["VideoMetadata"], list) else [merged["VideoMetadata"]]:
+        if metadata is not None:
+            metadata["DurationMillis"] = chunks[-1]["end_ms"]
+    return merged
+
+
+def startChunkedAnnotationJobs(recording_path, chunks, output_directory=".", job_tracker=None, recording_name=None, run_state=None) -> dict:
+    '''
+        Function to run the AWS analyzing jobs of all chunks of a long recording at the same time as a graph of stages,
+        the results of the chunks are merged to the raw responses of the recording and then annotated like a single recording,
+        returns the stage timings
+    '''
+    job_tracker = job_tracker or JobTracker(getNotificationQueue())
+    job_key_prefix = recording_name+" " if recording_name else ""
+    job_name = unix_timestamp+"_"+os.path.basename(recording_path)
+    chunk_directory = os.path.join(output_directory, "chunks")
+    os.makedirs(chunk_directory, exist_ok=True)
+    with open(os.path.join(chunk_directory, "chunks.json"), 'w') as fp:
+        json.dump(chunks, fp, indent=2)
+
+    stage_graph = StageGraph(run_state)
+    for chunk in chunks:
+        part = "_chunk"+f'{chunk["index"]:03d}'
+        part_directory = os.path.join(chunk_directory, part.lstrip("_"))
+        os.makedirs(part_directory, exist_ok=True)
+        stage_graph.add("cut"+part, lambda chunk=chunk: cutChunk(recording_path, chunk, chunk_directory), checkpoint=(existingPath, existingPath))
+        stage_graph.add("media_hash"+part, lambda part=part, **results: hashFile(results["cut"+part]), ["cut"+part], checkpoint=True)
+        stage_graph.add("upload"+part, lambda part=part, **results: uploadRecording(results["media_hash"+part], results["cut"+part]), ["media_hash"+part, "cut"+part], checkpoint=True)
+        transcription_upload = "upload"+part
+        if extract_audio:
+            transcription_upload = "audio_upload"+part
+            stage_graph.add(transcription_upload, lambda part=part, part_directory=part_directory, **results: uploadAudio(results["media_hash"+part], results["cut"+part], part_directory), ["media_hash"+part, "cut"+part], checkpoint=True)
+        stage_graph.add("transcription"+part, lambda part=part, part_directory=part_directory, transcription_upload=transcription_upload, **results: list(runTranscriptionStage(job_tracker, results["media_hash"+part], results[transcription_upload], part_directory, job_name+part, job_key_prefix+"transcription"+part, run_state)), ["media_hash"+part, transcription_upload],
+            checkpoint=fileCheckpoint(os.path.join(part_directory, 'raw_transcript.json'), lambda path: list(readTranscriptItems(path))))
+        for rekognition_job_name in getRekognitionJobNames():
+            stage_graph.add(rekognition_job_name+part, lambda part=part, rekognition_job_name=rekognition_job_name, **results: list(getRekognitionPages(job_tracker, rekognition_job_name, results["media_hash"+part], results["upload"+part], job_key_prefix+rekognition_job_name+part, run_state)), ["media_hash"+part, "upload"+part],
+                checkpoint=(lambda pages, path=os.path.join(part_directory, raw_response_names[rekognition_job_name]+"_pages.json"): saveStageOutput(pages, path), loadStageOutput))
+
+    def mergeTranscription(**results):
+        items = mergeTranscriptItems([results["transcription_chunk"+f'{chunk["index"]:03d}'] for chunk in chunks], chunks)
+        saveMergedTranscript(items, os.path.join(output_directory, 'raw_transcript.json'), job_name)
+        return items
+
+    def mergeRekognition(rekognition_job_name, **results):
+        page = mergeRekognitionPages(rekognition_job_name, [results[rekognition_job_name+"_chunk"+f'{chunk["index"]:03d}'] for chunk in chunks], chunks)
+        if spool_raw_responses:
+            with open(os.path.join(output_directory, raw_response_names[rekognition_job_name]+".jsonl"), 'w') as spool:
+                spool.write(json.dumps(page)+"\n")
+        return collectRekognitionResults(rekognition_job_name, [page])
+
+    stage_graph.add("transcription", mergeTranscription, ["transcription_chunk"+f'{chunk["index"]:03d}' for chunk in chunks],
+        checkpoint=fileCheckpoint(os.path.join(output_directory, 'raw_transcript.json'), lambda path: list(readTranscriptItems(path))))
+    stage_graph.add("utterances", lambda transcription: iterUtterances(transcription), ["transcription"])
+    addEnrichmentStages(stage_graph, output_directory, job_tracker, job_name, job_key_prefix, run_state)
+    if segment_detection_backend == "local":
+        stage_graph.add("segment_detection", lambda: runLocalSegmentStage(recording_path, output_directory), checkpoint=rawResponseCheckpoint("segment_detection", output_directory))
+    for rekognition_job_name in getRekognitionJobNames():
+        stage_graph.add(rekognition_job_name, lambda rekognition_job_name=rekognition_job_name, **results: mergeRekognition(rekognition_job_name, **results), [rekognition_job_name+"_chunk"+f'{chunk["index"]:03d}' for chunk in chunks],
+            checkpoint=rawResponseCheckpoint(rekognition_job_name, output_directory))
+    stage_graph.add("merge", lambda **results: mergeAnnotation(annotation_path=os.path.join(output_directory, 'annotation.json'), recording_file_name=os.path.basename(recording_path), **results), ["enrichment"] + list(rekognition_get_operations))
+    stage_graph.run()
+
+    reportJobStarts(stage_graph, job_tracker, job_key_prefix)
+    print(job_key_prefix+"Stage timings")
+    stage_graph.printTimings()
+
+    return stage_graph.timings
+
+
+def detectRangeSegments(recording_path, segment_range) -> tuple:
+    '''
+        Function to decode a range of the recording with ffmpeg, scaled down as only the frame differences are needed,
+        returns the scene changes as (time, score) and the black frames as (start, end) with times in milliseconds of the recording
+    '''
+    filters = ",".join([
+        "scale=320:-2",
+        "blackdetect=d="+str(black_frames_min_duration)+":pix_th=0.10",
+        "select='gt(scene,"+str(scene_change_threshold)+")'",
+        "metadata=print:key=lavfi.scene_score",
+    ])
+    output = subprocess.run([ffmpeg_path, "-hide_banner", "-nostats",
+        "-ss", '%.3f' % (segment_range["start_ms"] / 1000), "-t", '%.3f' % ((segment_range["end_ms"] - segment_range["start_ms"]) / 1000),
+        "-i", recording_path, "-an", "-vf", filters, "-f", "null", "-"],
+        check=True, capture_output=True, text=True).stderr
+    offset = segment_range["start_ms"]
+    scene_changes = []
+    black_frames = []
+    frame_time = None
+    for line in output.splitlines():
+        match = re.search(r"pts_time:\s*([0-9.]+)", line)
+        if match:
+            frame_time = toMilliseconds(match.group(1)) + offset
+        match = re.search(r"lavfi\.scene_score=([0-9.]+)", line)
+        if match and frame_time is not None:
+            scene_changes.append((frame_time, float(match.group(1))))
+        match = re.search(r"black_start:\s*([0-9.]+)\s+black_end:\s*([0-9.]+)", line)
+        if match:
+            black_frames.append((toMilliseconds(match.group(1)) + offset, toMilliseconds(match.group(2)) + offset))
+    return scene_changes, black_frames
+
+
+def buildSegmentResponse(duration_ms, scene_changes, black_frames, tolerance_ms=100) -> dict:
+    '''
+        Function to build a segment detection response like Rekognition returns it from the scene changes and black frames,
+        a shot starts at each scene change and the technical cues are the black frames and the content between them
+    '''
+    segments = []
+    shot_starts = [(0, 100.0)]
+    for time_ms, score in sorted(scene_changes):
+        if shot_starts[-1][0] + tolerance_ms < time_ms < duration_ms:
+            shot_starts.append((time_ms, score * 100))
+    for index, (start, confidence) in enumerate(shot_starts):
+        end = shot_starts[index + 1][0] if index + 1 < len(shot_starts) else duration_ms
+        segments.append({
+            "Type": "SHOT",
+            "StartTimestampMillis": start,
+            "EndTimestampMillis": end,
+            "DurationMillis": end - start,
+            "ShotSegment": {"Index": index, "Confidence": round(confidence, 3)},
+        })
+
+    # Black frames cut by the end of a range are joined with their continuation in the next range
+    merged_black_frames = []
+    for start, end in sorted(black_frames):
+        if merged_black_frames and start <= merged_black_frames[-1][1] + tolerance_ms:
+            merged_black_frames[-1] = (merged_black_frames[-1][0], max(end, merged_black_frames[-1][1]))
+        else:
+            merged_black_frames.append((start, end))
+    cues = []
+    position = 0
+    for start, end in merged_black_frames:
+        if start > position:
+            cues.append(("Content", position, start))
+        cues.append(("BlackFrames", start, end))
+        position = end
+    if position < duration_ms:
+        cues.append(("Content", position, duration_ms))
+    for cue_type, start, end in cues:
+        segments.append({
+            "Type": "TECHNICAL_CUE",
+            "StartTimestampMillis": start,
+            "EndTimestampMillis": end,
+            "DurationMillis": end - start,
+            "TechnicalCueSegment": {"Type": cue_type, "Confidence": 100.0},
+        })
+    segments.sort(key=lambda segment: (segment["StartTimestampMillis"], segment["Type"]))
+    return {
+        "JobStatus": "SUCCEEDED",
+        "VideoMetadata": [{"DurationMillis": duration_ms}],
+        "Segments": segments,
+        "SelectedSegmentTypes": [{"Type": "SHOT", "ModelVersion": "ffmpeg"}, {"Type": "TECHNICAL_CUE", "ModelVersion": "ffmpeg"}],
+    }
+
+
+def detectSegments(recording_path, max_workers=None) -> dict:
+    '''
+        Function to detect the shots and technical cues of a recording locally, ranges of the recording starting at keyframes
+        are decoded by several ffmpeg processes at the same time, returns a segment detection response like Rekognition
+    '''
+    duration_ms, keyframes_ms = probeRecording(recording_path)
+    segment_ranges = planChunks(duration_ms, keyframes_ms, round(local_segment_range_duration * 1000), 0)
+    scene_changes = []
+    black_frames = []
+    with metrics.timer("local_segment_detection_seconds"):
+        with ThreadPoolExecutor(max_workers=max_workers or local_segment_workers) as executor:
+            for range_scene_changes, range_black_frames in executor.map(lambda segment_range: detectRangeSegments(recording_path, segment_range), segment_ranges):
+                scene_changes.extend(range_scene_changes)
+                black_frames.extend(range_black_frames)
+    return buildSegmentResponse(duration_ms, scene_changes, black_frames)
+
+
+def runLocalSegmentStage(recording_path, output_directory=".") -> dict:
+    '''
+        Function to detect the shots and technical cues locally and save the response like the raw Rekognition response
+    '''
+    print("Start local segment detection")
+    response = detectSegments(recording_path)
+    pages = [response]
+    if spool_raw_responses:
+        pages = spoolPages(pages, os.path.join(output_directory, raw_response_names["segment_detection"]+".jsonl"))
+    results = collectRekognitionResults("segment_detection", pages)
+    print("Local segment detection found "+str(len(results["detected_shots"]))+" shots and "+str(len(results["detected_cues"]))+" technical cues")
+    return results
+
+
+def compareSegments(detected, reference, tolerance_ms=500) -> dict:
+    '''
+        Function to compare the shot boundaries of two segment detection responses,
+        a boundary is found if the reference has one within the tolerance, returns precision, recall and the mean offset
+    '''
+    detected_starts = sorted(segment["StartTimestampMillis"] for segment in detected["Segments"] if segment["Type"] == "SHOT")[1:]
+    reference_starts = sorted(segment["StartTimestampMillis"] for segment in reference["Segments"] if segment["Type"] == "SHOT")[1:]
+    offsets = []
+    unmatched = list(reference_starts)
+    for start in detected_starts:
+        position = bisect.bisect_left(unmatched, start)
+        candidates = [index for index in (position - 1, position) if 0 <= index < len(unmatched) and abs(unmatched[index] - start) <= tolerance_ms]
+        if candidates:
+            index = min(candidates, key=lambda index: abs(unmatched[index] - start))
+            offsets.append(abs(unmatched.pop(index) - start))
+    precision = len(offsets) / len(detected_starts) if detected_starts else 1.0
+    recall = len(offsets) / len(reference_starts) if reference_starts else 1.0
+    return {
+        "detected_shots": len(detected_starts) + 1,
+        "reference_shots": len(reference_starts) + 1,
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "mean_offset_ms": statistics.mean(offsets) if offsets else None,
+    }
+
+
+def detectAndCompareSegments(recording_path, output_directory=".", reference_directory=None) -> bool:
+    '''
+        Function to detect the segments of a recording locally, save the response and compare it with the Rekognition response
+        saved in the reference directory
+    '''
+    os.makedirs(output_directory, exist_ok=True)
+    started = time.perf_counter()
+    runLocalSegmentStage(recording_path, output_directory)
+    print("Local segment detection took "+'%.1f' % (time.perf_counter() - started)+" seconds")
+    if reference_directory:
+        detected = next(readRawPages(output_directory, "segment_detection"))
+        reference = next(readRawPages(reference_directory, "segment_detection"))
+        comparison = compareSegments(detected, reference)
+        print("Shots "+str(comparison["detected_shots"])+" local, "+str(comparison["reference_shots"])+" Rekognition, boundary precision "
+            +'%.3f' % comparison["precision"]+", recall "+'%.3f' % comparison["recall"]+", F1 "+'%.3f' % comparison["f1"]
+            +(", mean offset "+'%.0f' % comparison["mean_offset_ms"]+" ms" if comparison["mean_offset_ms"] is not None else ""))
+    return True
+
+
+def readRawPages(raw_directory, job_name):
+    '''
+        Generator over the saved result pages of a Rekognition job,
+        reads the json lines spool file or else the raw response file holding a single page
+    '''
+    path = os.path.join(raw_directory, raw_response_names[job_name])
+    if os.path.exists(path+".jsonl"):
+        with open(path+".jsonl") as spool:
+            for line in spool:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path+".json") as f_in:
+            yield json.load(f_in)
+
+
+def reuseEnrichment(utterances, previous_utterances, enrichment_keys=("translation", "entities", "sentiment", "syntax")) -> list:
+    '''
+        Function to copy translation, entities, sentiment and syntax from the utterances of a previous annotation
+        with the same start and text, returns the utterances not found in the previous annotation
+    '''
+    previous = {(toMilliseconds(utterance["start"]), utterance["text"]): utterance for utterance in previous_utterances}
+    missing = []
+    for utterance in utterances:
+        previous_utterance = previous.get((toMilliseconds(utterance["start"]), utterance["text"]))
+        if previous_utterance is None or not all(key in previous_utterance for key in enrichment_keys):
+            missing.append(utterance)
+            continue
+        for key in enrichment_keys:
+            utterance[key] = previous_utterance[key]
+    return missing
+
+
+def rebuildAnnotation(raw_directory, output_directory=None, recording_file_name=None) -> dict:
+    '''
+        Function to build the annotation from the raw responses saved in a directory without running any job,
+        the utterance analyses are taken from the annotation.json in the directory or from the result cache
+    '''
+    output_directory = output_directory or raw_directory
+    previous_annotation = {}
+    previous_annotation_path = os.path.join(raw_directory, 'annotation.json')
+    if os.path.exists(previous_annotation_path):
+        with open(previous_annotation_path) as f_in:
+            previous_annotation = json.load(f_in)
+    recording_file_name = recording_file_name or previous_annotation.get("Metadata", {}).get("FileName")
+
+    utterances = list(iterUtterances(readTranscriptItems(os.path.join(raw_directory, 'raw_transcript.json'))))
+    if analyzer_backend == "comprehend":
+        missing = reuseEnrichment(utterances, previous_annotation.get("utterances", []))
+        if missing:
+            print(str(len(missing))+" utterances not found in the previous annotation of "+raw_directory)
+            enrichUtterances(missing)
+    else:
+        # Local analyzers analyze all utterances again, only the translations are reused
+        missing = reuseEnrichment(utterances, previous_annotation.get("utterances", []), ("translation",))
+        if missing:
+            print(str(len(missing))+" utterances not translated in the previous annotation of "+raw_directory)
+        enrichUtterances(utterances)
+
+    results = {}
+    for job_name in rekognition_get_operations:
+        results[job_name] = collectRekognitionResults(job_name, readRawPages(raw_directory, job_name))
+    return mergeAnnotation(utterances,
+        annotation_path=os.path.join(output_directory, 'annotation.json'),
+        recording_file_name=recording_file_name,
+        **results,
+    )
+
+
+def writeTeiFile(tei_document, tei_path):
+    with metrics.timer("tei_serialization_seconds"):
+        etree.ElementTree(tei_document).write(tei_path,
+                                            encoding="utf-8",
+                                            xml_declaration=True,
+                                            pretty_print=True
+                                        )
+
+
+def saveTeiFile(annotation_path, tei_path, registry=None):
+    '''
+        Function to convert an annotation file to a TEI file with the writer chosen by incremental_tei_writer
+    '''
+    with metrics.timer("tei_file_seconds", writer="incremental" if incremental_tei_writer else "tree"):
+        if incremental_tei_writer:
+            writeTeiFileIncrementally(annotation_path, tei_path, registry)
+        else:
+            writeTeiFile(createTeiFile(annotation_path, registry), tei_path)
+
+
+def rebuildDirectory(raw_directory, output_directory=None, recording_file_name=None) -> str:
+    '''
+        Function to rebuild annotation.json and the TEI file of a directory of raw responses,
+        the TEI file is named after the directory and the metrics of the rebuild are saved next to it, returns its path
+    '''
+    output_directory = output_directory or raw_directory
+    os.makedirs(output_directory, exist_ok=True)
+    metrics.reset()
+    with metrics.timer("rebuild_annotation_seconds"):
+        rebuildAnnotation(raw_directory, output_directory, recording_file_name)
+    tei_path = os.path.join(output_directory, os.path.basename(os.path.normpath(raw_directory))+".xml")
+    saveTeiFile(getAnnotationPath(output_directory), tei_path)
+    metrics.save(output_directory)
+    return tei_path
+
+
+def setOfflineMode(offline):
+    global offline_mode
+    offline_mode = offline
+
+
+def rebuildDirectories(raw_directories, output_root=None, recording_file_name=None, workers=None, offline=True):
+    '''
+        Function to rebuild several directories of raw responses in parallel processes,
+        with an output root the files of each directory are written to a sub directory named like it
+    '''
+    with ProcessPoolExecutor(max_workers=workers, initializer=setOfflineMode, initargs=(offline,)) as executor:
+        futures = {}
+        for raw_directory in raw_directories:
+            output_directory = None
+            if output_root:
+                output_directory = os.path.join(output_root, os.path.basename(os.path.normpath(raw_directory)))
+            futures[executor.submit(rebuildDirectory, raw_directory, output_directory, recording_file_name)] = raw_directory
+        failed = 0
+        for future in futures:
+            try:
+                print("Rebuilt "+future.result())
+            except Exception as error:
+                failed = failed + 1
+                print("Rebuilding "+futures[future]+" failed: "+str(error))
+    return failed == 0
+
+
+def loadManifest(manifest) -> list:
+    '''
+        Function to read the recordings of a batch from a CSV file with a path and an optional name column
+        or from a glob pattern, returns the path and the unique name of each recording
+    '''
+    recordings = []
+    if manifest.lower().endswith(".csv"):
+        with open(manifest, newline='') as f_in:
+            for row in csv.DictReader(f_in):
+                # Relative paths start at the directory of the manifest
+                recordings.append({
+                    "path": os.path.join(os.path.dirname(manifest), row["path"]),
+                    "name": row.get("name") or "",
+                })
+    else:
+        for path in sorted(glob.glob(manifest, recursive=True)):
+            recordings.append({"path": path, "name": ""})
+    names = set()
+    for recording in recordings:
+        recording["name"] = recording["name"] or os.path.splitext(os.path.basename(recording["path"]))[0]
+        if recording["name"] in names:
+            raise Exception("Recording name "+recording["name"]+" used twice in "+manifest+", add a name column to the manifest")
+        names.add(recording["name"])
+    return recordings
+
+
+def readRunState(output_directory) -> dict:
+    state_path = os.path.join(output_directory, run_state_file_name)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f_in:
+        return json.load(f_in)
+
+
+def writeRunState(output_directory, state):
+    '''
+        Function to save the state of a run, the file is replaced at once so an interrupted run never leaves a partial state
+    '''
+    state_path = os.path.join(output_directory, run_state_file_name)
+    with open(state_path+".tmp", 'w') as fp:
+        json.dump(state, fp, indent=2)
+    os.replace(state_path+".tmp", state_path)
+
+
+class RunState:
+    '''
+        State of the run of a recording saved in the output directory after every change,
+        holds the finished stages with their results or output files and the ids of the submitted jobs,
+        a restarted run of the same recording with the same settings attaches to the jobs and skips the finished stages
+    '''
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.lock = threading.Lock()
+        self.state = readRunState(output_directory)
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            writeRunState(self.output_directory, self.state)
+
+    def begin(self, recording_path):
+        '''
+            Starts a run of the recording, stages and jobs of a previous run are dropped if the recording or the settings changed
+        '''
+        identity = json.loads(json.dumps({
+            "recording": os.path.abspath(recording_path),
+            "size": os.path.getsize(recording_path),
+            "modified": os.path.getmtime(recording_path),
+            "settings": {
+                "language_code": language_code,
+                "custom_vocabulary": custom_vocabulary,
+                "analyze_source_language": analyze_source_language,
+                "translation_target_language": translation_target_language,
+                "analyzer_backend": analyzer_backend,
+                "segment_detection_backend": segment_detection_backend,
+                "extract_audio": extract_audio,
+                "audio_format": audio_format,
+                "chunk_duration": chunk_duration,
+                "chunk_overlap": chunk_overlap,
+                "rekognition_job_parameters": rekognition_job_parameters,
+            },
+        }))
+        with self.lock:
+            if self.state.get("identity") != identity:
+                if self.state.get("stages") or self.state.get("jobs"):
+                    print("Recording or settings changed since the previous run, running all stages again")
+                self.state["identity"] = identity
+                self.state["stages"] = {}
+                self.state["jobs"] = {}
+            elif self.state.get("stages") or self.state.get("jobs"):
+                print("Resuming the previous run with "+str(len(self.state["stages"]))+" finished stages and "+str(len(self.state["jobs"]))+" submitted jobs")
+            writeRunState(self.output_directory, self.state)
+
+    def getJob(self, job_key):
+        with self.lock:
+            return self.state.get("jobs", {}).get(job_key)
+
+    def setJob(self, job_key, job_id):
+        with self.lock:
+            self.state.setdefault("jobs", {})[job_key] = job_id
+            writeRunState(self.output_directory, self.state)
+
+    def saveStage(self, name, value):
+        # Stages without a value to save run again in a restarted run
+        if value is None:
+            return
+        with self.lock:
+            self.state.setdefault("stages", {})[name] = value
+            writeRunState(self.output_directory, self.state)
+
+    def saveStageAfterItems(self, name, items, value):
+        '''
+            Generator passing the items of a stage through, the stage counts as finished once the last item passed
+        '''
+        yield from items
+        self.saveStage(name, value)
+
+    def runStage(self, name, run, save, load):
+        '''
+            Returns the result of a stage finished by a previous run converted back by load, or else runs the stage
+            and saves the value returned by save for the result, results read lazily are saved once they are read completely
+        '''
+        with self.lock:
+            stages = self.state.get("stages", {})
+            finished = name in stages
+            value = stages.get(name)
+        if finished:
+            try:
+                result = load(value)
+            except (OSError, ValueError) as error:
+                print(name+" output of the previous run can not be read, running the stage again: "+str(error))
+            else:
+                print(name+" finished in the previous run")
+                metrics.count("stages_resumed_total")
+                return result
+        result = run()
+        if hasattr(result, "__next__"):
+            return self.saveStageAfterItems(name, result, save(result))
+        self.saveStage(name, save(result))
+        return result
+
+
+def existingPath(path) -> str:
+    if not os.path.exists(path):
+        raise FileNotFoundError("No such file: "+path)
+    return path
+
+
+def saveStageOutput(value, path) -> str:
+    '''
+        Function to save the result of a stage as json file for a restarted run, returns the path
+    '''
+    with open(path+".tmp", 'w') as fp:
+        json.dump(value, fp)
+    os.replace(path+".tmp", path)
+    return path
+
+
+def loadStageOutput(path):
+    with open(existingPath(path)) as f_in:
+        return json.load(f_in)
+
+
+def fileCheckpoint(path, load=existingPath) -> tuple:
+    '''
+        Function to return the save and load functions of a stage writing its output to a file, the result is read again from it
+    '''
+    return (lambda result: path, lambda path: load(existingPath(path)))
+
+
+def rawResponseCheckpoint(job_name, output_directory) -> tuple:
+    '''
+        Function to return the save and load functions of a stage saving the raw response of a job,
+        the results are collected again from the spool file, without spooling the stage is not saved
+    '''
+    path = os.path.join(output_directory, raw_response_names[job_name]+".jsonl")
+    return (lambda results: path if spool_raw_responses else None,
+        lambda path: collectRekognitionResults(job_name, readRawPages(os.path.dirname(existingPath(path)), job_name)))
 
-    print("Running translation, entity, sentiment and syntax recognition")
-    for utterance in utterances:
-        
-        # Translation
-        response = translate_client.translate_text(
-            Text=utterance["text"],
-            SourceLanguageCode=analyze_source_language,
-            TargetLanguageCode=translation_target_language,
-        )
-        utterance["translation"] = response["TranslatedText"]
-        
-        # Entities
-        response = comprehend_client.detect_entities(
-            Text=utterance["text"],
-            LanguageCode=analyze_source_language,
-        )
-        entities = []
-        for entity in response["Entities"]:
-            if entity["Score"] > 0.7:
-                entities.append(entity)
-        utterance["entities"] = entities
 
-        # Sentiment
-        response = comprehend_client.detect_sentiment(
-            Text=utterance["text"],
-            LanguageCode=analyze_source_language,
-        )
-        utterance["sentiment"] = response["Sentiment"]
-        
-        response = comprehend_client.detect_syntax(
-            Text=utterance["text"],
-            LanguageCode='de',
+def attachJob(job_key, poll) -> tuple:
+    '''
+        Function to request the status of a job submitted by a previous run, returns its (status, response)
+        or (None, None) if the job is not found or failed and has to be started again
+    '''
+    try:
+        status, response = poll()
+    except Exception as error:
+        print(job_key+" job of the previous run not found, starting it again: "+str(error))
+        return None, None
+    if status == "FAILED":
+        print(job_key+" job of the previous run failed, starting it again")
+        return None, None
+    print("Attached to the "+job_key+" job of the previous run")
+    metrics.count("jobs_attached_total")
+    return status, response
+
+
+def annotateRecording(recording, output_directory, job_tracker) -> dict:
+    '''
+        Function to run the AWS analyzing jobs of a batch recording, returns its updated state
+    '''
+    run_state = RunState(output_directory)
+    run_state.update(recording=recording["path"])
+    try:
+        timings = startAnnotationJobs(recording["path"], output_directory, job_tracker, recording["name"], run_state)
+    except Exception as error:
+        print(recording["name"]+" failed: "+str(error))
+        run_state.update(status="failed", error=str(error))
+    else:
+        run_state.update(
+            status="annotated",
+            error=None,
+            stage_seconds={name: round(timing["end"] - timing["start"], 3) for name, timing in timings.items()},
         )
-        utterance["syntax"] = response["SyntaxTokens"]
+    return run_state.state
 
-    annotation_dict['utterances'] = utterances
-    
 
+def buildTeiFile(annotation_path, tei_path, registry_path=None) -> float:
+    '''
+        Function to convert an annotation file to a TEI file in a worker process with the ids of the saved entity registry,
+        the metrics of the worker are saved next to the TEI file, returns the seconds taken
+    '''
+    metrics.reset()
+    started = time.monotonic()
+    saveTeiFile(annotation_path, tei_path, EntityRegistry.load(registry_path) if registry_path else None)
+    metrics.save(os.path.dirname(tei_path) or ".")
+    return time.monotonic() - started
+
+
+def printBatchSummary(summary):
+    print("Batch summary")
+    print(f"  recordings {summary['recordings']}   finished {summary['finished']}   skipped {summary['skipped']}   failed {summary['failed']}")
+    print(f"  wall time {summary['seconds']:.1f} s   throughput {summary['recordings_per_hour']:.1f} recordings/hour")
+    print(f"  {'stage':24} {'count':>6} {'mean s':>9} {'median s':>9} {'max s':>9}")
+    for name, latency in summary["stage_seconds"].items():
+        print(f"  {name:24} {latency['count']:6} {latency['mean']:9.2f} {latency['median']:9.2f} {latency['max']:9.2f}")
+
+
+def runBatch(manifest, output_root=".", max_recordings=None, tei_workers=None) -> dict:
+    '''
+        Function to process all recordings of a manifest, the AWS jobs of several recordings run in threads sharing
+        one job tracker and the job slots, finished annotations are converted to TEI in a process pool,
+        recordings finished by an earlier run are skipped and failed ones are tried again,
+        the ids of the persons, places and organizations come from one entity registry for all recordings, returns the summary
+    '''
+    recordings = loadManifest(manifest)
+    metrics.reset()
+    job_tracker = JobTracker(getNotificationQueue())
+    registry_path = os.path.join(output_root, entity_registry_file_name)
+    registry = EntityRegistry.load(registry_path) if os.path.exists(registry_path) else EntityRegistry()
+    states = {}
+    pending = {}
+    skipped = 0
+    started = time.monotonic()
+    annotation_executor = ThreadPoolExecutor(max_workers=max_recordings or batch_max_recordings)
+    # Worker processes are spawned as forking the threads of running jobs is not safe
+    tei_executor = ProcessPoolExecutor(max_workers=tei_workers or batch_tei_workers or None, mp_context=multiprocessing.get_context("spawn"))
+
+    def submitTeiFile(recording, output_directory):
+        # The names are registered here so all recordings share one registry, the workers only look them up
+        annotation_path = getAnnotationPath(output_directory)
+        try:
+            registry.registerAnnotation(loadAnnotationModel(annotation_path))
+            registry.save(registry_path)
+        except Exception as error:
+            print(recording["name"]+" TEI file failed: "+str(error))
+            state = states[recording["name"]]
+            state["status"] = "failed"
+            state["error"] = str(error)
+            writeRunState(output_directory, state)
+            return
+        tei_path = os.path.join(output_directory, recording["name"]+".xml")
+        future = tei_executor.submit(buildTeiFile, annotation_path, tei_path, registry_path)
+        pending[future] = ("tei", recording, output_directory)
+
+    try:
+        for recording in recordings:
+            output_directory = os.path.join(output_root, recording["name"])
+            os.makedirs(output_directory, exist_ok=True)
+            state = readRunState(output_directory)
+            if state.get("status") == "done" and os.path.exists(state.get("tei", "")):
+                skipped = skipped + 1
+                continue
+            states[recording["name"]] = state
+            if state.get("status") == "annotated" and os.path.exists(os.path.join(output_directory, 'annotation.json')):
+                submitTeiFile(recording, output_directory)
+            else:
+                future = annotation_executor.submit(annotateRecording, recording, output_directory, job_tracker)
+                pending[future] = ("annotation", recording, output_directory)
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                phase, recording, output_directory = pending.pop(future)
+                if phase == "annotation":
+                    states[recording["name"]] = state = future.result()
+                    if state["status"] == "annotated":
+                        submitTeiFile(recording, output_directory)
+                    continue
+                state = states[recording["name"]]
+                try:
+                    tei_seconds = future.result()
+                except Exception as error:
+                    print(recording["name"]+" TEI file failed: "+str(error))
+                    state["status"] = "failed"
+                    state["error"] = str(error)
+                else:
+                    print(recording["name"]+" finished")
+                    state["status"] = "done"
+                    state["tei"] = os.path.join(output_directory, recording["name"]+".xml")
+                    state.setdefault("stage_seconds", {})["tei"] = round(tei_seconds, 3)
+                writeRunState(output_directory, state)
+    finally:
+        annotation_executor.shutdown(wait=False, cancel_futures=True)
+        tei_executor.shutdown(wait=False, cancel_futures=True)
+
+    seconds = time.monotonic() - started
+    finished = sum(1 for state in states.values() if state.get("status") == "done")
+    stage_seconds = {}
+    for state in states.values():
+        for name, stage_duration in state.get("stage_seconds", {}).items():
+            stage_seconds.setdefault(name, []).append(stage_duration)
+    summary = {
+        "recordings": len(recordings),
+        "finished": finished,
+        "skipped": skipped,
+        "failed": len(states) - finished,
+        "seconds": seconds,
+        "recordings_per_hour": finished * 3600.0 / max(seconds, 0.001),
+        "stage_seconds": {
+            name: {
+                "count": len(durations),
+                "mean": statistics.mean(durations),
+                "median": statistics.median(durations),
+                "max": max(durations),
+            } for name, durations in stage_seconds.items()
+        },
+    }
+    with open(os.path.join(output_root, 'batch_summary.json'), 'w') as fp:
+        json.dump(summary, fp, indent=2)
+    metrics.save(output_root)
+    printBatchSummary(summary)
+    return summary
 
-    # Wait for all video analyzing jobs to be finished
-    print("Waiting for all video analyzing jobs to be complete")
-    label_finished = False
-    segment_finished = False
-    text_finished = False
-    celebrity_finished = False
-    
-    while (label_finished is False) or (segment_finished is False) or (text_finished is False) or (celebrity_finished is False):
 
-        label_detection_response = rekognition_client.get_label_detection(
-            JobId=label_detection_response_jobId,
+def toMilliseconds(value) -> int:
+    return round(float(value) * 1000)
+
+
+def formatClock(milliseconds) -> str:
+    '''
+        Function to format milliseconds as HH:MM:SS like time.strftime('%H:%M:%S', time.gmtime(seconds))
+    '''
+    seconds = milliseconds // 1000
+    return f'{seconds // 3600 % 24:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class AnnotationModel:
+    '''
+        Columnar annotation, every table of annotation_columns is a dict of equally long arrays with one row per item,
+        times are integer milliseconds and each string column stores positions in its own table of unique strings,
+        the entities and syntax tokens of an utterance end at the rows in its entities_end and syntax_end columns
+    '''
+    __slots__ = ("metadata", "tables", "strings")
+
+    def __init__(self, metadata=None):
+        self.metadata = metadata or {}
+        self.tables = {table: {column: array.array(typecode) for column, typecode in columns.items()} for table, columns in annotation_columns.items()}
+        self.strings = {}
+
+    def setColumns(self, table, **columns):
+        '''
+            Sets all columns of a table from the lists of their values, the strings of a string column are numbered in one pass
+        '''
+        for column, typecode in annotation_columns[table].items():
+            values = columns[column]
+            if typecode == "i":
+                positions = {}
+                values = [positions.setdefault(value, len(positions)) for value in values]
+                self.strings[table+"."+column] = list(positions)
+            self.tables[table][column] = array.array(typecode, values)
+
+    def rows(self, table) -> int:
+        return len(next(iter(self.tables[table].values())))
+
+    def column(self, table, column):
+        '''
+            Returns the values of a column, the strings for a string column
+        '''
+        values = self.tables[table][column]
+        if annotation_columns[table][column] != "i":
+            return values
+        strings = self.strings.get(table+"."+column, [])
+        return [strings[position] for position in values]
+
+    def childRows(self, row, child_table) -> range:
+        '''
+            Returns the rows of the entities or syntax tokens of an utterance row
+        '''
+        ends = self.tables["utterances"][child_table+"_end"]
+        return range(ends[row - 1] if row else 0, ends[row])
+
+    @classmethod
+    def fromDict(cls, annotation):
+        '''
+            Builds the model of an annotation dict column by column
+        '''
+        model = cls(annotation.get("Metadata"))
+        cues = annotation["detected_cues"]
+        model.setColumns("detected_cues",
+            start_ms=[toMilliseconds(cue["start"]) for cue in cues],
+            end_ms=[toMilliseconds(cue["end"]) for cue in cues],
+            dur_ms=[toMilliseconds(cue["dur"]) for cue in cues],
+            type=[cue["type"] for cue in cues],
+        )
+        shots = annotation["detected_shots"]
+        model.setColumns("detected_shots",
+            start_ms=[toMilliseconds(shot["start"]) for shot in shots],
+            end_ms=[toMilliseconds(shot["end"]) for shot in shots],
+            dur_ms=[toMilliseconds(shot["dur"]) for shot in shots],
+            index=[shot["index"] for shot in shots],
+        )
+        detected_text = annotation["detected_text"]
+        model.setColumns("detected_text",
+            timestamp_ms=[toMilliseconds(text["timestamp"]) for text in detected_text],
+            detected_text=[text["detected_text"] for text in detected_text],
         )
-        if label_detection_response["JobStatus"] == "SUCCEEDED":
-            label_finished = True
-        
-        segment_detection_response = rekognition_client.get_segment_detection(
-            JobId=segment_detection_response_jobId,
+        # Labels with a start are time ranges of aggregated samples, single samples end at their timestamp
+        labels = annotation["detected_labels"]
+        model.setColumns("detected_labels",
+            timestamp_ms=[toMilliseconds(label["start"] if "start" in label else label["timestamp"]) for label in labels],
+            label_name=[label["label_name"] for label in labels],
+            end_ms=[toMilliseconds(label["end"] if "start" in label else label["timestamp"]) for label in labels],
+            confidence=[label["confidence"] if "start" in label else 0.0 for label in labels],
+            count=[label["count"] if "start" in label else 0 for label in labels],
         )
-        if segment_detection_response["JobStatus"] == "SUCCEEDED":
-            segment_finished = True
-        
-        text_detection_response = rekognition_client.get_text_detection(
-            JobId=text_detection_response_jobId,
+        celebrities = annotation["detected_celebrities"]
+        model.setColumns("detected_celebrities",
+            timestamp_ms=[toMilliseconds(celebrity["timestamp"]) for celebrity in celebrities],
+            name=[celebrity["name"] for celebrity in celebrities],
+            urls=[json.dumps(celebrity["urls"]) for celebrity in celebrities],
         )
-        if text_detection_response["JobStatus"] == "SUCCEEDED":
-            text_finished = True
-        
-        celebrity_detection_response = rekognition_client.get_celebrity_recognition(
-            JobId=celebrity_detection_response_jobId,
+        utterances = annotation["utterances"]
+        entities = [entity for utterance in utterances for entity in utterance["entities"]]
+        model.setColumns("entities",
+            begin=[entity["BeginOffset"] for entity in entities],
+            end=[entity["EndOffset"] for entity in entities],
+            type=[entity["Type"] for entity in entities],
+            text=[entity["Text"] for entity in entities],
+            score=[entity["Score"] for entity in entities],
         )
-        if celebrity_detection_response["JobStatus"] == "SUCCEEDED":
-            celebrity_finished = True
+        tokens = [token for utterance in utterances for token in utterance["syntax"]]
+        model.setColumns("syntax",
+            begin=[token["BeginOffset"] for token in tokens],
+            end=[token["EndOffset"] for token in tokens],
+            text=[token["Text"] for token in tokens],
+            tag=[token["PartOfSpeech"]["Tag"] for token in tokens],
+            tag_score=[token["PartOfSpeech"]["Score"] for token in tokens],
+        )
+        model.setColumns("utterances",
+            start_ms=[toMilliseconds(utterance["start"]) for utterance in utterances],
+            end_ms=[toMilliseconds(utterance["end"]) for utterance in utterances],
+            dur_ms=[toMilliseconds(utterance["dur"]) for utterance in utterances],
+            text=[utterance["text"] for utterance in utterances],
+            translation=[utterance["translation"] for utterance in utterances],
+            sentiment=[utterance["sentiment"] for utterance in utterances],
+            entities_end=list(itertools.accumulate(len(utterance["entities"]) for utterance in utterances)),
+            syntax_end=list(itertools.accumulate(len(utterance["syntax"]) for utterance in utterances)),
+        )
+        return model
 
-        if (label_detection_response["JobStatus"] == "FAILED") or (segment_detection_response["JobStatus"] == "FAILED") or (text_detection_response["JobStatus"] == "FAILED") or (celebrity_detection_response["JobStatus"] == "FAILED"):
-            raise Exception("Video analyzing jobs failed")
+    def toDict(self) -> dict:
+        '''
+            Returns the annotation as dict of lists like it is saved in annotation.json
+        '''
+        def seconds(column):
+            return ['%.2f' % (milliseconds / 1000) for milliseconds in column]
 
-        print("Video analyzing jobs not finished - retry in 15 seconds")
+        tables = self.tables
+        entities = tables["entities"]
+        entity_types = self.column("entities", "type")
+        entity_texts = self.column("entities", "text")
+        syntax = tables["syntax"]
+        token_texts = self.column("syntax", "text")
+        token_tags = self.column("syntax", "tag")
+        utterances = []
+        for row, (start, end, dur, text, translation, sentiment) in enumerate(zip(
+                tables["utterances"]["start_ms"], tables["utterances"]["end_ms"], seconds(tables["utterances"]["dur_ms"]),
+                self.column("utterances", "text"), self.column("utterances", "translation"), self.column("utterances", "sentiment"))):
+            token_rows = self.childRows(row, "syntax")
+            utterances.append({
+                "text": text,
+                "start": str(start / 1000),
+                "end": str(end / 1000),
+                "dur": dur,
+                "translation": translation,
+                "entities": [{
+                    "Score": entities["score"][entity],
+                    "Type": entity_types[entity],
+                    "Text": entity_texts[entity],
+                    "BeginOffset": entities["begin"][entity],
+                    "EndOffset": entities["end"][entity],
+                } for entity in self.childRows(row, "entities")],
+                "sentiment": sentiment,
+                "syntax": [{
+                    "TokenId": token - token_rows.start + 1,
+                    "Text": token_texts[token],
+                    "BeginOffset": syntax["begin"][token],
+                    "EndOffset": syntax["end"][token],
+                    "PartOfSpeech": {
+                        "Tag": token_tags[token],
+                        "Score": syntax["tag_score"][token],
+                    },
+                } for token in token_rows],
+            })
 
-        time.sleep(15)
-    
-    
-    # Save AWS responses to json files
-    with open('raw_label_detection_response.json', 'w') as fp:
-        json.dump(label_detection_response, fp)
+        # Labels with a count are time ranges of aggregated samples
+        labels = tables["detected_labels"]
+        detected_labels = []
+        for name, timestamp, end, confidence, count in zip(self.column("detected_labels", "label_name"), seconds(labels["timestamp_ms"]), seconds(labels["end_ms"]), labels["confidence"], labels["count"]):
+            if count:
+                detected_labels.append({"label_name": name, "start": timestamp, "end": end, "confidence": confidence, "count": count})
+            else:
+                detected_labels.append({"label_name": name, "timestamp": timestamp})
 
-    with open('raw_segment_detection_response.json', 'w') as fp:
-        json.dump(segment_detection_response, fp)
+        cues = tables["detected_cues"]
+        shots = tables["detected_shots"]
+        return {
+            "utterances": utterances,
+            "detected_text": [{"detected_text": text, "timestamp": timestamp} for text, timestamp in zip(
+                self.column("detected_text", "detected_text"), seconds(tables["detected_text"]["timestamp_ms"]))],
+            "detected_cues": [{"start": start, "end": end, "dur": dur, "type": cue_type} for start, end, dur, cue_type in zip(
+                seconds(cues["start_ms"]), seconds(cues["end_ms"]), seconds(cues["dur_ms"]), self.column("detected_cues", "type"))],
+            "detected_shots": [{"start": start, "end": end, "dur": dur, "index": index} for start, end, dur, index in zip(
+                seconds(shots["start_ms"]), seconds(shots["end_ms"]), seconds(shots["dur_ms"]), shots["index"])],
+            "detected_labels": detected_labels,
+            "detected_celebrities": [{"name": name, "timestamp": timestamp, "urls": json.loads(urls)} for name, timestamp, urls in zip(
+                self.column("detected_celebrities", "name"), seconds(tables["detected_celebrities"]["timestamp_ms"]), self.column("detected_celebrities", "urls"))],
+            "Metadata": self.metadata,
+        }
 
-    with open('raw_text_detection_response.json', 'w') as fp:
-        json.dump(text_detection_response, fp)
+    def save(self, path):
+        '''
+            Saves the model in the binary format, the magic bytes and the length of a json header are followed by
+            the header with metadata, string tables and column layout and the bytes of the columns in that layout
+        '''
+        layout = []
+        for table, columns in self.tables.items():
+            for column, values in columns.items():
+                layout.append([table, column, values.typecode, len(values)])
+        header = json.dumps({
+            "version": annotation_model_version,
+            "byteorder": sys.byteorder,
+            "metadata": self.metadata,
+            "strings": self.strings,
+            "columns": layout,
+        }).encode("utf-8")
+        with open(path, 'wb') as fp:
+            fp.write(annotation_model_magic)
+            fp.write(struct.pack("<Q", len(header)))
+            fp.write(header)
+            for table, column, typecode, length in layout:
+                self.tables[table][column].tofile(fp)
 
-    with open('raw_celebrity_detection_response.json', 'w') as fp:
-        json.dump(celebrity_detection_response, fp)
-    
-    
-    print("Analyzing text, segments, labels and celebrities")
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            if fp.read(len(annotation_model_magic)) != annotation_model_magic:
+                raise Exception(path+" is no binary annotation")
+            header_length, = struct.unpack("<Q", fp.read(8))
+            header = json.loads(fp.read(header_length))
+            if header.get("version") != annotation_model_version:
+                raise Exception(path+" is a binary annotation of version "+str(header.get("version"))+", only version "+str(annotation_model_version)+" can be read")
+            model = cls(header["metadata"])
+            model.strings = header["strings"]
+            for table, column, typecode, length in header["columns"]:
+                values = array.array(typecode)
+                values.fromfile(fp, length)
+                if header["byteorder"] != sys.byteorder:
+                    values.byteswap()
+                model.tables[table][column] = values
+        # Columns added after the file was saved are filled with zeros
+        saved_columns = {(table, column) for table, column, typecode, length in header["columns"]}
+        for table, columns in model.tables.items():
+            rows = max(len(values) for values in columns.values())
+            for column, values in columns.items():
+                if (table, column) not in saved_columns:
+                    columns[column] = array.array(values.typecode, bytes(values.itemsize * rows))
+        return model
 
-    with open('raw_text_detection_response.json') as f_in:
-        text_detection_response = json.load(f_in)
 
-    detected_text_array = []
-    for detection in text_detection_response["TextDetections"]:
-        detected_text = {}
-        if detection["TextDetection"]["Type"] == "LINE":
-            detected_text["detected_text"] = detection["TextDetection"]["DetectedText"]
-            timestamp = float(detection["Timestamp"])/1000.0
-            detected_text["timestamp"] = "%.2f" % timestamp
-            #print(detection["TextDetection"]["DetectedText"])
-            detected_text_array.append(detected_text)
-    #print(detected_text_array)
-    annotation_dict['detected_text'] = detected_text_array
-    
+def loadAnnotationModel(annotation_path) -> AnnotationModel:
+    '''
+        Function to load an annotation saved in the binary format or as json file
+    '''
+    with open(annotation_path, 'rb') as fp:
+        binary = fp.read(len(annotation_model_magic)) == annotation_model_magic
+    if binary:
+        return AnnotationModel.load(annotation_path)
+    with open(annotation_path) as f_in:
+        return AnnotationModel.fromDict(json.load(f_in))
 
-    with open('raw_segment_detection_response.json') as f_in:
-        segment_detection_response = json.load(f_in)
 
-    cue_detection_array = []
-    shot_detection_array = []
-    for segment in segment_detection_response["Segments"]:
-        if segment["Type"] == "TECHNICAL_CUE":
-            detected_cue = {}
-            timestamp = float(segment["StartTimestampMillis"])/1000.0
-            detected_cue["start"] = "%.2f" % timestamp
-            timestamp = float(segment["EndTimestampMillis"])/1000.0
-            detected_cue["end"] = "%.2f" % timestamp
-            timestamp = float(segment["DurationMillis"])/1000.0
-            detected_cue["dur"] = "%.2f" % timestamp
-            detected_cue["type"] = segment["TechnicalCueSegment"]["Type"]
-            cue_detection_array.append(detected_cue)
-        if segment["Type"] == "SHOT":
-            detected_shot = {}
-            timestamp = float(segment["StartTimestampMillis"])/1000.0
-            detected_shot["start"] = "%.2f" % timestamp
-            timestamp = float(segment["EndTimestampMillis"])/1000.0
-            detected_shot["end"] = "%.2f" % timestamp
-            timestamp = float(segment["DurationMillis"])/1000.0
-            detected_shot["dur"] = "%.2f" % timestamp
-            detected_shot["index"] = segment["ShotSegment"]["Index"]
-            shot_detection_array.append(detected_shot)
-    annotation_dict['detected_cues'] = cue_detection_array
-    annotation_dict['detected_shots'] = shot_detection_array
-    #print(shot_detection_array)
-    #print(cue_detection_array)
-    
+def getAnnotationPath(directory) -> str:
+    '''
+        Function to return the path of the annotation saved in a directory, annotation.bin if it was saved next to annotation.json
+    '''
+    binary_path = os.path.join(directory, 'annotation.bin')
+    if save_binary_annotation and os.path.exists(binary_path):
+        return binary_path
+    return os.path.join(directory, 'annotation.json')
 
-    with open('raw_label_detection_response.json') as f_in:
-        label_detection_response = json.load(f_in)
 
-    label_detection_array = []
-    for label in label_detection_response["Labels"]:
-        detected_label = {}
-        detected_label["label_name"] = label["Label"]["Name"]
-        timestamp = float(label["Timestamp"])/1000.0
-        detected_label["timestamp"] = "%.2f" % timestamp
-        label_detection_array.append(detected_label)
+def normalizeName(name) -> str:
+    '''
+        Function to normalize a name for matching, case, accents, punctuation and repeated whitespace are ignored
+    '''
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(character for character in name if not unicodedata.combining(character))
+    return " ".join(re.sub(r"[^\w\s]", " ", name).split()) or name
 
 
+class EntityRegistry:
+    '''
+        Authority records of the persons, places and organizations of one or many recordings,
+        each record gets the id of its list type counted up in the order of registration, so ids never change once assigned,
+        names are matched normalized and a single person name matches the one record of several words ending with it
+    '''
+    def __init__(self):
+        self.records = {}
+        self.counters = {}
+        self.index = {}
+        self.surnames = {}
+        self.lock = threading.Lock()
 
-    annotation_dict['detected_labels'] = label_detection_array      
-    #print(label_detection_array)    
-    
-    with open('raw_celebrity_detection_response.json') as f_in:
-        celebrity_detection_response = json.load(f_in)
+    def addName(self, record, name):
+        tokens = normalizeName(name).split() or [name]
+        self.index[(record["type"], " ".join(tokens))] = record["id"]
+        if record["type"] == "pers" and len(tokens) > 1:
+            self.surnames.setdefault(tokens[-1], set()).add(record["id"])
+        if name not in record["names"]:
+            record["names"].append(name)
 
-    celebrity_detection_array = []
-    for celebrity in celebrity_detection_response["Celebrities"]:
-        if celebrity["Celebrity"]["Confidence"] > 90:
-            detected_celebrity = {}
-            detected_celebrity["name"] = celebrity["Celebrity"]["Name"]
-            timestamp = float(label["Timestamp"])/1000.0
-            detected_celebrity["timestamp"] = "%.2f" % timestamp
-            urls = celebrity["Celebrity"]["Urls"]
-            detected_celebrity["urls"] = urls
-            celebrity_detection_array.append(detected_celebrity)
+    def lookup(self, name, list_type):
+        '''
+            Returns the id of the record of a name or None
+        '''
+        key = normalizeName(name)
+        record_id = self.index.get((list_type, key))
+        if record_id is None and list_type == "pers" and len(key.split()) == 1:
+            candidates = self.surnames.get(key, ())
+            if len(candidates) == 1:
+                record_id = next(iter(candidates))
+        return record_id
 
-    annotation_dict['detected_celebrities'] = celebrity_detection_array  
-    #print(celebrity_detection_array)
+    def register(self, name, list_type, urls=None) -> str:
+        '''
+            Returns the id of the record of a name, a new record is added for an unknown name,
+            urls mark the record as celebrity and its name is used as the name of the record
+        '''
+        with self.lock:
+            record_id = self.lookup(name, list_type)
+            tokens = normalizeName(name).split()
+            if record_id is None and list_type == "pers" and len(tokens) > 1:
+                # A single name registered before is the short form of this name if it was not matched to another name yet
+                short_id = self.index.get(("pers", tokens[-1]))
+                if short_id is not None and all(len(normalizeName(short_name).split()) == 1 for short_name in self.records[short_id]["names"]):
+                    record_id = short_id
+            if record_id is None:
+                self.counters[list_type] = self.counters.get(list_type, 0) + 1
+                record_id = list_type+f'{self.counters[list_type]:03d}'
+                self.records[record_id] = {"id": record_id, "type": list_type, "name": name, "names": [], "urls": [], "celebrity": False}
+            record = self.records[record_id]
+            if urls is not None and not record["celebrity"]:
+                record["celebrity"] = True
+                record["name"] = name
+            elif not record["celebrity"] and len(tokens) > len(normalizeName(record["name"]).split()):
+                record["name"] = name
+            for url in urls or ():
+                if url not in record["urls"]:
+                    record["urls"].append(url)
+            self.addName(record, name)
+            return record_id
 
+    def registerAnnotation(self, model):
+        '''
+            Registers the celebrities in the order they were detected and the named persons, places and organizations,
+            the names are registered sorted with the longer names first so their short forms match them
+        '''
+        for name, urls in zip(model.column("detected_celebrities", "name"), model.column("detected_celebrities", "urls")):
+            self.register(name, "pers", json.loads(urls))
+        names = {}
+        for entity_type, entity_text in zip(model.column("entities", "type"), model.column("entities", "text")):
+            if entity_type in entity_markup and entity_markup[entity_type][1]:
+                names.setdefault(entity_markup[entity_type][1], set()).add(entity_text)
+        for list_type in ("pers", "place", "org"):
+            for name in sorted(names.get(list_type, ()), key=lambda name: (-len(normalizeName(name).split()), normalizeName(name), name)):
+                self.register(name, list_type)
 
+    def toDict(self) -> dict:
+        with self.lock:
+            return {"counters": dict(self.counters), "records": copy.deepcopy(list(self.records.values()))}
 
-    # Metadata
-    metadata = {}
-    metadata["FileName"] = file_name
-    metadata["Duration"] = celebrity_detection_response["VideoMetadata"]["DurationMillis"] / 1000
-    metadata["Format"] = celebrity_detection_response["VideoMetadata"]["Format"]
-    metadata["FrameRate"] = celebrity_detection_response["VideoMetadata"]["FrameRate"]
-    metadata["FrameHeight"] = str(celebrity_detection_response["VideoMetadata"]["FrameHeight"])
-    metadata["FrameWidth"] = str(celebrity_detection_response["VideoMetadata"]["FrameWidth"])
-    metadata["VideoLanguage"] = analyze_source_language
-    metadata["TranslationLanguage"] = translation_target_language
-    annotation_dict["Metadata"] = metadata
+    @classmethod
+    def fromDict(cls, registry):
+        entity_registry = cls()
+        entity_registry.counters = registry["counters"]
+        for record in registry["records"]:
+            entity_registry.records[record["id"]] = record
+            for name in record["names"]:
+                entity_registry.addName(record, name)
+        return entity_registry
 
+    def save(self, path):
+        registry = self.toDict()
+        with open(path+".tmp", 'w') as fp:
+            json.dump(registry, fp, indent=2)
+        os.replace(path+".tmp", path)
 
-    # Save final annotation json file
-    with open('annotation.json', 'w') as fp:
-        json.dump(annotation_dict, fp)
+    @classmethod
+    def load(cls, path):
+        with open(path) as f_in:
+            return cls.fromDict(json.load(f_in))
 
-    
-    return True
+
+def getUtteranceSpans(model, row, getReferenceIdByText) -> list:
+    '''
+        Function to collect the entity and part of speech spans of an utterance row,
+        returns (begin, end, nesting level, tag, attributes) tuples sorted by their position in the text
+    '''
+    spans = []
+    entities = model.tables["entities"]
+    entity_types = model.strings.get("entities.type")
+    entity_texts = model.strings.get("entities.text")
+    for entity in model.childRows(row, "entities"):
+        entity_type = entity_types[entities["type"][entity]]
+        if entity_type not in entity_markup:
+            continue
+        tag, dictType = entity_markup[entity_type]
+        attributes = {}
+        if dictType:
+            attributes["ref"] = "#"+getReferenceIdByText(entity_texts[entities["text"][entity]], dictType=dictType)
+        spans.append((entities["begin"][entity], entities["end"][entity], 0, tag, attributes))
+    syntax = model.tables["syntax"]
+    token_tags = model.strings.get("syntax.tag")
+    for token in model.childRows(row, "syntax"):
+        tag = token_tags[syntax["tag"][token]]
+        pos = tag if tag in stts_tag_set else stts_tags.get(tag, "XY")
+        spans.append((syntax["begin"][token], syntax["end"][token], 1, 'w', {"pos": pos}))
+    # Entities enclose the words starting at the same offset, longer spans enclose shorter ones
+    spans.sort(key=lambda span: (span[0], span[2], -span[1]))
+    return spans
 
 
-def increaseOffsets(transcribtDict, beginOffset, endOffset, preIncreaseValue, postIncreaseValue)  -> dict:
-    for entity in transcribtDict["entities"]:
-        if entity["BeginOffset"] >= endOffset:
-            entity["BeginOffset"] = entity["BeginOffset"] + postIncreaseValue
-            entity["EndOffset"] = entity["EndOffset"] + postIncreaseValue
-        elif entity["BeginOffset"] >= beginOffset:
-            entity["BeginOffset"] = entity["BeginOffset"] + preIncreaseValue
-            entity["EndOffset"] = entity["EndOffset"] + preIncreaseValue
-    for pos in transcribtDict["syntax"]:
-        if pos["BeginOffset"] >= endOffset:
-            pos["BeginOffset"] = pos["BeginOffset"] + postIncreaseValue
-            pos["EndOffset"] = pos["EndOffset"] + postIncreaseValue
-        elif pos["BeginOffset"] >= beginOffset:
-            pos["BeginOffset"] = pos["BeginOffset"] + preIncreaseValue
-            pos["EndOffset"] = pos["EndOffset"] + preIncreaseValue
-    return transcribtDict
-            
+def appendMarkupText(element, text):
+    if not text:
+        return
+    if len(element):
+        element[-1].tail = (element[-1].tail or "") + text
+    else:
+        element.text = (element.text or "") + text
 
 
-def createTeiFile() -> etree.Element:
+def appendUtteranceMarkup(u, text, spans):
     '''
-        Function to parse the annotation json file to a TEI document
+        Function to append the utterance text with nested entity and word elements to u in a single pass over the sorted spans,
+        spans crossing the end of an enclosing span are cut at its end
     '''
-    with open('annotation.json') as f_in:
-        transcript_json = json.load(f_in)
+    open_elements = [(u, len(text))]
+    position = 0
+    for begin, end, level, tag, attributes in spans:
+        begin = max(begin, position)
+        while len(open_elements) > 1 and open_elements[-1][1] <= begin:
+            element, element_end = open_elements.pop()
+            appendMarkupText(element, text[position:element_end])
+            position = element_end
+        parent, parent_end = open_elements[-1]
+        end = min(end, parent_end)
+        if begin >= end:
+            continue
+        appendMarkupText(parent, text[position:begin])
+        position = begin
+        element = etree.SubElement(parent, tag, attributes)
+        open_elements.append((element, end))
+    while len(open_elements) > 1:
+        element, element_end = open_elements.pop()
+        appendMarkupText(element, text[position:element_end])
+        position = element_end
+    appendMarkupText(u, text[position:])
 
-    TEI = etree.Element('TEI', xmlns="http://www.tei-c.org/ns/1.0")
+
+
+def buildColumnIndex(times) -> tuple:
+    '''
+        Function to sort the rows of a time column once, returns the sorted times and the matching rows
+    '''
+    positions = sorted(range(len(times)), key=times.__getitem__)
+    return [times[position] for position in positions], positions
+
+
+def getRowsInRange(time_index, start, end) -> list:
+    '''
+        Function to return the rows with start <= time <= end from a time index in ascending order
+    '''
+    times, positions = time_index
+    lower = bisect.bisect_left(times, start)
+    upper = bisect.bisect_right(times, end)
+    return sorted(positions[lower:upper])
+
+
+
+def addTeiProcessingInstructions(TEI):
     TEI.addprevious(etree.ProcessingInstruction("xml-model", text='href="http://www.tei-c.org/release/xml/tei/custom/schema/relaxng/tei_all.rng" type="application/xml" schematypens="http://purl.oclc.org/dsdl/schematron"'))
     TEI.addprevious(etree.ProcessingInstruction("xml-model", text='href="https://raw.githubusercontent.com/MichaelFleck92/video-to-tei/main/custom-scheme.rng" type="application/xml" schematypens="http://relaxng.org/ns/structure/1.0"'))
 
+
+def buildTeiHeader(metadata) -> etree.Element:
     teiHeader = etree.Element('teiHeader')
     fileDesc = etree.Element('fileDesc')
     titleStmt = etree.Element('titleStmt')
     title = etree.Element('title')
-    title.text = transcript_json["Metadata"]["FileName"]
+    title.text = metadata["FileName"]
     titleStmt.append(title)
     publicationStmt = etree.Element('publicationStmt')
     p = etree.Element('p')
@@ -482,37 +3559,31 @@ def createTeiFile() -> etree.Element:
     publicationStmt.append(p)
     sourceDesc = etree.Element('sourceDesc')
     p = etree.Element('p')
-    p.text = "Automatically generated from "+transcript_json["Metadata"]["FileName"]+" by MichaelFleck92/video-to-tei"
+    p.text = "Automatically generated from "+metadata["FileName"]+" by MichaelFleck92/video-to-tei"
     sourceDesc.append(p)
 
     fileDesc.append(titleStmt)
     fileDesc.append(publicationStmt)
     fileDesc.append(sourceDesc)
 
-
-
-
-
-
-
     sourceDesc = etree.Element('sourceDesc')
     recordingStmt = etree.Element('recordingStmt')
     recording = etree.Element('recording',
         type="video"
     )
-    mt = mimetypes.guess_type(file_path+file_name)
+    mt = mimetypes.guess_type(metadata["FileName"])
     media = etree.Element('media',
-        url=transcript_json["Metadata"]["FileName"],
+        url=metadata["FileName"],
         mimeType=mt[0]
     )
-    media.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = transcript_json["Metadata"]["VideoLanguage"]
+    media.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = metadata["VideoLanguage"]
     desc = etree.Element('desc')
     dimensions = etree.Element('dimensions')
     width = etree.Element('width')
-    width.text = transcript_json["Metadata"]["FrameWidth"]
+    width.text = metadata["FrameWidth"]
     dimensions.append(width)
     height = etree.Element('height')
-    height.text = transcript_json["Metadata"]["FrameHeight"]
+    height.text = metadata["FrameHeight"]
     dimensions.append(height)
     desc.append(dimensions)
 
@@ -523,79 +3594,52 @@ def createTeiFile() -> etree.Element:
     fileDesc.append(sourceDesc)
 
     teiHeader.append(fileDesc)
-    TEI.append(teiHeader)
-
-    standOff = etree.Element('standOff')
+    return teiHeader
 
-    # Get unique pers, place and orgNames
-    unique_persons = set()
-    unique_locations = set()
-    unique_organizations = set()
-    for utterance in transcript_json["utterances"]:
-        for entity in utterance["entities"]:
-            if entity["Type"] == "PERSON":
-                unique_persons.add(entity["Text"])
-            if entity["Type"] == "LOCATION":
-                unique_locations.add(entity["Text"])
-            if entity["Type"] == "ORGANIZATION":
-                unique_organizations.add(entity["Text"])
-    persons_dict = []
-    unique_celebreties = []
-    unique_celebreties_names = []
-    counter = 1
-    for celebrity in transcript_json["detected_celebrities"]:
-        if celebrity["name"] not in unique_celebreties_names:
-            unique_celebreties.append(celebrity)
-            unique_celebreties_names.append(celebrity["name"])
-            celebrity["id"] = "pers"+f'{counter:03d}'
-            counter = counter + 1
-    for person in unique_persons:
-        persons_dict.append({
-            "id": "pers"+f'{counter:03d}',
-            "persName": str(person)
-        })
-        counter = counter + 1
-    locations_dict = []
-    counter = 1
-    for location in unique_locations:
-        locations_dict.append({
-            "id": "place"+f'{counter:03d}',
-            "placeName": str(location)
-        })
-        counter = counter + 1
-    organizations_dict = []
-    counter = 1
-    for organization in unique_organizations:
-        organizations_dict.append({
-            "id": "org"+f'{counter:03d}',
-            "orgName": str(organization)
-        })
-        counter = counter + 1
 
+def getReferenceLookup(registry):
+    '''
+        Function to return the function looking up the id of a name in the entity registry by its list type
+    '''
     def getReferenceIdByText(name, dictType) -> str:
-        if dictType == "pers":
-            for person in persons_dict:
-                if person["persName"] == name:
-                    return person["id"]
-        elif dictType == "celebrity":
-            for celebrity in unique_celebreties:
-                if celebrity["name"] == name:
-                    return celebrity["id"]
-        elif dictType == "place":
-            for place in locations_dict:
-                if place["placeName"] == name:
-                    return place["id"]
-        elif dictType == "org":
-            for org in organizations_dict:
-                if org["orgName"] == name:
-                    return org["id"]
+        if dictType == "celebrity":
+            return registry.lookup(name, "pers")
+        elif dictType in ("pers", "place", "org"):
+            return registry.lookup(name, dictType)
         else:
             return None
+    return getReferenceIdByText
+
+
+def buildStandOff(model, registry=None) -> tuple:
+    '''
+        Function to build the authority lists of persons, places and organizations and the sentiment interpretations,
+        the names are registered in the entity registry shared by several recordings or in a new one,
+        returns the standOff element and the function looking up the id of a name in the lists
+    '''
+    standOff = etree.Element('standOff')
+
+    registry = registry or EntityRegistry()
+    registry.registerAnnotation(model)
+    getReferenceIdByText = getReferenceLookup(registry)
+
+    # Records of the celebrities in the order they were detected and of the names in the utterances in the order of the registry
+    celebrity_ids = {}
+    for name in model.column("detected_celebrities", "name"):
+        celebrity_ids.setdefault(getReferenceIdByText(name, "celebrity"), None)
+    used_ids = set()
+    for entity_type, entity_text in zip(model.column("entities", "type"), model.column("entities", "text")):
+        if entity_type in entity_markup and entity_markup[entity_type][1]:
+            used_ids.add(getReferenceIdByText(entity_text, entity_markup[entity_type][1]))
+    used_records = {"pers": [], "place": [], "org": []}
+    for record_id, record in registry.records.items():
+        if record_id in used_ids and record_id not in celebrity_ids:
+            used_records[record["type"]].append(record)
 
-    
     listPerson = etree.Element('listPerson')
 
-    for celebrity in unique_celebreties:
+    for celebrity_id in celebrity_ids:
+        celebrity = registry.records[celebrity_id]
         person = etree.Element('person')
         person.attrib["{http://www.w3.org/XML/1998/namespace}id"] = celebrity["id"]
         persName = etree.Element('persName')
@@ -610,31 +3654,31 @@ def createTeiFile() -> etree.Element:
 
     
     personGrp = etree.Element('personGrp', role="determined-by-utterances")
-    for person in persons_dict:
+    for person in used_records["pers"]:
         persName = etree.Element('persName')
         persName.attrib["{http://www.w3.org/XML/1998/namespace}id"] = person["id"]
-        persName.text = person["persName"]
+        persName.text = person["name"]
         personGrp.append(persName)
     listPerson.append(personGrp)
 
     standOff.append(listPerson)
 
     listPlace = etree.Element('listPlace', type="determined-by-utterances")
-    for place in locations_dict:
+    for place in used_records["place"]:
         place_tag = etree.Element('place')
         placeName = etree.Element('placeName')
         placeName.attrib["{http://www.w3.org/XML/1998/namespace}id"] = place["id"]
-        placeName.text = place["placeName"]
+        placeName.text = place["name"]
         place_tag.append(placeName)
         listPlace.append(place_tag)
     standOff.append(listPlace)
 
     listOrg = etree.Element('listOrg', type="determined-by-utterances")
-    for org in organizations_dict:
+    for org in used_records["org"]:
         org_tag = etree.Element('org')
         orgName = etree.Element('orgName')
         orgName.attrib["{http://www.w3.org/XML/1998/namespace}id"] = org["id"]
-        orgName.text = org["orgName"]
+        orgName.text = org["name"]
         org_tag.append(orgName)
         listOrg.append(org_tag)
     standOff.append(listOrg)
@@ -642,231 +3686,214 @@ def createTeiFile() -> etree.Element:
     interpGrp = etree.Element('interpGrp')
     interpGrp.attrib["{http://www.w3.org/XML/1998/namespace}id"] = "sentiment"
     sentiment_array = []
-    for utterance in transcript_json["utterances"]:
-        if utterance["sentiment"] not in sentiment_array:
-            sentiment_array.append(utterance["sentiment"])
+    for sentiment in model.column("utterances", "sentiment"):
+        if sentiment not in sentiment_array:
+            sentiment_array.append(sentiment)
             interp = etree.Element('interp')
-            interp.attrib["{http://www.w3.org/XML/1998/namespace}id"] = utterance["sentiment"]
+            interp.attrib["{http://www.w3.org/XML/1998/namespace}id"] = sentiment
             interpGrp.append(interp)
     standOff.append(interpGrp)
 
-    TEI.append(standOff)
+    return standOff, getReferenceIdByText
+
+
+def getCueRange(model, row) -> tuple:
+    '''
+        Function to return the start and end of a cue row in milliseconds, opening credits reach back to the start of the recording
+    '''
+    cues = model.tables["detected_cues"]
+    if model.strings["detected_cues.type"][cues["type"][row]] == "OpeningCredits":
+        return 0, cues["end_ms"][row]
+    return cues["start_ms"][row], cues["end_ms"][row]
+
+def buildTimeIndexes(model) -> dict:
+    # Time indexes to look up the shots, detections and utterances of a cue or shot without scanning all of them
+    time_indexes = {
+        "detected_shots": buildColumnIndex(model.tables["detected_shots"]["start_ms"]),
+        "detected_text": buildColumnIndex(model.tables["detected_text"]["timestamp_ms"]),
+        "detected_labels": buildColumnIndex(model.tables["detected_labels"]["timestamp_ms"]),
+        "detected_celebrities": buildColumnIndex(model.tables["detected_celebrities"]["timestamp_ms"]),
+        "utterances": buildColumnIndex(model.tables["utterances"]["start_ms"]),
+    }
+    # First cue row of each utterance, cues overlap and opening credits reach back to the start, so later cues may repeat an utterance
+    utterance_cues = array.array("i", [-1]) * model.rows("utterances")
+    for row in range(model.rows("detected_cues")):
+        for utterance_row in getRowsInRange(time_indexes["utterances"], *getCueRange(model, row)):
+            if utterance_cues[utterance_row] < 0:
+                utterance_cues[utterance_row] = row
+    time_indexes["utterance_cues"] = utterance_cues
+    return time_indexes
+
+
+
+def buildCueDiv(model, row) -> etree.Element:
+    '''
+        Function to build the div of a cue row without its shots and utterances
+    '''
+    cues = model.tables["detected_cues"]
+    cue_type = model.strings["detected_cues.type"][cues["type"][row]]
+    div_cue = etree.Element('div',
+        type="DetectedCue"
+    )
+    if cue_type == "OpeningCredits":
+        div_cue.attrib["type"] = "OpeningCredits"
+    elif cue_type == "Content":
+        div_cue.attrib["type"] = "Content"
+    elif cue_type == "EndCredits":
+        div_cue.attrib["type"] = "EndCredits"
+    div_cue.attrib["from"] = formatClock(cues["start_ms"][row])
+    div_cue.attrib["to"] = formatClock(cues["end_ms"][row])
+    div_cue.attrib["dur"] = formatClock(cues["dur_ms"][row])
+    return div_cue
+
+
+def buildShotDiv(model, time_indexes, row, getReferenceIdByText) -> etree.Element:
+    shot_elements_array = []
+    shots = model.tables["detected_shots"]
+    div_shot = etree.Element('div',
+        type="DetectedShot"
+    )
+    div_shot.attrib["from"] = formatClock(shots["start_ms"][row])
+    div_shot.attrib["to"] = formatClock(shots["end_ms"][row])
+    div_shot.attrib["dur"] = '%.2f' % (shots["dur_ms"][row] / 1000)
+
+    shot_start = shots["start_ms"][row]
+    shot_end = shots["end_ms"][row]
+
+    detected_text = model.tables["detected_text"]
+    for text_row in getRowsInRange(time_indexes["detected_text"], shot_start, shot_end):
+        div_text = etree.Element('div',
+            type="DetectedText"
+        )
+        div_text.attrib["when"] = formatClock(detected_text["timestamp_ms"][text_row])
+        caption = etree.Element('caption')
+        caption.text = model.strings["detected_text.detected_text"][detected_text["detected_text"][text_row]]
+        div_text.append(caption)
+        shot_elements_array.append(div_text)
+
+    labels = model.tables["detected_labels"]
+    for label_row in getRowsInRange(time_indexes["detected_labels"], shot_start, shot_end):
+        div_label = etree.Element('div',
+            type="DetectedLabel"
+        )
+        ab = etree.Element('ab')
+        if labels["count"][label_row]:
+            div_label.attrib["from"] = formatClock(labels["timestamp_ms"][label_row])
+            div_label.attrib["to"] = formatClock(labels["end_ms"][label_row])
+            div_label.attrib["n"] = str(labels["count"][label_row])
+            ab.attrib["cert"] = str(round(labels["confidence"][label_row] / 100, 4))
+        else:
+            div_label.attrib["when"] = formatClock(labels["timestamp_ms"][label_row])
+        ab.text = model.strings["detected_labels.label_name"][labels["label_name"][label_row]]
+        div_label.append(ab)
+        shot_elements_array.append(div_label)
+
+    celebrities = model.tables["detected_celebrities"]
+    for celebrity_row in getRowsInRange(time_indexes["detected_celebrities"], shot_start, shot_end):
+        name = model.strings["detected_celebrities.name"][celebrities["name"][celebrity_row]]
+        div_celebrity = etree.Element('div',
+            type="DetectedPerson"
+        )
+        div_celebrity.attrib["when"] = formatClock(celebrities["timestamp_ms"][celebrity_row])
+        p = etree.Element('p')
+        persName = etree.Element('persName')
+        persName.text = name
+        persName.attrib["ref"] = "#"+getReferenceIdByText(name, "celebrity")
+        p.append(persName)
+        div_celebrity.append(p)
+        shot_elements_array.append(div_celebrity)
+
+    
+    shot_elements_array.sort(key=lambda x: x.attrib.get("when", x.attrib.get("from")))
+    for element in shot_elements_array:
+        div_shot.append(element)
+    return div_shot
+
+
+def buildSpeechDiv(model, row, number, getReferenceIdByText) -> etree.Element:
+    utterances = model.tables["utterances"]
+    div_speech = etree.Element('div',
+        type="DetectedSpeech"
+    )
+    div_speech.attrib["from"] = formatClock(utterances["start_ms"][row])
+    div_speech.attrib["to"] = formatClock(utterances["end_ms"][row])
+    div_speech.attrib["dur"] = '%.2f' % (utterances["dur_ms"][row] / 1000)
+
+    u = etree.Element('u')
+    u.attrib["{http://www.w3.org/XML/1998/namespace}id"] = "utterance"+number
+    u.attrib["ana"] = "#"+model.strings["utterances.sentiment"][utterances["sentiment"][row]]
+    u.attrib["corresp"] = "#translation"+number
+    # Add entities and part of speech tags in utterance text
+    with metrics.timer("tei_utterance_markup_seconds"):
+        appendUtteranceMarkup(u, model.strings["utterances.text"][utterances["text"][row]], getUtteranceSpans(model, row, getReferenceIdByText))
+    div_speech.append(u)
+    ab = etree.Element('ab')
+    ab.attrib["{http://www.w3.org/XML/1998/namespace}id"] = "translation"+number
+    ab.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = model.metadata["TranslationLanguage"]
+    ab.attrib["type"] = "translation"
+    ab.text = model.strings["utterances.translation"][utterances["translation"][row]]
+    div_speech.append(ab)
+    return div_speech
+
+
+def iterCueElements(model, time_indexes, row, getReferenceIdByText, window=None):
+    '''
+        Generator over the shot and speech divs of a cue row sorted by their start time, shots first at the same time,
+        the order is decided on the times alone so only one div is built at a time,
+        with a (start, end) window in whole seconds only the divs starting in it are built
+    '''
+    cue_start, cue_end = getCueRange(model, row)
+
+    cue_items = []
+    shots = model.tables["detected_shots"]
+    for shot_row in getRowsInRange(time_indexes["detected_shots"], cue_start, cue_end):
+        if shots["end_ms"][shot_row] > cue_end:
+            continue
+        cue_items.append((formatClock(shots["start_ms"][shot_row]), shots["start_ms"][shot_row], shot_row, None))
+
+    # Utterances are numbered by their row in the annotation, so their ids do not depend on the cue or window they are built in,
+    # an utterance repeated in a later cue gets the number of that cue appended to keep the ids unique in the file
+    utterances = model.tables["utterances"]
+    utterance_cues = time_indexes["utterance_cues"]
+    for utterance_row in getRowsInRange(time_indexes["utterances"], cue_start, cue_end):
+        number = f'{utterance_row + 1:03d}'
+        if utterance_cues[utterance_row] != row:
+            number = number+"-"+str(row + 1)
+        cue_items.append((formatClock(utterances["start_ms"][utterance_row]), utterances["start_ms"][utterance_row], utterance_row, number))
+
+    cue_items.sort(key=lambda x: x[0])
+    for _, start, item_row, number in cue_items:
+        if window is not None and not window[0] <= start < window[1]:
+            continue
+        if number is None:
+            yield buildShotDiv(model, time_indexes, item_row, getReferenceIdByText)
+        else:
+            yield buildSpeechDiv(model, item_row, number, getReferenceIdByText)
 
 
+def createTeiFile(annotation_path='annotation.json', registry=None) -> etree.Element:
+    '''
+        Function to parse the annotation json or binary file to a TEI document
+    '''
+    with metrics.timer("annotation_load_seconds"):
+        model = loadAnnotationModel(annotation_path)
+
+    TEI = etree.Element('TEI', xmlns="http://www.tei-c.org/ns/1.0")
+    addTeiProcessingInstructions(TEI)
+    TEI.append(buildTeiHeader(model.metadata))
+
+    with metrics.timer("tei_standoff_seconds"):
+        standOff, getReferenceIdByText = buildStandOff(model, registry)
+    TEI.append(standOff)
+
     text = etree.Element('text')
     body = etree.Element('body')
 
-    for cue in transcript_json["detected_cues"]:
-        cue_elements_array = []
-        div_cue = etree.Element('div',
-            type="DetectedCue"
-        )
-        if cue["type"] == "OpeningCredits":
-            div_cue.attrib["type"] = "OpeningCredits"
-        elif cue["type"] == "Content":
-            div_cue.attrib["type"] = "Content"
-        elif cue["type"] == "EndCredits":
-            div_cue.attrib["type"] = "EndCredits"
-        div_cue.attrib["from"] = time.strftime('%H:%M:%S', time.gmtime(float(cue["start"])))
-        div_cue.attrib["to"] = time.strftime('%H:%M:%S', time.gmtime(float(cue["end"])))
-        div_cue.attrib["dur"] = time.strftime('%H:%M:%S', time.gmtime(float(cue["dur"])))
-
-        cue_start = float(cue["start"])
-        if cue["type"] == "OpeningCredits":
-            cue_start = 0.0
-        cue_end = float(cue["end"])
-
-        for shot in transcript_json["detected_shots"]:
-            if float(shot["start"]) >= cue_start and float(shot["end"]) <= cue_end:
-                shot_elements_array = []
-                div_shot = etree.Element('div',
-                    type="DetectedShot"
-                )
-                div_shot.attrib["from"] = time.strftime('%H:%M:%S', time.gmtime(float(shot["start"])))
-                div_shot.attrib["to"] = time.strftime('%H:%M:%S', time.gmtime(float(shot["end"])))
-                div_shot.attrib["dur"] = shot["dur"]
-
-                shot_start = float(shot["start"])
-                shot_end = float(shot["end"])
-
-                for detected_text in transcript_json["detected_text"]:
-                    if float(detected_text["timestamp"]) >= shot_start and float(detected_text["timestamp"]) <= shot_end:
-                        div_text = etree.Element('div',
-                            type="DetectedText"
-                        )
-                        div_text.attrib["when"] = time.strftime('%H:%M:%S', time.gmtime(float(detected_text["timestamp"])))
-                        caption = etree.Element('caption')
-                        caption.text = detected_text["detected_text"]
-                        div_text.append(caption)
-                        shot_elements_array.append(div_text)
-
-                for label in transcript_json["detected_labels"]:
-                    if float(label["timestamp"]) >= shot_start and float(label["timestamp"]) <= shot_end:
-                        div_label = etree.Element('div',
-                            type="DetectedLabel"
-                        )
-                        div_label.attrib["when"] = time.strftime('%H:%M:%S', time.gmtime(float(label["timestamp"])))
-                        ab = etree.Element('ab')
-                        ab.text = label["label_name"]
-                        div_label.append(ab)
-                        shot_elements_array.append(div_label)
-
-                for celebrity in transcript_json["detected_celebrities"]:
-                    if float(celebrity["timestamp"]) >= shot_start and float(celebrity["timestamp"]) <= shot_end:
-                        div_celebrity = etree.Element('div',
-                            type="DetectedPerson"
-                        )
-                        div_celebrity.attrib["when"] = time.strftime('%H:%M:%S', time.gmtime(float(celebrity["timestamp"])))
-                        p = etree.Element('p')
-                        persName = etree.Element('persName')
-                        persName.text = celebrity["name"]
-                        persName.attrib["ref"] = "#"+getReferenceIdByText(celebrity["name"], "celebrity")
-                        p.append(persName)
-                        div_celebrity.append(p)
-                        shot_elements_array.append(div_celebrity)
-
-                
-                shot_elements_array.sort(key=lambda x: x.attrib["when"])
-                for element in shot_elements_array:
-                    div_shot.append(element)
-
-                cue_elements_array.append(div_shot)
-
-        # Utterances
-
-        counter = 1
-        for utterance in transcript_json["utterances"]:
-            if float(utterance["start"]) >= cue_start and float(utterance["start"]) <= cue_end:
-                div_speech = etree.Element('div',
-                    type="DetectedSpeech"
-                )
-                div_speech.attrib["from"] = time.strftime('%H:%M:%S', time.gmtime(float(utterance["start"])))
-                div_speech.attrib["to"] = time.strftime('%H:%M:%S', time.gmtime(float(utterance["end"])))
-                div_speech.attrib["dur"] = utterance["dur"]
-
-                u = etree.Element('u')
-                u.attrib["{http://www.w3.org/XML/1998/namespace}id"] = "utterance"+f'{counter:03d}'
-                u.attrib["ana"] = "#"+utterance["sentiment"]
-                u.attrib["corresp"] = "#translation"+f'{counter:03d}'
-                # Add entities in utterance text
-                temp_utterance = utterance["text"]
-                
-                for entity in utterance["entities"]:
-                    if entity["Type"] == "LOCATION":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<placeName ref='#"+getReferenceIdByText(entity["Text"], dictType="place")+"'>"+entity["Text"]+"</placeName>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 27, 39)
-                    if entity["Type"] == "PERSON":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<persName ref='#"+getReferenceIdByText(entity["Text"], dictType="pers")+"'>"+entity["Text"]+"</persName>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 25, 36)
-                    if entity["Type"] == "DATE":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<date>"+entity["Text"]+"</date>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 6, 13)
-                    if entity["Type"] == "ORGANIZATION":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<orgName ref='#"+getReferenceIdByText(entity["Text"], dictType="org")+"'>"+entity["Text"]+"</orgName>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 23, 33)
-                    if entity["Type"] == "QUANTITY":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<num>"+entity["Text"]+"</num>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 5, 11)
-                
-                
-                for entity in utterance["syntax"]:
-                    w = etree.Element('w')
-                    if entity["PartOfSpeech"]["Tag"] == "NOUN":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='NN'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                    elif entity["PartOfSpeech"]["Tag"] == "DET":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='ART'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 13, 17)
-                    elif entity["PartOfSpeech"]["Tag"] == "NUM":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='CARD'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 14, 18)
-                    elif entity["PartOfSpeech"]["Tag"] == "ADJ":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='ADJA'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 14, 18)
-                    elif entity["PartOfSpeech"]["Tag"] == "ADP":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='APPR'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 14, 18)
-                    elif entity["PartOfSpeech"]["Tag"] == "ADV":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='ADV'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 13, 17)
-                    elif entity["PartOfSpeech"]["Tag"] == "AUX":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='VAINF'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 15, 19)
-                    elif entity["PartOfSpeech"]["Tag"] == "CCONJ":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='KON'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 13, 17)
-                    elif entity["PartOfSpeech"]["Tag"] == "INTJ":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='ITJ'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 13, 17)
-                    elif entity["PartOfSpeech"]["Tag"] == "PRON":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='PPER'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 14, 18)
-                    elif entity["PartOfSpeech"]["Tag"] == "PROPN":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='NE'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                    elif entity["PartOfSpeech"]["Tag"] == "PUNCT":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='XY'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                    elif entity["PartOfSpeech"]["Tag"] == "SCONJ":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='KOUS'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 14, 18)
-                    elif entity["PartOfSpeech"]["Tag"] == "VERB":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='VVINF'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 15, 19)
-                    elif entity["PartOfSpeech"]["Tag"] == "PART":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='PTKZU'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 15, 19)
-                    elif entity["PartOfSpeech"]["Tag"] == "SYM":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='XY'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                    elif entity["PartOfSpeech"]["Tag"] == "O":
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='XY'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                    else:
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + temp_utterance[entity["EndOffset"] + 0:]
-                        temp_utterance = temp_utterance[:entity["BeginOffset"]] + "<w pos='XY'>"+entity["Text"]+"</w>" + temp_utterance[entity["BeginOffset"]:]
-                        utterance = increaseOffsets(utterance, entity["BeginOffset"], entity["EndOffset"], 12, 16)
-                
-                
-                fragment = etree.fromstring(f"<temp>{temp_utterance}</temp>")
-                u.append(fragment)
-                div_speech.append(u)
-                ab = etree.Element('ab')
-                ab.attrib["{http://www.w3.org/XML/1998/namespace}id"] = "translation"+f'{counter:03d}'
-                ab.attrib["{http://www.w3.org/XML/1998/namespace}lang"] = transcript_json["Metadata"]["TranslationLanguage"]
-                ab.attrib["type"] = "translation"
-                ab.text = utterance["translation"]
-                div_speech.append(ab)
-                cue_elements_array.append(div_speech)
-                etree.strip_tags(div_speech, "temp")
-                counter = counter + 1
-        
-        cue_elements_array.sort(key=lambda x: x.attrib["from"])
-        for element in cue_elements_array:
+    time_indexes = buildTimeIndexes(model)
+    for row in range(model.rows("detected_cues")):
+        div_cue = buildCueDiv(model, row)
+        for element in iterCueElements(model, time_indexes, row, getReferenceIdByText):
             div_cue.append(element)
-
         body.append(div_cue)
     
     text.append(body)
@@ -874,18 +3901,209 @@ def createTeiFile() -> etree.Element:
 
     return TEI
 
+
+def indentElement(element, level):
+    '''
+        Function to add the whitespace pretty_print adds to an element at a nesting level,
+        like in libxml2 an element with text between its children is left unchanged together with all its descendants
+    '''
+    if not len(element) or element.text is not None or any(child.tail is not None for child in element):
+        return
+    indentation = "\n" + "  " * (level + 1)
+    element.text = indentation
+    for child in element:
+        indentElement(child, level + 1)
+        child.tail = indentation
+    element[-1].tail = "\n" + "  " * level
+
+
+def writeIndented(xf, element, level):
+    '''
+        Function to write an element to an incremental XML file on a new line, indented like pretty_print at its nesting level
+    '''
+    indentElement(element, level)
+    with metrics.timer("tei_serialization_seconds"):
+        xf.write("\n"+"  "*level, element, with_tail=False)
+
+
+# Annotation model, time indexes and name lookup of a TEI fragment worker process
+tei_fragment_worker = {}
+
+
+def initTeiFragmentWorker(annotation_path, registry):
+    model = loadAnnotationModel(annotation_path)
+    tei_fragment_worker["model"] = model
+    tei_fragment_worker["time_indexes"] = buildTimeIndexes(model)
+    tei_fragment_worker["getReferenceIdByText"] = getReferenceLookup(EntityRegistry.fromDict(registry))
+
+
+def buildTeiFragment(task) -> bytes:
+    '''
+        Function to build the shot and speech divs of a (cue row, window) task in a worker process,
+        returns them serialized like the incremental writer writes them inside of the cue div
+    '''
+    row, window = task
+    fragment = []
+    for element in iterCueElements(tei_fragment_worker["model"], tei_fragment_worker["time_indexes"], row, tei_fragment_worker["getReferenceIdByText"], window):
+        indentElement(element, 4)
+        fragment.append(b"\n        "+etree.tostring(element, encoding="UTF-8", with_tail=False))
+    return b"".join(fragment)
+
+
+def planTeiFragments(model, window_ms) -> list:
+    '''
+        Function to split the cues into (cue row, window) tasks, cues longer than the window are split into windows
+        starting at whole seconds, so the divs of the windows follow each other in the order of the whole cue
+    '''
+    tasks = []
+    for row in range(model.rows("detected_cues")):
+        cue_start, cue_end = getCueRange(model, row)
+        if cue_end - cue_start <= window_ms:
+            tasks.append((row, None))
+            continue
+        window_start = cue_start // 1000 * 1000
+        while window_start <= cue_end:
+            window_end = window_start + window_ms
+            tasks.append((row, (window_start, min(window_end, cue_end + 1))))
+            window_start = window_end
+    return tasks
+
+
+def getTeiFragmentWorkers(model, tasks) -> int:
+    '''
+        Function to return the number of worker processes building the cues of an annotation, 1 builds them in this process
+    '''
+    rows = sum(model.rows(table) for table in ("detected_shots", "detected_text", "detected_labels", "detected_celebrities", "utterances", "entities", "syntax"))
+    if len(tasks) < 2 or rows < tei_fragment_min_rows:
+        return 1
+    processors = os.cpu_count() or 1
+    return max(1, min(tei_fragment_workers or processors, processors, len(tasks)))
+
+
+def iterCueFragments(executor, tasks):
+    '''
+        Generator over the serialized divs of each cue in cue order, built by the worker processes
+    '''
+    fragments = zip((row for row, window in tasks), executor.map(buildTeiFragment, tasks))
+    for row, cue_fragments in itertools.groupby(fragments, key=lambda fragment: fragment[0]):
+        yield b"".join(fragment for _, fragment in cue_fragments)
+
+
+def writeTeiFileIncrementally(annotation_path, tei_path, registry=None):
+    '''
+        Function to write the TEI document of an annotation json or binary file element by element,
+        header and standOff are written first and then the cues one shot or utterance at a time,
+        so only a single div is held in memory, the output is identical to writing createTeiFile(),
+        with tei_fragment_workers the cues are built by worker processes and written in order
+    '''
+    with metrics.timer("annotation_load_seconds"):
+        model = loadAnnotationModel(annotation_path)
+
+    TEI = etree.Element('TEI', xmlns="http://www.tei-c.org/ns/1.0")
+    addTeiProcessingInstructions(TEI)
+    registry = registry or EntityRegistry()
+    with metrics.timer("tei_standoff_seconds"):
+        standOff, getReferenceIdByText = buildStandOff(model, registry)
+
+    with contextlib.ExitStack() as stack:
+        cue_fragments = None
+        tasks = planTeiFragments(model, max(1, round(tei_fragment_window)) * 1000) if tei_fragment_workers != 1 else []
+        workers = getTeiFragmentWorkers(model, tasks) if tasks else 1
+        if workers > 1:
+            # Worker processes are spawned as the caller may run threads, each loads the annotation once
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"), initializer=initTeiFragmentWorker, initargs=(annotation_path, registry.toDict())))
+            cue_fragments = iterCueFragments(executor, tasks)
+        with open(tei_path, 'wb') as output:
+            # The incremental writer only writes inside of the root element, the prolog is written before
+            output.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+            for processing_instruction in (TEI.getprevious().getprevious(), TEI.getprevious()):
+                output.write(etree.tostring(processing_instruction, encoding="UTF-8")+b"\n")
+            writeTeiRoot(output, TEI, model, standOff, getReferenceIdByText, cue_fragments)
+
+
+def writeTeiRoot(output, TEI, model, standOff, getReferenceIdByText, cue_fragments=None):
+    time_indexes = buildTimeIndexes(model)
+    with etree.xmlfile(output, encoding="UTF-8") as xf:
+        with xf.element('TEI', TEI.attrib):
+            writeIndented(xf, buildTeiHeader(model.metadata), 1)
+            writeIndented(xf, standOff, 1)
+            xf.write("\n  ")
+            with xf.element('text'):
+                if not model.rows("detected_cues"):
+                    writeIndented(xf, etree.Element('body'), 2)
+                else:
+                    xf.write("\n    ")
+                    with xf.element('body'):
+                        for row in range(model.rows("detected_cues")):
+                            div_cue = buildCueDiv(model, row)
+                            if cue_fragments is not None:
+                                fragment = next(cue_fragments)
+                                if not fragment:
+                                    writeIndented(xf, div_cue, 3)
+                                    continue
+                                xf.write("\n      ")
+                                with xf.element('div', div_cue.attrib):
+                                    # The divs built by the workers are written between the tags of the cue div
+                                    xf.flush()
+                                    output.write(fragment)
+                                    xf.write("\n      ")
+                                continue
+                            elements = iterCueElements(model, time_indexes, row, getReferenceIdByText)
+                            element = next(elements, None)
+                            if element is None:
+                                writeIndented(xf, div_cue, 3)
+                                continue
+                            xf.write("\n      ")
+                            with xf.element('div', div_cue.attrib):
+                                while element is not None:
+                                    writeIndented(xf, element, 4)
+                                    element = next(elements, None)
+                                xf.write("\n      ")
+                        xf.write("\n    ")
+                xf.write("\n  ")
+            xf.write("\n")
+    output.write(b"\n")
+
     
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Annotate a recording with AWS and convert the annotation to TEI")
+    parser.add_argument("--rebuild", nargs="+", metavar="DIRECTORY",
+        help="rebuild annotation.json and the TEI file from the raw responses saved in the directories, without AWS requests")
+    parser.add_argument("--batch", metavar="MANIFEST",
+        help="process all recordings of a CSV file with a path and an optional name column or of a glob pattern like 'videos/*.mp4'")
+    parser.add_argument("--output-directory",
+        help="write the files of each recording to a sub directory of this directory named like the recording, default is the raw directory for --rebuild and the current directory for --batch")
+    parser.add_argument("--file-name",
+        help="file name of the recording in the TEI header, default is the file name in the annotation.json of the raw directory")
+    parser.add_argument("--workers", type=int, default=None,
+        help="number of processes rebuilding directories or creating TEI files in parallel, default is the number of processors")
+    parser.add_argument("--max-recordings", type=int, default=None,
+        help="number of recordings of a batch analyzed by AWS at the same time, default is batch_max_recordings")
+    parser.add_argument("--allow-requests", action="store_true",
+        help="analyze utterances missing in annotation.json and cache with Translate and Comprehend")
+    parser.add_argument("--detect-segments", metavar="RECORDING",
+        help="detect the shots and technical cues of a recording locally with ffmpeg and save them as raw segment detection response in the output directory")
+    parser.add_argument("--reference", metavar="DIRECTORY",
+        help="compare the shots found by --detect-segments with the Rekognition segment detection response saved in the directory")
+    arguments = parser.parse_args()
+
+    if arguments.detect_segments:
+        return detectAndCompareSegments(arguments.detect_segments, arguments.output_directory or ".", arguments.reference)
+
+    if arguments.rebuild:
+        return rebuildDirectories(arguments.rebuild, arguments.output_directory, arguments.file_name, arguments.workers, not arguments.allow_requests)
+
+    if arguments.batch:
+        summary = runBatch(arguments.batch, arguments.output_directory or ".", arguments.max_recordings, arguments.workers)
+        return summary["failed"] == 0
+
     if startAnnotationJobs():
         #return True
-        tei_document = createTeiFile()
-        etree.ElementTree(tei_document).write(file_path+tei_output_file_name,
-                                            encoding="utf-8",
-                                            xml_declaration=True,
-                                            pretty_print=True
-                                        )
+        saveTeiFile(getAnnotationPath("."), file_path+tei_output_file_name)
+        metrics.save(".")
 
 
 
@@ -0,0 +1,527 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import app
+from tests.corpus import loadAnnotation, repeatAnnotation, joinCues, naiveShotBuckets, indexedShotBuckets, splitExample, planExampleChunks
+from tests.fakes import FakeEnrichmentClient, LocalS3, LocalBatchTranslate, SimulatedClock, FakeNotificationQueue, simulateJobTracking, simulateFixedPolling, job_scenarios
+
+'''
+    Benchmarks for the local code paths, run against the bundled examples,
+    the results are checked by the tests in tests/
+
+    python benchmark.py [--repeat 5] [--hours 1 5 20] [examples/dw548 ...]
+'''
+
+example_directories = [
+    "examples/dw548",
+    "examples/dw694",
+    "examples/dw750",
+]
+
+
+def measure(function, repeat) -> tuple:
+    '''
+        Function to run a function several times, returns the best wall-clock time and the last result
+    '''
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmarkShotBucketing(directory, repeat):
+    annotation = loadAnnotation(directory)
+    naive_time, _ = measure(lambda: naiveShotBuckets(annotation), repeat)
+    model = app.AnnotationModel.fromDict(annotation)
+    indexed_time, _ = measure(lambda: indexedShotBuckets(model), repeat)
+    print(f"  shot/cue bucketing   nested scan {naive_time*1000:9.2f} ms   time index {indexed_time*1000:9.2f} ms   speedup {naive_time/indexed_time:6.1f}x")
+
+
+def benchmarkCreateTeiFile(directory, repeat):
+    tei_time, _ = measure(lambda: app.createTeiFile(os.path.join(directory, 'annotation.json')), repeat)
+    print(f"  createTeiFile()      {tei_time*1000:9.2f} ms")
+
+
+def peakMemory() -> int:
+    '''
+        Function to return the peak resident memory of the process in KB, read from VmHWM on Linux
+        as ru_maxrss of a spawned worker process still counts the process it was forked from
+    '''
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def runTeiWriter(incremental, annotation_path, tei_path) -> tuple:
+    '''
+        Writes a TEI file in a fresh worker process, returns the seconds and the growth of the peak resident memory in KB
+    '''
+    peak_before = peakMemory()
+    started = time.perf_counter()
+    if incremental:
+        app.writeTeiFileIncrementally(annotation_path, tei_path)
+    else:
+        app.writeTeiFile(app.createTeiFile(annotation_path), tei_path)
+    return time.perf_counter() - started, peakMemory() - peak_before
+
+
+def benchmarkTeiWriters(directory, times=20):
+    '''
+        The in-memory tree and the incremental TEI writer on the annotation repeated to a long recording,
+        each writer runs in its own process so the peak memory is not shared
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as output_directory:
+        annotation_path = os.path.join(output_directory, 'annotation.json')
+        with open(annotation_path, 'w') as fp:
+            json.dump(repeatAnnotation(loadAnnotation(directory), times), fp)
+        for incremental in (False, True):
+            tei_path = os.path.join(output_directory, "incremental.xml" if incremental else "tree.xml")
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results[incremental] = executor.submit(runTeiWriter, incremental, annotation_path, tei_path).result()
+    (tree_time, tree_memory), (incremental_time, incremental_memory) = results[False], results[True]
+    print(f"  TEI writer {times}x       tree {tree_time*1000:9.2f} ms {tree_memory/1024:7.1f} MB   incremental {incremental_time*1000:9.2f} ms {incremental_memory/1024:7.1f} MB peak growth")
+
+
+def benchmarkTeiFragments(directory, times=20, workers=0, single_cue=False):
+    '''
+        The incremental TEI writer building the cues in this process and in worker processes
+        on the annotation repeated to a long recording, with single_cue the recording is one long cue split into windows
+    '''
+    tei_fragment_workers = app.tei_fragment_workers
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as output_directory:
+            annotation_path = os.path.join(output_directory, 'annotation.json')
+            annotation = repeatAnnotation(loadAnnotation(directory), times)
+            with open(annotation_path, 'w') as fp:
+                json.dump(joinCues(annotation) if single_cue else annotation, fp)
+            del annotation
+            app.tei_fragment_workers = workers
+            model = app.loadAnnotationModel(annotation_path)
+            tasks = app.planTeiFragments(model, max(1, round(app.tei_fragment_window)) * 1000)
+            started_workers = app.getTeiFragmentWorkers(model, tasks)
+            for fragment_workers in (1, workers):
+                app.tei_fragment_workers = fragment_workers
+                started = time.perf_counter()
+                app.writeTeiFileIncrementally(annotation_path, os.path.join(output_directory, f"workers{fragment_workers}.xml"))
+                results[fragment_workers] = time.perf_counter() - started
+    finally:
+        app.tei_fragment_workers = tei_fragment_workers
+    name = f"TEI fragments {times}x" + (" 1 cue" if single_cue else "")
+    if started_workers == 1:
+        print(f"  {name:20} serial {results[1]*1000:9.2f} ms   {workers or 'processor count'} workers fall back to the serial writer "
+            f"({os.cpu_count()} processors, {len(tasks)} tasks of {model.rows('detected_cues')} cues) {results[workers]*1000:9.2f} ms")
+        return
+    speedup = results[1] / results[workers]
+    print(f"  {name:20} serial {results[1]*1000:9.2f} ms   {started_workers} workers {results[workers]*1000:9.2f} ms   {speedup:5.2f}x"
+        + ("" if speedup >= 1 else ", parallel mode is slower than the serial writer"))
+
+
+def benchmarkTranscriptParsing(directory, times=20):
+    '''
+        Peak Python memory of segmenting the transcript repeated to a long recording,
+        loaded as a whole and parsed as a stream of items
+    '''
+    with open(os.path.join(directory, 'raw_transcript.json')) as f_in:
+        transcript_json = json.load(f_in)
+    items = transcript_json["results"]["items"]
+    duration = max(float(item["end_time"]) for item in items if "end_time" in item) + 5.0
+    repeated_items = []
+    for repetition in range(times):
+        for item in items:
+            item = copy.deepcopy(item)
+            for time_key in ("start_time", "end_time"):
+                if time_key in item:
+                    item[time_key] = "%.2f" % (float(item[time_key]) + repetition * duration)
+            repeated_items.append(item)
+    transcript_json["results"]["items"] = repeated_items
+    transcript_json["results"]["transcripts"] = [{"transcript": ""}]
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        transcript_path = os.path.join(output_directory, 'raw_transcript.json')
+        with open(transcript_path, 'w') as fp:
+            json.dump(transcript_json, fp)
+        del transcript_json, repeated_items
+
+        def loadWhole():
+            with open(transcript_path) as f_in:
+                return sum(1 for utterance in app.iterUtterances(json.load(f_in)["results"]["items"]))
+
+        def parseStream():
+            return sum(1 for utterance in app.iterUtterances(app.readTranscriptItems(transcript_path)))
+
+        peaks = {}
+        for name, function in (("json.load", loadWhole), ("stream", parseStream)):
+            tracemalloc.start()
+            started = time.perf_counter()
+            count = function()
+            seconds = time.perf_counter() - started
+            peaks[name] = (seconds, tracemalloc.get_traced_memory()[1], count)
+            tracemalloc.stop()
+    parser = "ijson" if app.ijson is not None else "json module"
+    print(f"  transcript {times}x      json.load {peaks['json.load'][0]*1000:8.2f} ms {peaks['json.load'][1]/1048576:7.1f} MB   stream ({parser}) {peaks['stream'][0]*1000:8.2f} ms {peaks['stream'][1]/1048576:7.1f} MB peak")
+
+
+def benchmarkRebuild(directory, repeat):
+    '''
+        Parsing of the raw responses to the annotation in offline mode, without any AWS client
+    '''
+    app.offline_mode = True
+    app.print = lambda *args, **kwargs: None
+    try:
+        with tempfile.TemporaryDirectory() as output_directory:
+            rebuild_time, _ = measure(lambda: app.rebuildAnnotation(directory, output_directory), repeat)
+    finally:
+        del app.print
+        app.offline_mode = False
+    print(f"  rebuildAnnotation()  {rebuild_time*1000:9.2f} ms")
+
+
+def benchmarkBatchTranslation(directory):
+    '''
+        Translation of the utterances with a request per utterance and with one batch job against local stand-ins
+        for S3 and Translate
+    '''
+    annotation = loadAnnotation(directory)
+    expected = [utterance["translation"] for utterance in annotation["utterances"]]
+    for service in app.rate_limiters:
+        app.rate_limiters[service] = app.RateLimiter(0)
+    client = FakeEnrichmentClient(annotation["utterances"], latency=0)
+    for utterance in annotation["utterances"]:
+        app.translateText(utterance["text"], client)
+    s3 = LocalS3()
+    batch_client = LocalBatchTranslate(annotation["utterances"], s3)
+    job_tracker = app.JobTracker(min_interval=0.01, max_interval=0.01)
+    app.print = lambda *args, **kwargs: None
+    try:
+        started = time.perf_counter()
+        app.translateUtterancesBatch([{"text": utterance["text"]} for utterance in annotation["utterances"]], job_tracker, "benchmark_"+os.path.basename(directory),
+            translate_client=batch_client, s3_client=s3)
+        batch_time = time.perf_counter() - started
+    finally:
+        del app.print
+    distinct = len(set(utterance["text"] for utterance in annotation["utterances"]))
+    print(f"  batch translation    {sum(client.calls.values())} translate_text requests for {len(expected)} utterances ({distinct} distinct) replaced by 1 job in {batch_time*1000:8.2f} ms "
+        f"({sum(batch_client.calls.values())} requests)")
+
+
+def benchmarkEnrichment(directory, latency):
+    annotation = loadAnnotation(directory)
+    timings = {}
+    # The configured service rate limits would dominate the simulated latency
+    for service in app.rate_limiters:
+        app.rate_limiters[service] = app.RateLimiter(0)
+    for max_workers in (1, app.enrichment_max_workers):
+        client = FakeEnrichmentClient(annotation["utterances"], latency=latency, throttle_every=17, fail_every=23)
+        utterances = [{"text": utterance["text"]} for utterance in annotation["utterances"]]
+        started = time.perf_counter()
+        utterances = app.enrichUtterances(utterances, translate_client=client, comprehend_client=client, max_workers=max_workers)
+        timings[max_workers] = time.perf_counter() - started
+    sequential = timings[1]
+    parallel = timings[app.enrichment_max_workers]
+    comprehend_calls = sum(calls for operation, calls in client.calls.items() if operation.startswith("batch_"))
+    print(f"  enrichment           1 worker {sequential:8.2f} s   {app.enrichment_max_workers} workers {parallel:8.2f} s   speedup {sequential/parallel:6.1f}x")
+    print(f"  comprehend requests  {comprehend_calls} batch requests for {3*len(utterances)} utterance analyses")
+
+    # Second run over the same utterances answered from the result cache
+    with tempfile.TemporaryDirectory() as cache_directory:
+        app.result_cache = app.ResultCache(os.path.join(cache_directory, "cache.sqlite"), app.cache_max_bytes)
+        try:
+            for run in ("first", "cached"):
+                client = FakeEnrichmentClient(annotation["utterances"], latency=latency)
+                utterances = [{"text": utterance["text"]} for utterance in annotation["utterances"]]
+                started = time.perf_counter()
+                app.enrichUtterances(utterances, translate_client=client, comprehend_client=client)
+                print(f"  enrichment {run:9} {time.perf_counter() - started:8.2f} s   {sum(client.calls.values())} requests")
+        finally:
+            app.result_cache.close()
+            app.result_cache = None
+
+
+def benchmarkSpacyAnalyzer(directory, model, times=20):
+    '''
+        Analyzes the utterances of an example repeated times often with the spaCy analyzer on one and on all processors
+    '''
+    if app.spacy is None:
+        print("  spacy analyzer       skipped, spacy is not installed")
+        return
+    try:
+        analyzers = {processes: app.SpacyAnalyzer(model, processes) for processes in (1, os.cpu_count() or 1)}
+    except OSError:
+        print("  spacy analyzer       skipped, pipeline "+model+" is not installed")
+        return
+    texts = [utterance["text"] for utterance in loadAnnotation(directory)["utterances"]] * times
+    timings = {}
+    for processes, analyzer in analyzers.items():
+        started = time.perf_counter()
+        analyzer.analyze(texts, None)
+        timings[processes] = time.perf_counter() - started
+    sequential = timings[1]
+    parallel = timings[max(timings)]
+    print(f"  spacy analyzer {times}x   1 process {sequential:8.2f} s   {max(timings)} processes {parallel:8.2f} s   speedup {sequential/parallel:6.1f}x   {len(texts)/parallel:8.0f} utterances/s")
+
+
+def benchmarkJobTracking():
+    '''
+        Adaptive polling, notifications and a fixed polling loop waiting for the jobs of a short clip and of a long recording
+    '''
+    for scenario, finish_times in job_scenarios.items():
+        print("job tracking (simulated "+scenario+")")
+        fixed_dead_time, fixed_requests = simulateFixedPolling(finish_times)
+        print(f"  fixed 15 s polling   dead time {fixed_dead_time:6.1f} s   status requests {fixed_requests}")
+        app.print = lambda *args, **kwargs: None
+        try:
+            clock = SimulatedClock()
+            dead_time, requests = simulateJobTracking(finish_times, None, clock)
+            print(f"  adaptive polling     dead time {dead_time:6.1f} s   status requests {requests}")
+            clock = SimulatedClock()
+            notification_dead_time, notification_requests = simulateJobTracking(finish_times, FakeNotificationQueue(clock, finish_times), clock)
+            print(f"  notifications        dead time {notification_dead_time:6.1f} s   status requests {notification_requests}")
+        finally:
+            del app.print
+
+
+def benchmarkAnnotationLoading(directory, times=20):
+    '''
+        Load time and retained Python memory of the annotation repeated to a long recording,
+        as json dicts, as columnar model parsed from the json file and as model read from the binary file
+    '''
+    annotation = repeatAnnotation(loadAnnotation(directory), times)
+    with tempfile.TemporaryDirectory() as output_directory:
+        json_path = os.path.join(output_directory, 'annotation.json')
+        binary_path = os.path.join(output_directory, 'annotation.bin')
+        with open(json_path, 'w') as fp:
+            json.dump(annotation, fp)
+        app.AnnotationModel.fromDict(annotation).save(binary_path)
+
+        def loadJson():
+            with open(json_path) as f_in:
+                return json.load(f_in)
+
+        results = {}
+        for name, function in (("json", loadJson), ("model", lambda: app.loadAnnotationModel(json_path)), ("binary", lambda: app.loadAnnotationModel(binary_path))):
+            tracemalloc.start()
+            started = time.perf_counter()
+            loaded = function()
+            seconds = time.perf_counter() - started
+            results[name] = (seconds, tracemalloc.get_traced_memory()[0], loaded)
+            tracemalloc.stop()
+        json_size, binary_size = os.path.getsize(json_path), os.path.getsize(binary_path)
+    print(f"  annotation {times}x      json {results['json'][0]*1000:8.2f} ms {results['json'][1]/1048576:6.1f} MB   model {results['model'][0]*1000:8.2f} ms {results['model'][1]/1048576:6.1f} MB   binary {results['binary'][0]*1000:8.2f} ms {results['binary'][1]/1048576:6.1f} MB   file {json_size/1048576:5.1f} MB -> {binary_size/1048576:5.1f} MB")
+
+
+def benchmarkLabelAggregation(directory, repeat):
+    '''
+        Size of annotation.json and of the TEI file and the time writing the TEI file with one label per sample and with label ranges
+    '''
+    results = {}
+    app.offline_mode = True
+    app.print = lambda *args, **kwargs: None
+    try:
+        for aggregate in (False, True):
+            app.aggregate_labels = aggregate
+            with tempfile.TemporaryDirectory() as output_directory:
+                annotation = app.rebuildAnnotation(directory, output_directory)
+                tei_path = os.path.join(output_directory, 'annotation.xml')
+                tei_time, _ = measure(lambda: app.saveTeiFile(app.getAnnotationPath(output_directory), tei_path), repeat)
+                results[aggregate] = (len(annotation["detected_labels"]), os.path.getsize(os.path.join(output_directory, 'annotation.json')), os.path.getsize(tei_path), tei_time)
+    finally:
+        del app.print
+        app.offline_mode = False
+        app.aggregate_labels = False
+    for aggregate, name in ((False, "per sample"), (True, "ranges")):
+        labels, annotation_size, tei_size, tei_time = results[aggregate]
+        print(f"  labels {name:13} {labels:6} labels   annotation.json {annotation_size/1024:7.1f} KB   TEI {tei_size/1024:7.1f} KB written in {tei_time*1000:8.2f} ms")
+
+
+def scaleExample(directory, raw_directory, hours) -> float:
+    '''
+        Writes the raw responses of an example played again and again to a recording of at least the given hours,
+        one result page per repetition, and an annotation holding the analyses of the repeated utterances
+        so the annotation can be rebuilt offline, returns the hours of the synthetic recording
+    '''
+    annotation = loadAnnotation(directory)
+    duration_ms = round(annotation["Metadata"]["Duration"] * 1000)
+    repetitions = max(1, -(-round(hours * 3600000) // duration_ms))
+
+    with open(os.path.join(directory, 'raw_transcript.json')) as f_in:
+        transcript_json = json.load(f_in)
+    items = []
+    for repetition in range(repetitions):
+        for item in transcript_json["results"]["items"]:
+            item = dict(item)
+            for time_key in ("start_time", "end_time"):
+                if time_key in item:
+                    item[time_key] = app.shiftTime(item[time_key], repetition * duration_ms)
+            items.append(item)
+    transcript_json["results"]["items"] = items
+    transcript_json["results"]["transcripts"] = [{"transcript": ""}]
+    with open(os.path.join(raw_directory, 'raw_transcript.json'), 'w') as fp:
+        json.dump(transcript_json, fp)
+
+    # Utterances spanning two repetitions have no analyses in the example and are left unannotated
+    analyses = {utterance["text"]: utterance for utterance in annotation["utterances"]}
+    utterances = []
+    for utterance in app.iterUtterances(items):
+        analysis = analyses.get(utterance["text"], {"translation": utterance["text"], "entities": [], "sentiment": "NEUTRAL", "syntax": []})
+        for key in ("translation", "entities", "sentiment", "syntax"):
+            utterance[key] = analysis[key]
+        utterances.append(utterance)
+    del transcript_json, items
+    with open(os.path.join(raw_directory, 'annotation.json'), 'w') as fp:
+        json.dump({"utterances": utterances, "Metadata": annotation["Metadata"]}, fp)
+    del utterances
+
+    for job_name, (results_key, time_keys) in app.rekognition_result_times.items():
+        with open(os.path.join(directory, app.raw_response_names[job_name]+".json")) as f_in:
+            response = json.load(f_in)
+        # Segment detection returns a list of the metadata of each video stream
+        video_metadata = response["VideoMetadata"]
+        for metadata in video_metadata if isinstance(video_metadata, list) else [video_metadata]:
+            metadata["DurationMillis"] = duration_ms * repetitions
+        shots = sum(1 for result in response[results_key] if result.get("Type") == "SHOT")
+        with open(os.path.join(raw_directory, app.raw_response_names[job_name]+".jsonl"), 'w') as spool:
+            for repetition in range(repetitions):
+                page = dict(response)
+                page["NextToken"] = "page"+str(repetition + 1)
+                page[results_key] = []
+                for result in response[results_key]:
+                    result = copy.deepcopy(result)
+                    for time_key in time_keys:
+                        result[time_key] = result[time_key] + repetition * duration_ms
+                    if repetition > 0 and "ShotSegment" in result:
+                        result["ShotSegment"]["Index"] = result["ShotSegment"]["Index"] + repetition * shots
+                    # Opening credits reach back to the start of the recording
+                    if repetition > 0 and result.get("TechnicalCueSegment", {}).get("Type") == "OpeningCredits":
+                        result["TechnicalCueSegment"]["Type"] = "Content"
+                    page[results_key].append(result)
+                if repetition == repetitions - 1:
+                    del page["NextToken"]
+                spool.write(json.dumps(page)+"\n")
+    return duration_ms * repetitions / 3600000
+
+
+def runScaledStage(stage, raw_directory) -> tuple:
+    '''
+        Runs a stage on a synthetic recording in a fresh worker process,
+        returns the seconds and the peak resident memory of the process in KB
+    '''
+    app.offline_mode = True
+    app.cache_file_path = ""
+    app.print = lambda *args, **kwargs: None
+    started = time.perf_counter()
+    if stage == "segmentation":
+        sum(1 for utterance in app.iterUtterances(app.readTranscriptItems(os.path.join(raw_directory, 'raw_transcript.json'))))
+    elif stage == "annotation":
+        app.rebuildAnnotation(raw_directory)
+    elif stage == "createTeiFile":
+        app.writeTeiFile(app.createTeiFile(app.getAnnotationPath(raw_directory)), os.path.join(raw_directory, 'annotation.xml'))
+    return time.perf_counter() - started, peakMemory()
+
+
+def benchmarkScaling(directory, hours_list, max_growth) -> list:
+    '''
+        Segmentation, annotation building and createTeiFile() on the example scaled to recordings of several hours,
+        each stage runs in its own process, returns the stages whose time per hour of video grows more than max_growth times
+        from the shortest to the longest recording, a sign of quadratic behaviour
+    '''
+    stages = ("segmentation", "annotation", "createTeiFile")
+    seconds_per_hour = {}
+    for hours in hours_list:
+        with tempfile.TemporaryDirectory() as raw_directory:
+            video_hours = scaleExample(directory, raw_directory, hours)
+            results = {}
+            for stage in stages:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    results[stage] = executor.submit(runScaledStage, stage, raw_directory).result()
+                seconds_per_hour.setdefault(stage, []).append(results[stage][0] / video_hours)
+        print(f"  scaled to {video_hours:5.1f} h   "+"   ".join(f"{stage} {seconds:8.2f} s {memory/1024:7.1f} MB" for stage, (seconds, memory) in results.items())+" peak RSS")
+
+    failed = []
+    if len(hours_list) > 1:
+        growth = {stage: values[-1] / max(values[0], 1e-9) for stage, values in seconds_per_hour.items()}
+        print(f"  growth of the time per hour from {hours_list[0]} h to {hours_list[-1]} h   "+"   ".join(f"{stage} {ratio:5.2f}x" for stage, ratio in growth.items()))
+        failed = [directory+" "+stage for stage, ratio in growth.items() if ratio > max_growth]
+    return failed
+
+
+def benchmarkChunkMerge(directory, chunk_seconds=120, overlap_seconds=30):
+    '''
+        Splits the raw responses of an example into overlapping chunks starting at shot boundaries like the chunked mode does
+        and merges them again
+    '''
+    chunks = planExampleChunks(directory, chunk_seconds, overlap_seconds)
+    chunk_items, chunk_pages = splitExample(directory, chunks)
+
+    app.print = lambda *args, **kwargs: None
+    try:
+        with tempfile.TemporaryDirectory() as merged_directory:
+            started = time.perf_counter()
+            items = app.mergeTranscriptItems(chunk_items, chunks)
+            app.saveMergedTranscript(items, os.path.join(merged_directory, 'raw_transcript.json'), "merged")
+            for job_name, pages in chunk_pages.items():
+                with open(os.path.join(merged_directory, app.raw_response_names[job_name]+".jsonl"), 'w') as spool:
+                    spool.write(json.dumps(app.mergeRekognitionPages(job_name, pages, chunks))+"\n")
+            merge_time = time.perf_counter() - started
+    finally:
+        del app.print
+    print(f"  chunk merge          {len(chunks)} chunks of {chunk_seconds} s with {overlap_seconds} s overlap merged in {merge_time*1000:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local code paths against the bundled examples")
+    parser.add_argument("directories", nargs="*", default=example_directories)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated AWS request latency in seconds for the enrichment benchmark")
+    parser.add_argument("--hours", type=float, nargs="*", default=[1, 5, 20], help="hours of the synthetic recordings the examples are scaled to, none skips the scaling benchmark")
+    parser.add_argument("--spacy-model", default=app.spacy_model, help="spaCy pipeline name or path of the spaCy analyzer benchmark")
+    parser.add_argument("--max-growth", type=float, default=3.0, help="largest accepted growth of the time per hour of video from the shortest to the longest synthetic recording")
+    args = parser.parse_args()
+
+    # Results cached by earlier runs would hide the request latency
+    app.cache_file_path = ""
+
+    failed = []
+    for directory in args.directories:
+        print(directory)
+        benchmarkShotBucketing(directory, args.repeat)
+        benchmarkTranscriptParsing(directory)
+        benchmarkRebuild(directory, args.repeat)
+        benchmarkCreateTeiFile(directory, args.repeat)
+        benchmarkAnnotationLoading(directory)
+        benchmarkLabelAggregation(directory, args.repeat)
+        benchmarkTeiWriters(directory)
+        benchmarkTeiFragments(directory)
+        benchmarkTeiFragments(directory, times=80, single_cue=True)
+        benchmarkEnrichment(directory, args.latency)
+        benchmarkBatchTranslation(directory)
+        benchmarkSpacyAnalyzer(directory, args.spacy_model)
+        benchmarkChunkMerge(directory)
+        failed.extend(benchmarkScaling(directory, sorted(args.hours), args.max_growth))
+    benchmarkJobTracking()
+    if failed:
+        print("Time per hour of video grows faster than linear for: "+", ".join(failed))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
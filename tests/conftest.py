@@ -0,0 +1,31 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def no_result_cache(monkeypatch):
+    # Results cached by earlier runs would answer the requests the tests count
+    monkeypatch.setattr(app, "cache_file_path", "")
+    monkeypatch.setattr(app, "result_cache", None)
+
+
+@pytest.fixture
+def no_rate_limits(monkeypatch):
+    for service in list(app.rate_limiters):
+        monkeypatch.setitem(app.rate_limiters, service, app.RateLimiter(0))
+    # Throttled requests are retried at once
+    monkeypatch.setattr(app.random, "uniform", lambda low, high: 0.0)
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    monkeypatch.setattr(app, "offline_mode", True)
+
+
+@pytest.fixture
+def result_cache(monkeypatch, tmp_path):
+    cache = app.ResultCache(str(tmp_path / "cache.sqlite"), app.cache_max_bytes)
+    monkeypatch.setattr(app, "result_cache", cache)
+    yield cache
+    cache.close()
@@ -0,0 +1,170 @@
+import os
+import copy
+import json
+
+import app
+
+'''
+    The bundled examples, recordings built from them and reference implementations the tests and the benchmarks compare against
+'''
+
+example_root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+example_directories = [
+    os.path.join(example_root, "dw548"),
+    os.path.join(example_root, "dw694"),
+    os.path.join(example_root, "dw750"),
+]
+
+
+def loadAnnotation(directory) -> dict:
+    with open(os.path.join(directory, 'annotation.json')) as f_in:
+        return json.load(f_in)
+
+
+def repeatAnnotation(annotation, times) -> dict:
+    '''
+        Builds the annotation of a recording as long as the given one played times times in a row
+    '''
+    duration = annotation["Metadata"]["Duration"]
+    time_keys = {
+        "utterances": ("start", "end"),
+        "detected_cues": ("start", "end"),
+        "detected_shots": ("start", "end"),
+        "detected_text": ("timestamp",),
+        "detected_labels": ("timestamp",),
+        "detected_celebrities": ("timestamp",),
+    }
+    repeated = copy.deepcopy(annotation)
+    for key, item_time_keys in time_keys.items():
+        repeated[key] = []
+        for repetition in range(times):
+            for item in annotation[key]:
+                item = dict(item)
+                for time_key in item_time_keys:
+                    item[time_key] = "%.2f" % (float(item[time_key]) + repetition * duration)
+                # Opening credits reach back to the start of the recording
+                if item.get("type") == "OpeningCredits" and repetition > 0:
+                    item["type"] = "Content"
+                repeated[key].append(item)
+    repeated["Metadata"]["Duration"] = duration * times
+    return repeated
+
+
+def joinCues(annotation) -> dict:
+    '''
+        Replaces the cues of an annotation by a single cue over the whole recording, like a long recording without technical cues
+    '''
+    duration = "%.2f" % annotation["Metadata"]["Duration"]
+    return dict(annotation, detected_cues=[{"start": "0.00", "end": duration, "dur": duration, "type": "Content"}])
+
+
+def naiveShotBuckets(annotation) -> list:
+    '''
+        Reference implementation of the shot/cue matching as nested full scans
+        over the string timestamps, like createTeiFile() did before the time index,
+        returns the list positions of the matched items
+    '''
+    buckets = []
+    for cue in annotation["detected_cues"]:
+        cue_start = float(cue["start"])
+        if cue["type"] == "OpeningCredits":
+            cue_start = 0.0
+        cue_end = float(cue["end"])
+        for shot_position, shot in enumerate(annotation["detected_shots"]):
+            if float(shot["start"]) >= cue_start and float(shot["end"]) <= cue_end:
+                shot_start = float(shot["start"])
+                shot_end = float(shot["end"])
+                bucket = [shot_position]
+                for key in ("detected_text", "detected_labels", "detected_celebrities"):
+                    for position, detection in enumerate(annotation[key]):
+                        if float(detection["timestamp"]) >= shot_start and float(detection["timestamp"]) <= shot_end:
+                            bucket.append(position)
+                buckets.append(bucket)
+        bucket = []
+        for position, utterance in enumerate(annotation["utterances"]):
+            if float(utterance["start"]) >= cue_start and float(utterance["start"]) <= cue_end:
+                bucket.append(position)
+        buckets.append(bucket)
+    return buckets
+
+
+def indexedShotBuckets(model) -> list:
+    '''
+        The same matching as naiveShotBuckets() on the annotation model with the time indexes the TEI writers use
+    '''
+    time_indexes = app.buildTimeIndexes(model)
+    cues = model.tables["detected_cues"]
+    shots = model.tables["detected_shots"]
+
+    buckets = []
+    for row in range(model.rows("detected_cues")):
+        cue_start = cues["start_ms"][row]
+        if model.strings["detected_cues.type"][cues["type"][row]] == "OpeningCredits":
+            cue_start = 0
+        cue_end = cues["end_ms"][row]
+        for shot_row in app.getRowsInRange(time_indexes["detected_shots"], cue_start, cue_end):
+            if shots["end_ms"][shot_row] > cue_end:
+                continue
+            bucket = [shot_row]
+            for key in ("detected_text", "detected_labels", "detected_celebrities"):
+                bucket.extend(app.getRowsInRange(time_indexes[key], shots["start_ms"][shot_row], shots["end_ms"][shot_row]))
+            buckets.append(bucket)
+        buckets.append(app.getRowsInRange(time_indexes["utterances"], cue_start, cue_end))
+    return buckets
+
+
+def splitExample(directory, chunks) -> tuple:
+    '''
+        Splits the raw responses of an example into the responses the jobs of the chunks would return,
+        words and detections inside a chunk and segments cut at its ends, all with times relative to the chunk start,
+        returns the transcript items and the result pages of each Rekognition job for each chunk
+    '''
+    with open(os.path.join(directory, 'raw_transcript.json')) as f_in:
+        items = json.load(f_in)["results"]["items"]
+    chunk_items = []
+    for chunk in chunks:
+        chunk_items.append([])
+        inside = False
+        for item in items:
+            if "start_time" in item:
+                inside = chunk["start_ms"] <= app.toMilliseconds(item["start_time"]) and app.toMilliseconds(item["end_time"]) <= chunk["end_ms"]
+            if inside:
+                item = dict(item)
+                for time_key in ("start_time", "end_time"):
+                    if time_key in item:
+                        item[time_key] = app.shiftTime(item[time_key], -chunk["start_ms"])
+                chunk_items[-1].append(item)
+
+    chunk_pages = {}
+    for job_name, (results_key, time_keys) in app.rekognition_result_times.items():
+        response = next(app.readRawPages(directory, job_name))
+        chunk_pages[job_name] = []
+        for chunk in chunks:
+            page = copy.deepcopy(response)
+            page[results_key] = []
+            for result in response[results_key]:
+                result = copy.deepcopy(result)
+                if len(time_keys) == 2:
+                    start, end = max(result[time_keys[0]], chunk["start_ms"]), min(result[time_keys[1]], chunk["end_ms"])
+                    if start >= end:
+                        continue
+                    result[time_keys[0]], result[time_keys[1]] = start - chunk["start_ms"], end - chunk["start_ms"]
+                    result["DurationMillis"] = end - start
+                elif chunk["start_ms"] <= result[time_keys[0]] < chunk["end_ms"]:
+                    result[time_keys[0]] = result[time_keys[0]] - chunk["start_ms"]
+                else:
+                    continue
+                page[results_key].append(result)
+            chunk_pages[job_name].append([page])
+    return chunk_items, chunk_pages
+
+
+def planExampleChunks(directory, chunk_seconds=120, overlap_seconds=30) -> list:
+    '''
+        Plans the chunks of an example starting at its shot boundaries like the chunked mode does
+    '''
+    segments = next(app.readRawPages(directory, "segment_detection"))["Segments"]
+    keyframes = sorted(segment["StartTimestampMillis"] for segment in segments if segment["Type"] == "SHOT")
+    return app.planChunks(round(loadAnnotation(directory)["Metadata"]["Duration"] * 1000), keyframes, chunk_seconds * 1000, overlap_seconds * 1000)
+
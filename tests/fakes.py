@@ -0,0 +1,210 @@
+import io
+import os
+import copy
+import time
+import threading
+from lxml import etree
+
+import app
+
+'''
+    Local stand-ins for the AWS clients and the notification queue, used by the tests and the benchmarks
+'''
+
+
+class FakeThrottlingError(Exception):
+    response = {"Error": {"Code": "ThrottlingException"}}
+
+
+class FakeEnrichmentClient:
+    '''
+        Local stand-in for the Translate and Comprehend clients, answers with the analysis stored
+        in an annotation.json after a fixed latency, throttles every n-th request and fails
+        every n-th batch document
+    '''
+    def __init__(self, utterances, latency=0.05, throttle_every=0, fail_every=0):
+        self.utterances = {utterance["text"]: utterance for utterance in utterances}
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.fail_every = fail_every
+        self.calls = {}
+        self.documents = 0
+        self.lock = threading.Lock()
+
+    def respond(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = self.throttle_every and sum(self.calls.values()) % self.throttle_every == 0
+        time.sleep(self.latency)
+        if throttled:
+            raise FakeThrottlingError()
+
+    def respondBatch(self, operation, TextList, result):
+        self.respond(operation)
+        response = {"ResultList": [], "ErrorList": []}
+        for index, text in enumerate(TextList):
+            with self.lock:
+                self.documents = self.documents + 1
+                failed = self.fail_every and self.documents % self.fail_every == 0
+            if failed:
+                response["ErrorList"].append({"Index": index, "ErrorCode": "InternalServerException"})
+            else:
+                response["ResultList"].append(dict(result(self.utterances[text]), Index=index))
+        return response
+
+    def translate_text(self, Text, SourceLanguageCode, TargetLanguageCode):
+        self.respond("translate_text")
+        return {"TranslatedText": self.utterances[Text]["translation"]}
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        return self.respondBatch("batch_detect_entities", TextList, lambda utterance: {"Entities": copy.deepcopy(utterance["entities"])})
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        return self.respondBatch("batch_detect_sentiment", TextList, lambda utterance: {"Sentiment": utterance["sentiment"], "SentimentScore": {}})
+
+    def batch_detect_syntax(self, TextList, LanguageCode):
+        return self.respondBatch("batch_detect_syntax", TextList, lambda utterance: {"SyntaxTokens": copy.deepcopy(utterance["syntax"])})
+
+
+class LocalS3:
+    '''
+        Local stand-in for the S3 client keeping the objects in memory
+    '''
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {"Contents": [{"Key": key} for bucket, key in sorted(self.objects) if bucket == Bucket and key.startswith(Prefix)]}
+
+
+class LocalBatchTranslate(FakeEnrichmentClient):
+    '''
+        Local stand-in for the Translate client, batch jobs translate the HTML documents in the local S3
+        with the translations stored in an annotation.json and are finished at the first status request
+    '''
+    def __init__(self, utterances, s3, latency=0.0):
+        super().__init__(utterances, latency)
+        self.s3 = s3
+        self.jobs = {}
+
+    def start_text_translation_job(self, JobName, InputDataConfig, OutputDataConfig, DataAccessRoleArn, SourceLanguageCode, TargetLanguageCodes):
+        self.respond("start_text_translation_job")
+        job_id = "%032x" % len(self.jobs)
+        bucket, input_prefix = InputDataConfig["S3Uri"][len("s3://"):].split("/", 1)
+        output_prefix = OutputDataConfig["S3Uri"][len("s3://"):].split("/", 1)[1]
+        for (object_bucket, key), document in list(self.s3.objects.items()):
+            if object_bucket != bucket or not key.startswith(input_prefix):
+                continue
+            html = etree.fromstring(document, etree.HTMLParser(encoding="utf-8"))
+            for paragraph in html.iter("p"):
+                paragraph.text = self.utterances[paragraph.text]["translation"]
+            for language in TargetLanguageCodes:
+                self.s3.put_object(bucket, output_prefix+"123456789012-TranslateText-"+job_id+"/"+language+"."+os.path.basename(key),
+                    etree.tostring(html, encoding="UTF-8", method="html"))
+        self.jobs[job_id] = {"JobId": job_id, "JobName": JobName, "JobStatus": "COMPLETED", "OutputDataConfig": OutputDataConfig}
+        return {"JobId": job_id, "JobStatus": "SUBMITTED"}
+
+    def describe_text_translation_job(self, JobId):
+        self.respond("describe_text_translation_job")
+        return {"TextTranslationJobProperties": self.jobs[JobId]}
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = self.now + seconds
+
+
+class FakeNotificationQueue:
+    '''
+        Local stand-in for the SQS notification queue, delivers a notification for each job
+        at its simulated finish time
+    '''
+    def __init__(self, clock, finish_times):
+        self.clock = clock
+        self.finish_times = finish_times
+        self.delivered = set()
+
+    def receive(self, job_ids, wait_seconds) -> list:
+        pending = [finish_time for job_id, finish_time in self.finish_times.items() if job_id in job_ids and job_id not in self.delivered]
+        if not pending or min(pending) > self.clock.now + wait_seconds:
+            self.clock.sleep(wait_seconds)
+            return []
+        self.clock.now = max(self.clock.now, min(pending))
+        notifications = []
+        for job_id, finish_time in self.finish_times.items():
+            if job_id in job_ids and job_id not in self.delivered and finish_time <= self.clock.now:
+                self.delivered.add(job_id)
+                notifications.append((job_id, "SUCCEEDED"))
+        return notifications
+
+
+def simulateJobTracking(finish_times, notification_queue, clock) -> tuple:
+    '''
+        Function to wait for simulated jobs with the JobTracker of app.py,
+        returns the summed time between job end and its detection and the number of status requests
+    '''
+    requests = []
+    detected = {}
+
+    def poll(job_id):
+        requests.append(job_id)
+        if clock.now >= finish_times[job_id]:
+            detected[job_id] = clock.now
+            return "SUCCEEDED", {}
+        return "IN_PROGRESS", {}
+
+    job_tracker = app.JobTracker(notification_queue, clock=clock.time, sleep=clock.sleep)
+    for job_id in finish_times:
+        job_tracker.add(job_id, job_id, lambda job_id=job_id: poll(job_id))
+    job_tracker.waitFor(list(finish_times))
+    return sum(detected[job_id] - finish_times[job_id] for job_id in finish_times), len(requests)
+
+
+def simulateFixedPolling(finish_times, interval=15) -> tuple:
+    '''
+        The same simulation for a loop requesting every job every 15 seconds
+    '''
+    now = 0.0
+    requests = 0
+    detected = {}
+    while len(detected) < len(finish_times):
+        now = now + interval
+        for job_id, finish_time in finish_times.items():
+            requests = requests + 1
+            if now >= finish_time and job_id not in detected:
+                detected[job_id] = now
+    return sum(detected[job_id] - finish_times[job_id] for job_id in finish_times), requests
+
+
+# Finish times in seconds of the jobs of the simulated recordings
+job_scenarios = {
+    "short clip": {
+        "transcription": 21.0,
+        "label_detection": 34.0,
+        "segment_detection": 18.0,
+        "text_detection": 41.0,
+        "celebrity_recognition": 27.0,
+    },
+    "1 hour recording": {
+        "transcription": 1140.0,
+        "label_detection": 1530.0,
+        "segment_detection": 610.0,
+        "text_detection": 1720.0,
+        "celebrity_recognition": 1290.0,
+    },
+}
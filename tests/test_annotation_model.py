@@ -0,0 +1,42 @@
+import pytest
+
+import app
+from tests.corpus import example_directories, loadAnnotation, repeatAnnotation
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_binary_annotation_equals_json_annotation(directory, tmp_path):
+    model = app.AnnotationModel.fromDict(loadAnnotation(directory))
+    binary_path = str(tmp_path / "annotation.bin")
+    model.save(binary_path)
+    assert app.loadAnnotationModel(binary_path).toDict() == model.toDict()
+
+
+def test_binary_annotation_needs_the_magic_bytes(tmp_path):
+    path = tmp_path / "annotation.bin"
+    path.write_bytes(b"{}")
+    with pytest.raises(Exception, match="no binary annotation"):
+        app.AnnotationModel.load(str(path))
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_json_annotation_round_trip(directory):
+    annotation = loadAnnotation(directory)
+    assert app.AnnotationModel.fromDict(annotation).toDict() == annotation
+
+
+def test_strings_are_stored_once_per_column():
+    model = app.AnnotationModel.fromDict(repeatAnnotation(loadAnnotation(example_directories[0]), 3))
+    assert len(model.strings["detected_labels.label_name"]) == len(set(model.column("detected_labels", "label_name")))
+    assert model.rows("detected_labels") == 3 * len(loadAnnotation(example_directories[0])["detected_labels"])
+
+
+def test_unknown_binary_version_is_rejected(tmp_path):
+    path = str(tmp_path / "annotation.bin")
+    app.AnnotationModel.fromDict(loadAnnotation(example_directories[0])).save(path)
+    with open(path, 'rb') as f_in:
+        data = f_in.read()
+    with open(path, 'wb') as fp:
+        fp.write(data.replace(b'"version": 1', b'"version": 2', 1))
+    with pytest.raises(Exception, match="version 2"):
+        app.AnnotationModel.load(path)
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+
+import app
+
+
+def test_put_get_and_contains(tmp_path):
+    cache = app.ResultCache(str(tmp_path / "cache.sqlite"), app.cache_max_bytes)
+    try:
+        assert cache.get("translate_text", "Hallo") is None
+        assert not cache.contains("translate_text", "Hallo")
+        cache.put({"TranslatedText": "Hello"}, "translate_text", "Hallo")
+        assert cache.get("translate_text", "Hallo") == {"TranslatedText": "Hello"}
+        assert cache.contains("translate_text", "Hallo")
+    finally:
+        cache.close()
+
+
+def test_results_survive_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = app.ResultCache(path, app.cache_max_bytes)
+    cache.put(["a", 1], "key")
+    cache.close()
+    cache = app.ResultCache(path, app.cache_max_bytes)
+    try:
+        assert cache.get("key") == ["a", 1]
+        assert cache.total_bytes > 0
+    finally:
+        cache.close()
+
+
+def test_reads_are_written_on_close(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = app.ResultCache(path, app.cache_max_bytes)
+    cache.put(1, "first")
+    cache.put(2, "second")
+    cache.get("first")
+    assert cache.accessed
+    cache.close()
+    connection = sqlite3.connect(path)
+    order = [key for key, in connection.execute("SELECT key FROM results ORDER BY last_access")]
+    connection.close()
+    assert order == [cache.key(("second",)), cache.key(("first",))]
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = app.ResultCache(str(tmp_path / "cache.sqlite"), 10 ** 9)
+    try:
+        for number in range(3):
+            cache.put("x" * 1000 + str(number), "result", number)
+        # The oldest result was read last
+        cache.get("result", 0)
+        cache.max_bytes = cache.total_bytes
+        cache.put("x" * 1000 + "3", "result", 3)
+        assert cache.get("result", 1) is None
+        assert cache.get("result", 0) is not None
+        assert cache.get("result", 3) is not None
+    finally:
+        cache.close()
+
+
+def test_files_are_cached_next_to_the_database(tmp_path):
+    source = tmp_path / "raw_transcript.json"
+    source.write_bytes(b'{"results": {"items": []}}')
+    cache = app.ResultCache(str(tmp_path / "cache.sqlite"), app.cache_max_bytes)
+    try:
+        assert cache.getFile("transcript") is None
+        cache.putFile(str(source), "transcript")
+        source.unlink()
+        with open(cache.getFile("transcript"), 'rb') as f_in:
+            assert f_in.read() == b'{"results": {"items": []}}'
+        assert cache.get("transcript") is None
+        assert cache.total_bytes >= len(b'{"results": {"items": []}}')
+    finally:
+        cache.close()
+
+
+def test_evicted_files_are_removed(tmp_path):
+    source = tmp_path / "raw_transcript.json"
+    source.write_bytes(b"x" * 10000)
+    cache = app.ResultCache(str(tmp_path / "cache.sqlite"), 15000)
+    try:
+        cache.putFile(str(source), "first")
+        path = cache.getFile("first")
+        cache.putFile(str(source), "second")
+        assert cache.getFile("first") is None
+        assert not os.path.exists(path)
+        assert cache.getFile("second") is not None
+    finally:
+        cache.close()
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+import app
+from tests.corpus import example_directories, loadAnnotation, splitExample, planExampleChunks
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_merged_chunks_give_the_annotation_of_the_whole_recording(directory, offline, tmp_path):
+    chunks = planExampleChunks(directory)
+    assert len(chunks) > 1
+    chunk_items, chunk_pages = splitExample(directory, chunks)
+    merged_directory = tmp_path / "merged"
+    merged_directory.mkdir()
+    app.saveMergedTranscript(app.mergeTranscriptItems(chunk_items, chunks), str(merged_directory / 'raw_transcript.json'), "merged")
+    for job_name, pages in chunk_pages.items():
+        with open(merged_directory / (app.raw_response_names[job_name]+".jsonl"), 'w') as spool:
+            spool.write(json.dumps(app.mergeRekognitionPages(job_name, pages, chunks))+"\n")
+    with open(merged_directory / 'annotation.json', 'w') as fp:
+        json.dump(loadAnnotation(directory), fp)
+    merged = app.rebuildAnnotation(str(merged_directory))
+    original = app.rebuildAnnotation(directory, str(tmp_path))
+    for key in original:
+        if key != "Metadata":
+            assert merged[key] == original[key], key
+
+
+def test_chunks_overlap_and_cover_the_recording():
+    chunks = app.planChunks(600000, list(range(0, 600000, 7000)), 120000, 30000)
+    assert chunks[0]["start_ms"] == 0
+    assert chunks[-1]["end_ms"] == 600000
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk["start_ms"] < previous["end_ms"]
+        assert chunk["start_ms"] % 7000 == 0
+
+
+def test_long_shot_skips_the_nominal_start_inside_it():
+    # The shot from 100 s to 400 s covers the nominal starts at 240 s and 360 s
+    chunks = app.planChunks(600000, [0, 100000, 400000, 500000], 120000, 30000)
+    assert [chunk["start_ms"] for chunk in chunks] == [0, 100000, 400000]
+
+
+def test_recording_without_keyframes_is_one_chunk_with_a_warning(capsys):
+    chunks = app.planChunks(3600000, [], 600000, 30000)
+    assert chunks == [{"index": 0, "start_ms": 0, "end_ms": 3600000}]
+    assert "No keyframe after 00:00:00" in capsys.readouterr().out
@@ -0,0 +1,65 @@
+import pytest
+
+import app
+from tests.corpus import example_directories, loadAnnotation
+from tests.fakes import FakeEnrichmentClient, FakeThrottlingError
+
+
+def analyses(utterances) -> list:
+    return [(utterance["translation"], utterance["entities"], utterance["sentiment"], utterance["syntax"]) for utterance in utterances]
+
+
+@pytest.mark.parametrize("directory", example_directories)
+@pytest.mark.parametrize("max_workers", [1, app.enrichment_max_workers])
+def test_enrichment_retries_throttled_requests_and_failed_documents(directory, max_workers, no_rate_limits):
+    annotation = loadAnnotation(directory)
+    client = FakeEnrichmentClient(annotation["utterances"], latency=0, throttle_every=17, fail_every=23)
+    utterances = app.enrichUtterances([{"text": utterance["text"]} for utterance in annotation["utterances"]],
+        translate_client=client, comprehend_client=client, max_workers=max_workers)
+    assert analyses(utterances) == analyses(annotation["utterances"])
+
+
+def test_enrichment_translates_repeated_texts_once(no_rate_limits):
+    annotation = loadAnnotation(example_directories[0])
+    client = FakeEnrichmentClient(annotation["utterances"], latency=0)
+    utterances = app.enrichUtterances([{"text": utterance["text"]} for utterance in annotation["utterances"] * 2],
+        translate_client=client, comprehend_client=client)
+    assert client.calls["translate_text"] == len(set(utterance["text"] for utterance in annotation["utterances"]))
+    assert analyses(utterances) == analyses(annotation["utterances"]) * 2
+
+
+def test_cached_enrichment_sends_no_requests(no_rate_limits, result_cache):
+    annotation = loadAnnotation(example_directories[0])
+    for run in ("first", "cached"):
+        client = FakeEnrichmentClient(annotation["utterances"], latency=0)
+        utterances = app.enrichUtterances([{"text": utterance["text"]} for utterance in annotation["utterances"]],
+            translate_client=client, comprehend_client=client)
+        assert analyses(utterances) == analyses(annotation["utterances"])
+        if run == "first":
+            assert sum(client.calls.values()) > 0
+    assert client.calls == {}
+
+
+def test_call_aws_gives_up_after_max_retries(no_rate_limits, monkeypatch):
+    monkeypatch.setattr(app, "aws_max_retries", 2)
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise FakeThrottlingError()
+
+    with pytest.raises(FakeThrottlingError):
+        app.callAws("translate", throttled)
+    assert len(calls) == 3
+
+
+def test_call_aws_raises_other_errors_at_once(no_rate_limits):
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise ValueError("not throttled")
+
+    with pytest.raises(ValueError):
+        app.callAws("comprehend", failing)
+    assert len(calls) == 1
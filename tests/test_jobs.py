@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import app
+from tests.fakes import SimulatedClock, FakeNotificationQueue, simulateJobTracking, simulateFixedPolling, job_scenarios
+
+
+@pytest.mark.parametrize("scenario", list(job_scenarios))
+def test_adaptive_polling_sends_no_more_requests_than_fixed_polling(scenario):
+    finish_times = job_scenarios[scenario]
+    fixed_dead_time, fixed_requests = simulateFixedPolling(finish_times)
+    dead_time, requests = simulateJobTracking(finish_times, None, SimulatedClock())
+    assert requests <= fixed_requests
+
+
+@pytest.mark.parametrize("scenario", list(job_scenarios))
+def test_notifications_detect_finished_jobs_at_once(scenario):
+    finish_times = job_scenarios[scenario]
+    polling_dead_time, polling_requests = simulateJobTracking(finish_times, None, SimulatedClock())
+    clock = SimulatedClock()
+    dead_time, requests = simulateJobTracking(finish_times, FakeNotificationQueue(clock, finish_times), clock)
+    assert dead_time == 0
+    # Jobs are still polled now and then in case a notification is lost
+    assert requests <= polling_requests
+
+
+def test_failed_job_raises():
+    clock = SimulatedClock()
+    job_tracker = app.JobTracker(clock=clock.time, sleep=clock.sleep)
+    job_tracker.add("label_detection", "job", lambda: ("FAILED", {}))
+    with pytest.raises(Exception, match="label_detection job failed"):
+        job_tracker.waitFor(["label_detection"])
+
+
+def test_parse_job_notification():
+    rekognition = {"JobId": "1234", "Status": "SUCCEEDED", "API": "StartLabelDetection"}
+    assert app.parseJobNotification(json.dumps(rekognition)) == ("1234", "SUCCEEDED")
+    assert app.parseJobNotification(json.dumps({"Type": "Notification", "Message": json.dumps(rekognition)})) == ("1234", "SUCCEEDED")
+    transcribe = {"source": "aws.transcribe", "detail": {"TranscriptionJobName": "job", "TranscriptionJobStatus": "FAILED"}}
+    assert app.parseJobNotification(json.dumps(transcribe)) == ("job", "FAILED")
+    assert app.parseJobNotification("not json") is None
+    assert app.parseJobNotification(json.dumps({"other": "message"})) is None
@@ -0,0 +1,66 @@
+import os
+import random
+
+import pytest
+from lxml import etree
+
+import app
+from tests.corpus import example_directories
+
+
+@pytest.fixture(scope="module")
+def schema():
+    # Parsing the schema takes longer than all validations
+    return etree.RelaxNG(etree.parse(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'custom-scheme.rng')))
+
+
+def countLabelSchemaErrors(schema, tei_path) -> int:
+    '''
+        Validates a TEI file against custom-scheme.rng, returns the number of errors in the DetectedLabel divs
+    '''
+    document = etree.parse(tei_path)
+    schema.validate(document)
+    label_lines = set()
+    for div in document.iter('{http://www.tei-c.org/ns/1.0}div'):
+        if div.get("type") == "DetectedLabel":
+            label_lines.update(element.sourceline for element in div.iter())
+    return sum(1 for error in schema.error_log if error.line in label_lines)
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_label_ranges_validate_against_the_schema(directory, schema, offline, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "aggregate_labels", True)
+    annotation = app.rebuildAnnotation(directory, str(tmp_path))
+    assert all("count" in label for label in annotation["detected_labels"])
+    tei_path = str(tmp_path / "annotation.xml")
+    app.saveTeiFile(app.getAnnotationPath(str(tmp_path)), tei_path)
+    assert countLabelSchemaErrors(schema, tei_path) == 0
+
+
+def test_samples_are_not_merged_across_shots(monkeypatch):
+    monkeypatch.setattr(app, "label_run_max_gap", 10.0)
+    shots = [{"start": "0.00", "end": "4.00"}, {"start": "5.00", "end": "9.00"}]
+    labels = [{"label_name": "Person", "timestamp": timestamp, "confidence": 90.0} for timestamp in ("1.00", "3.00", "4.50", "6.00", "8.00", "9.50")]
+    assert [(run["start"], run["end"], run["count"]) for run in app.aggregateLabels(labels, shots)] == [
+        ("1.00", "3.00", 2), ("4.50", "4.50", 1), ("6.00", "8.00", 2), ("9.50", "9.50", 1)]
+
+
+@pytest.mark.skipif(app.numpy is None, reason="numpy is not installed")
+def test_numpy_aggregation_equals_python_aggregation(monkeypatch):
+    generator = random.Random(548)
+    for case in range(100):
+        shots = []
+        start = generator.randrange(0, 2000)
+        for shot in range(generator.randrange(0, 6)):
+            end = start + generator.randrange(0, 3000)
+            shots.append({"start": "%.2f" % (start / 1000), "end": "%.2f" % (end / 1000)})
+            start = end + generator.randrange(0, 2000)
+        labels = [{
+            "label_name": generator.choice(("Person", "Text", "Tree")),
+            "timestamp": "%.2f" % (generator.randrange(0, 20000) / 1000),
+            "confidence": generator.uniform(50, 100),
+        } for label in range(generator.randrange(0, 40))]
+        with_numpy = app.aggregateLabels(labels, shots)
+        monkeypatch.setattr(app, "numpy", None)
+        assert app.aggregateLabels(labels, shots) == with_numpy
+        monkeypatch.undo()
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import app
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+
+@pytest.fixture
+def sqs_client(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SECURITY_TOKEN", "AWS_SESSION_TOKEN"):
+        monkeypatch.setenv(name, "testing")
+    with moto.mock_aws():
+        yield boto3.client("sqs", region_name="eu-central-1")
+
+
+def test_only_notifications_of_tracked_jobs_are_deleted(sqs_client):
+    queue_url = sqs_client.create_queue(QueueName="job-notifications")["QueueUrl"]
+    bodies = [
+        json.dumps({"JobId": "tracked", "Status": "SUCCEEDED"}),
+        json.dumps({"JobId": "someone else's", "Status": "SUCCEEDED"}),
+        "no job notification",
+        json.dumps({"Type": "Notification", "Message": json.dumps({"JobId": "tracked too", "Status": "FAILED"})}),
+    ]
+    for body in bodies:
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=body)
+
+    queue = app.SqsNotificationQueue(queue_url, sqs_client)
+    notifications = []
+    for attempt in range(3):
+        notifications.extend(queue.receive({"tracked", "tracked too"}, 0))
+    assert sorted(notifications) == [("tracked", "SUCCEEDED"), ("tracked too", "FAILED")]
+
+    # The other messages are visible again for the other consumers of the queue
+    remaining = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)["Messages"]
+    assert sorted(message["Body"] for message in remaining) == sorted(bodies[1:3])
+
+
+def test_queue_requests_go_through_call_aws(sqs_client, monkeypatch):
+    queue_url = sqs_client.create_queue(QueueName="job-notifications")["QueueUrl"]
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps({"JobId": "tracked", "Status": "SUCCEEDED"}))
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody="no job notification")
+    calls = []
+    callAws = app.callAws
+
+    def countingCallAws(service, function, **kwargs):
+        calls.append((service, function.__name__))
+        return callAws(service, function, **kwargs)
+
+    monkeypatch.setattr(app, "callAws", countingCallAws)
+    app.SqsNotificationQueue(queue_url, sqs_client).receive({"tracked"}, 0)
+    assert ("sqs", "receive_message") in calls
+    assert ("sqs", "delete_message") in calls
+    assert ("sqs", "change_message_visibility") in calls
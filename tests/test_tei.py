@@ -0,0 +1,76 @@
+import os
+import json
+import filecmp
+
+import pytest
+from lxml import etree
+
+import app
+from tests.corpus import example_directories, loadAnnotation, repeatAnnotation, joinCues, naiveShotBuckets, indexedShotBuckets
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_time_index_matches_the_nested_scan(directory):
+    annotation = loadAnnotation(directory)
+    assert indexedShotBuckets(app.AnnotationModel.fromDict(annotation)) == naiveShotBuckets(annotation)
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_incremental_writer_equals_tree_writer(directory, tmp_path):
+    annotation_path = os.path.join(directory, 'annotation.json')
+    app.writeTeiFile(app.createTeiFile(annotation_path), str(tmp_path / "tree.xml"))
+    app.writeTeiFileIncrementally(annotation_path, str(tmp_path / "incremental.xml"))
+    assert filecmp.cmp(str(tmp_path / "tree.xml"), str(tmp_path / "incremental.xml"), shallow=False)
+
+
+@pytest.mark.parametrize("single_cue", [False, True])
+def test_fragment_workers_equal_serial_writer(single_cue, tmp_path, monkeypatch):
+    annotation = repeatAnnotation(loadAnnotation(example_directories[0]), 3)
+    annotation_path = str(tmp_path / "annotation.json")
+    with open(annotation_path, 'w') as fp:
+        json.dump(joinCues(annotation) if single_cue else annotation, fp)
+    monkeypatch.setattr(app, "tei_fragment_workers", 1)
+    app.writeTeiFileIncrementally(annotation_path, str(tmp_path / "serial.xml"))
+    # Workers are started however small the annotation and however many processors there are
+    monkeypatch.setattr(app, "tei_fragment_workers", 2)
+    monkeypatch.setattr(app, "getTeiFragmentWorkers", lambda model, tasks: 2)
+    app.writeTeiFileIncrementally(annotation_path, str(tmp_path / "workers.xml"))
+    assert filecmp.cmp(str(tmp_path / "serial.xml"), str(tmp_path / "workers.xml"), shallow=False)
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_utterance_ids_are_unique_and_independent_of_the_windows(directory, tmp_path, monkeypatch):
+    annotation_path = os.path.join(directory, 'annotation.json')
+    app.writeTeiFileIncrementally(annotation_path, str(tmp_path / "serial.xml"))
+    document = etree.parse(str(tmp_path / "serial.xml"))
+    ids = [element.get("{http://www.w3.org/XML/1998/namespace}id") for element in document.iter("{*}u", "{*}ab")]
+    ids = [element_id for element_id in ids if element_id]
+    assert ids and len(ids) == len(set(ids))
+    # Windows of 10 seconds split every cue, the divs are built in worker processes
+    monkeypatch.setattr(app, "tei_fragment_workers", 2)
+    monkeypatch.setattr(app, "tei_fragment_window", 10)
+    monkeypatch.setattr(app, "getTeiFragmentWorkers", lambda model, tasks: 2)
+    app.writeTeiFileIncrementally(annotation_path, str(tmp_path / "windows.xml"))
+    assert filecmp.cmp(str(tmp_path / "serial.xml"), str(tmp_path / "windows.xml"), shallow=False)
+
+
+def test_long_single_cue_starts_workers(monkeypatch):
+    annotation = joinCues(repeatAnnotation(loadAnnotation(example_directories[0]), 80))
+    model = app.AnnotationModel.fromDict(annotation)
+    tasks = app.planTeiFragments(model, app.tei_fragment_window * 1000)
+    monkeypatch.setattr(app, "tei_fragment_workers", 0)
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 4)
+    assert model.rows("detected_cues") == 1
+    assert app.getTeiFragmentWorkers(model, tasks) == 4
+    # The same recording with a single processor or in a single task is built in this process
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 1)
+    assert app.getTeiFragmentWorkers(model, tasks) == 1
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 4)
+    assert app.getTeiFragmentWorkers(model, tasks[:1]) == 1
+
+
+def test_short_recording_is_built_in_this_process(monkeypatch):
+    model = app.AnnotationModel.fromDict(loadAnnotation(example_directories[0]))
+    monkeypatch.setattr(app, "tei_fragment_workers", 0)
+    monkeypatch.setattr(app.os, "cpu_count", lambda: 4)
+    assert app.getTeiFragmentWorkers(model, app.planTeiFragments(model, app.tei_fragment_window * 1000)) == 1
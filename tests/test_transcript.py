@@ -0,0 +1,99 @@
+import io
+import os
+import json
+
+import pytest
+
+import app
+from tests.corpus import example_directories, loadAnnotation
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_streamed_transcript_gives_the_utterances_of_the_whole_file(directory):
+    transcript_path = os.path.join(directory, 'raw_transcript.json')
+    with open(transcript_path) as f_in:
+        expected = list(app.iterUtterances(json.load(f_in)["results"]["items"]))
+    assert list(app.iterUtterances(app.readTranscriptItems(transcript_path))) == expected
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_rebuilt_utterances_equal_the_annotation(directory, offline, tmp_path):
+    annotation = app.rebuildAnnotation(directory, str(tmp_path))
+    assert annotation["utterances"] == loadAnnotation(directory)["utterances"]
+
+
+@pytest.mark.parametrize("chunk_size", list(range(1, 25)))
+def test_numbers_cut_by_the_chunks(chunk_size):
+    document = {"results": {"transcripts": [{"transcript": "Ein Satz."}], "items": [12.5, 3, -0.25, 1e-05, 7E+3, 2.5e-3, True, None, "ä\\\"", {"start_time": "1.23"}, [10, 2.0]]}}
+    stream = io.BytesIO(json.dumps(document, ensure_ascii=False).encode("utf-8"))
+    assert list(app.JsonStreamReader(stream, chunk_size).iterArray(("results", "items"))) == document["results"]["items"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 6, 8, 12, 24])
+def test_float_cut_at_its_point(chunk_size):
+    stream = io.BytesIO(b'{"results":{"items":[12.5, 3]}}')
+    assert list(app.JsonStreamReader(stream, chunk_size).iterArray(("results", "items"))) == [12.5, 3]
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1024, 64 * 1024])
+def test_example_transcripts_in_chunks(chunk_size):
+    for directory in example_directories:
+        with open(os.path.join(directory, 'raw_transcript.json'), 'rb') as f_in:
+            data = f_in.read()
+        items = list(app.JsonStreamReader(io.BytesIO(data), chunk_size).iterArray(("results", "items")))
+        assert items == json.loads(data)["results"]["items"]
+
+
+def test_long_value_is_decoded_a_few_times():
+    data = json.dumps({"results": {"transcripts": [{"transcript": "wort " * 720000}], "items": [1]}}).encode("utf-8")
+    reader = app.JsonStreamReader(io.BytesIO(data))
+    decoder = reader.decoder
+    calls = []
+
+    class CountingDecoder:
+        def raw_decode(self, text, position):
+            calls.append(position)
+            return decoder.raw_decode(text, position)
+
+    reader.decoder = CountingDecoder()
+    assert list(reader.iterArray(("results", "items"))) == [1]
+    # The buffer doubles while the transcript is read instead of growing by a chunk each time
+    assert len(calls) < 20
+
+
+def test_truncated_document_raises():
+    with pytest.raises(json.JSONDecodeError):
+        list(app.JsonStreamReader(io.BytesIO(b'{"results":{"items":[{"type": "pronunciation"'), 4).iterArray(("results", "items")))
+
+
+class FakeDownload:
+    def __init__(self, data):
+        self.raw = io.BytesIO(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+
+def test_downloaded_transcript_is_cached_as_file(result_cache, tmp_path, monkeypatch):
+    transcript_path = os.path.join(example_directories[0], 'raw_transcript.json')
+    with open(transcript_path, 'rb') as f_in:
+        data = f_in.read()
+    monkeypatch.setattr(app.requests, "get", lambda url, **kwargs: FakeDownload(data))
+    response = {"TranscriptionJob": {"Transcript": {"TranscriptFileUri": "https://example.com/transcript.json"}}}
+    items = list(app.downloadTranscriptItems(response, str(tmp_path / "downloaded.json"), app.transcriptionCacheKey("hash")))
+    assert items == json.loads(data)["results"]["items"]
+    with open(result_cache.getFile(*app.transcriptionCacheKey("hash")), 'rb') as f_in:
+        assert f_in.read() == data
+
+    # The next run reads the transcript from the cache without a job
+    output_directory = tmp_path / "next"
+    output_directory.mkdir()
+    cached_items = app.runTranscriptionStage(None, "hash", None, str(output_directory))
+    assert list(cached_items) == items
+    assert (output_directory / 'raw_transcript.json').read_bytes() == data
@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+import app
+from tests.corpus import example_directories, loadAnnotation
+from tests.fakes import FakeEnrichmentClient, LocalS3, LocalBatchTranslate
+
+
+@pytest.mark.parametrize("directory", example_directories)
+def test_batch_translation_equals_realtime_translation(directory, no_rate_limits):
+    annotation = loadAnnotation(directory)
+    expected = [utterance["translation"] for utterance in annotation["utterances"]]
+    client = FakeEnrichmentClient(annotation["utterances"], latency=0)
+    assert [app.translateText(utterance["text"], client) for utterance in annotation["utterances"]] == expected
+
+    s3 = LocalS3()
+    batch_client = LocalBatchTranslate(annotation["utterances"], s3)
+    job_tracker = app.JobTracker(min_interval=0.01, max_interval=0.01)
+    utterances = app.translateUtterancesBatch([{"text": utterance["text"]} for utterance in annotation["utterances"]], job_tracker,
+        "test_"+os.path.basename(directory), translate_client=batch_client, s3_client=s3)
+    assert [utterance["translation"] for utterance in utterances] == expected
+    assert batch_client.calls["start_text_translation_job"] == 1
+    assert "translate_text" not in batch_client.calls
@@ -0,0 +1,70 @@
+import os
+import hashlib
+
+import pytest
+
+import app
+
+moto = pytest.importorskip("moto")
+boto3 = pytest.importorskip("boto3")
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SECURITY_TOKEN", "AWS_SESSION_TOKEN"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setattr(app, "s3_bucket_name", "video-to-tei-test")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="eu-central-1")
+        client.create_bucket(Bucket="video-to-tei-test", CreateBucketConfiguration={"LocationConstraint": "eu-central-1"})
+        yield client
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = tmp_path / "Recording.MP4"
+    path.write_bytes(os.urandom(64 * 1024))
+    return str(path)
+
+
+def test_recording_is_uploaded_under_its_content_hash(s3_client, recording):
+    media_hash = app.hashFile(recording)
+    with open(recording, 'rb') as f_in:
+        assert media_hash == hashlib.sha256(f_in.read()).hexdigest()
+    key = app.uploadRecording(media_hash, recording, s3_client)
+    assert key == "media/"+media_hash+".mp4"
+    with open(recording, 'rb') as f_in:
+        assert s3_client.get_object(Bucket="video-to-tei-test", Key=key)["Body"].read() == f_in.read()
+
+
+def test_known_recording_is_not_uploaded_again(s3_client, recording, monkeypatch):
+    media_hash = app.hashFile(recording)
+    key = app.uploadRecording(media_hash, recording, s3_client)
+    uploads = []
+    monkeypatch.setattr(s3_client, "upload_fileobj", lambda *args, **kwargs: uploads.append(args))
+    assert app.uploadRecording(media_hash, recording, s3_client) == key
+    assert uploads == []
+
+
+def test_object_of_another_size_is_uploaded_again(s3_client, recording):
+    media_hash = app.hashFile(recording)
+    key = "media/"+media_hash+".mp4"
+    # An upload broken off left a shorter object under the key
+    s3_client.put_object(Bucket="video-to-tei-test", Key=key, Body=b"partial")
+    assert not app.s3ObjectExists(s3_client, key, os.path.getsize(recording))
+    app.uploadRecording(media_hash, recording, s3_client)
+    assert s3_client.head_object(Bucket="video-to-tei-test", Key=key)["ContentLength"] == os.path.getsize(recording)
+
+
+def test_large_file_is_uploaded_in_parts(s3_client, tmp_path, monkeypatch):
+    # S3 parts are at least 5 MB except the last one
+    monkeypatch.setattr(app, "s3_multipart_threshold", 5 * 1024 * 1024)
+    monkeypatch.setattr(app, "s3_multipart_chunksize", 5 * 1024 * 1024)
+    path = tmp_path / "long.mp4"
+    path.write_bytes(os.urandom(11 * 1024 * 1024))
+    key = app.uploadFile(str(path), "media/long.mp4", s3_client, "video")
+    response = s3_client.head_object(Bucket="video-to-tei-test", Key=key)
+    assert response["ContentLength"] == 11 * 1024 * 1024
+    # The ETag of a multipart upload ends with the number of parts
+    assert response["ETag"].strip('"').endswith("-3")
+    assert s3_client.get_object(Bucket="video-to-tei-test", Key=key)["Body"].read() == path.read_bytes()